@@ -1,55 +1,227 @@
-from flask import Flask, request, redirect, render_template, session, flash, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, Blueprint, current_app, request, redirect, render_template, session, flash, g, jsonify, abort, send_from_directory, make_response
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import configure_mappers
 from datetime import date
 
-from models import db, connect_db, User, Book, Club, Membership, Read, Note, Meeting, Favorite
+from models import db, connect_db, User, CurrentUser, Book, Club, Membership, ClubRole, Read, Note, Meeting, Favorite
 from forms import LoginForm, RegisterForm, NewNoteForm, EditNoteForm, DeleteForm, EditUserForm, ClubForm, MeetingForm, BookSearchForm
 from transforms import transform_book_res
-
-import requests
+from cache import TTLCache
+from passwords import hasher
+from pagination import paginate
+from search import search_books
+from openlibrary import openlibrary, OpenLibraryError, SEARCH_PAGE_SIZE, to_bibkey
+from images import images, ImageError
+from assets import assets
+from config import CONFIGS
+from dbpool import pool_metrics
+from queries import query_counter
+from dates import parse_datetime, format_datetime
+
+from hashlib import sha1
+from urllib.parse import urlencode
+import hmac
+import json
 import os
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_VERSION_KEY = "curr_user_version"
+
+views = Blueprint("views", __name__)
+
+# Per worker caches, sized by create_app()
+user_cache = TTLCache()
+fragment_cache = TTLCache()
+
+
+@views.app_template_global()
+def cached_fragment(*key, caller):
+    """Use as {% call cached_fragment(name, id, version, ...) %}...{% endcall %}: renders the block once per key and reuses the HTML after that.
+
+    Keys should include the version of whatever the block shows, plus anything about the viewer that changes it."""
+
+    html = fragment_cache.get(key)
+    if html is None:
+        html = caller()
+        fragment_cache.set(key, html)
+
+    return html
+
+
+########################################################################
+# Conditional GETs
+#
+# Pages get a weak ETag built from the version stamps of what they show, so a repeat visit to an unchanged page is answered with an empty 304 before any template is rendered.
+
+
+def templates_version(app):
+    """Fingerprint of the deployed templates and static assets. Part of every ETag, so a deploy that changes how pages look invalidates them."""
+
+    digest = sha1(json.dumps(assets.manifest, sort_keys=True).encode("utf8"))
+    for root, dirs, files in sorted(os.walk(app.template_folder)):
+        dirs.sort()
+        for file in sorted(files):
+            with open(os.path.join(root, file), "rb") as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()[:12]
+
+def page_etag(*parts):
+    """Weak ETag for a page made from parts (ids, versions, rows...), as seen by the current user"""
+
+    # The nav bar shows the viewer, so their own version is part of every page
+    viewer = (g.user.id, g.user.version) if g.user else None
+    return sha1(repr((current_app.config['ETAG_SALT'], viewer, parts)).encode("utf8")).hexdigest()[:20]
+
+def tag_page(resp, etag):
+    resp.set_etag(etag, weak=True)
+    # Pages are per user, and must be revalidated on every visit
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def not_modified(etag):
+    """Return a 304 response if the browser already has this version of the page, else None"""
+
+    # Pending flash messages would be left unshown by a 304
+    if request.if_none_match.contains_weak(etag) and "_flashes" not in session:
+        return tag_page(current_app.response_class(status=304), etag)
+    return None
+
+def render_if_modified(etag, template, **context):
+    """Render template with an ETag, or answer 304 Not Modified without rendering it"""
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgresql:///booktalk')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False 
-app.config['SQLALCHEMY_ECHO'] = True
+    return not_modified(etag) or tag_page(make_response(render_template(template, **context)), etag)
 
-app.config["SECRET_KEY"] = os.environ.get('SECRET_KEY', '1c47bdd72341acb7c0c9b991ef6db584c53cee37e8fc19c38688b3f0fb8e29bc')
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
-connect_db(app)
+########################################################################
+# Images
+#
+# Covers and avatars are hotlinked from other sites, at full size. Templates instead use thumbnail(), which points at a resized local copy once we have one, and at the proxy below until then.
+
+# {{ meeting.starts_at|meeting_time }}
+views.add_app_template_filter(format_datetime, "meeting_time")
+
+# Thumbnails are named after their content, so they can be cached forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@views.app_template_global()
+def thumbnail(url, size=180):
+    """URL of a cached, resized copy of a remote image, for use in templates. Local images get their built copy, if there is one."""
+
+    if url and url.startswith("/static/"):
+        return assets.url(url[len("/static/"):])
+
+    if not url or not url.startswith(("http://", "https://")):
+        return url
 
-toolbar = DebugToolbarExtension(app)
+    content_hash = images.lookup(url)
+    if content_hash:
+        return f"/images/{images.filename(content_hash, size)}"
+
+    return f"/images/proxy?{urlencode({'url': url, 'size': size, 'sig': images.sign(url, size)})}"
+
+@views.route("/images/proxy")
+def proxy_image():
+    """Fetch and resize an image the first time a page asks for it, then redirect to the stored thumbnail"""
+
+    url = request.args.get("url", "")
+    size = request.args.get("size", type=int)
+
+    if not images.verify(url, size, request.args.get("sig")):
+        abort(404)
+
+    content_hash = images.lookup(url)
+    if not content_hash:
+        try:
+            content_hash = images.fetch(url)
+        except ImageError:
+            # Fall back to hotlinking rather than showing a broken image
+            return redirect(url)
+
+    resp = redirect(f"/images/{images.filename(content_hash, size)}")
+    resp.headers["Cache-Control"] = "public, max-age=86400"
+    return resp
+
+@views.route("/images/<filename>")
+def serve_image(filename):
+    """Serve a stored thumbnail"""
+
+    resp = send_from_directory(images.path, filename)
+    resp.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+    return resp
 
 
 ########################################################################
 # User register/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def load_user():
-    """If logged in, load curr user."""
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    """If logged in, load curr user from the identity cache, only hitting the db on a miss."""
 
-    else:
+    # Static files and images never need the user
+    if CURR_USER_KEY not in session or request.endpoint in ("static", "views.proxy_image", "views.serve_image"):
         g.user = None
+        return
+
+    user_id = session[CURR_USER_KEY]
+    snapshot = user_cache.get(user_id)
+
+    # The cache is per worker, so the user may have changed their profile through another one since this snapshot was taken. The signed session carries the version they last saw, which forget_user() clears, so a snapshot that doesn't match it is reloaded without asking the db on every hit. Changes made by someone else are picked up when the entry expires.
+    if snapshot is not None and snapshot["version"] != session.get(CURR_USER_VERSION_KEY):
+        snapshot = None
+
+    if snapshot is None:
+        user = User.query.get(user_id)
+        if not user:
+            g.user = None
+            return
+
+        snapshot = user.snapshot()
+        user_cache.set(user_id, snapshot)
+        session[CURR_USER_VERSION_KEY] = snapshot["version"]
+
+    g.user = CurrentUser(snapshot)
+
+def forget_user(user_id):
+    """Drop a user's cached identity. Call whenever the user's row or memberships change."""
+
+    user_cache.pop(user_id)
+
+    # Makes the user's next request, on whichever worker, reload them
+    if session.get(CURR_USER_KEY) == user_id:
+        session.pop(CURR_USER_VERSION_KEY, None)
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = user.version
+    user_cache.set(user.id, user.snapshot())
+
+def club_role(club_id):
+    """Return the current user's ClubRole for a club.
+
+    Costs one primary key lookup on memberships the first time a club is checked in a request; later checks for the same club are free."""
+
+    if not g.user:
+        return ClubRole()
+
+    roles = g.setdefault("club_roles", {})
+    if club_id not in roles:
+        roles[club_id] = ClubRole(Membership.query.get((g.user.id, club_id)))
+
+    return roles[club_id]
 
 def do_logout():
     """Logout user."""
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_VERSION_KEY, None)
 
-@app.route("/register", methods=["GET", "POST"])
+@views.route("/register", methods=["GET", "POST"])
 def register():
     """Generate and handles registration submission"""
 
@@ -89,7 +261,7 @@ def register():
     else:
         return render_template('users/register.html', form=form)
 
-@app.route("/login", methods=["GET", "POST"])
+@views.route("/login", methods=["GET", "POST"])
 def login():
     """Generates and handles login form submission"""
     if g.user:
@@ -103,6 +275,8 @@ def login():
 
         user = User.authenticate(username, password)
         if user:
+            # Saves the upgraded hash if authenticate rehashed the password
+            db.session.commit()
             # flash(f"Welcome Back, {user.first_name}!", "text-primary")
             do_login(user)
             flash(f"Welcome to BookTalk, {user.username}!", "text-light")
@@ -112,7 +286,7 @@ def login():
 
     return render_template('users/login.html', form=form)
 
-@app.route("/logout")
+@views.route("/logout")
 def logout():
     """Logs out current user"""
 
@@ -126,7 +300,7 @@ def logout():
 # User routes
 
 
-@app.route("/users")
+@views.route("/users")
 def show_users():
     """Shows a list of users in the app if logged in"""
 
@@ -134,11 +308,14 @@ def show_users():
         flash("You need to be logged in with a registered account to view that page.", "text-danger")
         return redirect("/")
 
-    users = User.query.all()
+    # Only the columns the list shows, as plain rows, a page at a time
+    query = db.session.query(User.id, User.username, User.image)
+    users = paginate(query, [User.username, User.id], cursor=request.args.get("after"))
 
-    return render_template("users/list.html", users=users)
+    etag = page_etag("users", [tuple(user) for user in users], users.next_cursor)
+    return render_if_modified(etag, "users/list.html", users=users)
 
-@app.route("/users/<int:user_id>")
+@views.route("/users/<int:user_id>")
 def user_details(user_id):
     """Shows user profile if logged in."""
 
@@ -148,9 +325,12 @@ def user_details(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template("users/details.html", user=user)
+    # Only the user sees their own clubs' meetings, which change with those clubs' versions rather than their own
+    club_versions = user.club_versions() if user.id == g.user.id else None
 
-@app.route("/users/<int:user_id>/edit", methods=["GET", "POST"])
+    return render_if_modified(page_etag("user", user.id, user.version, club_versions), "users/details.html", user=user, club_versions=club_versions)
+
+@views.route("/users/<int:user_id>/edit", methods=["GET", "POST"])
 def edit_user(user_id):
     """Generates and handles submission of user edit form"""
 
@@ -161,8 +341,9 @@ def edit_user(user_id):
     form = EditUserForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.password.data)
-        if user:
+        # By id, not username: another worker's cached snapshot may still carry an old one
+        user = User.query.get(g.user.id)
+        if user and user.check_password(form.password.data):
 
             user.username = form.username.data
             user.email = form.email.data
@@ -171,6 +352,10 @@ def edit_user(user_id):
             user.last_name = form.last_name.data
             user.bio = form.bio.data
 
+            # Their name shows on their profile and in their clubs' member lists
+            User.bump_version(user.id)
+            Club.bump_member_clubs(user.id)
+
             try:
                 db.session.commit()
 
@@ -178,6 +363,8 @@ def edit_user(user_id):
                 db.session.rollback()
                 form.username.errors.append('Sorry, this username is already taken. Please choose another')
                 return render_template('users/edit.html', form=form)
+
+            forget_user(user.id)
             
             flash("Successfully updated user information.", "text-light")
             return redirect (f"/users/{user.id}")
@@ -188,13 +375,13 @@ def edit_user(user_id):
     else:
         return render_template('users/edit.html', form=form)
 
-@app.route("/users/<int:user_id>/delete", methods=["POST"])
+@views.route("/users/<int:user_id>/delete", methods=["POST"])
 def delete_user(user_id):
     """Delete user."""
 
     user = User.query.get_or_404(user_id)
 
-    if not g.user or user is not g.user:
+    if not g.user or user.id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
@@ -219,8 +406,10 @@ def delete_user(user_id):
 
     do_logout()
 
-    db.session.delete(g.user)
+    Club.bump_member_clubs(user.id)
+    db.session.delete(user)
     db.session.commit()
+    forget_user(user.id)
 
     return redirect("/register")
 
@@ -230,7 +419,7 @@ def delete_user(user_id):
 # Home page
 
 
-@app.route("/")
+@views.route("/")
 def show_home():
     """Show home page."""
 
@@ -247,7 +436,7 @@ def show_home():
 # Club routes
 
 
-@app.route("/clubs")
+@views.route("/clubs")
 def show_clubs():
     """Shows list of active clubs"""
 
@@ -255,11 +444,16 @@ def show_clubs():
         flash("You need to be logged in with a registered account to view that page.", "text-danger")
         return redirect("/")
 
-    clubs = Club.query.all()
+    # Each club with its current book (if any), as plain rows, a page at a time
+    query = (db.session.query(Club.id, Club.name, Book.title.label("book_title"), Book.image.label("book_image"))
+             .outerjoin(Read, db.and_(Read.club_id == Club.id, Read.current == True))
+             .outerjoin(Book, Book.id == Read.book_id))
+    clubs = paginate(query, [Club.name, Club.id], cursor=request.args.get("after"))
 
-    return render_template("clubs/list.html", clubs=clubs)
+    etag = page_etag("clubs", [tuple(club) for club in clubs], clubs.next_cursor)
+    return render_if_modified(etag, "clubs/list.html", clubs=clubs)
 
-@app.route("/clubs/<int:club_id>")
+@views.route("/clubs/<int:club_id>")
 def show_club_page(club_id):
     """Shows page with club details"""
 
@@ -269,44 +463,22 @@ def show_club_page(club_id):
     
     club = Club.query.get_or_404(club_id)
 
-    # If user is in the club, they will see a more detailed club page
-    if g.user in club.users:
-        ########################
-        # Build shelves
-
-        # Create list of reads that are not current
-        shelved = []
-        for read in club.reads:
-            if not read.current:
-                shelved.append(read)
+    # Everything on the page, including who is a member, bumps club.version when it changes
+    etag = page_etag("club", club.id, club.version)
+    resp = not_modified(etag)
+    if resp:
+        return resp
 
-        # From shelved books, separate books that have been finished
-        finished_ids = []
-        unfinished_ids = []
+    role = club_role(club_id)
 
-        for read in shelved:
-            if read.complete:
-                finished_ids.append(read.book_id)
-            else:
-                unfinished_ids.append(read.book_id)
-
-        finished = Book.query.filter(Book.id.in_(finished_ids)).all()
-        unfinished = Book.query.filter(Book.id.in_(unfinished_ids)).all()
-
-        ########################
-        # Designate admins and moderators
-
-        admin_members = Membership.query.filter(Membership.admin == True, Membership.club_id == club.id).all()
-        admins = [member.user_id for member in admin_members]
-        mod_members = Membership.query.filter(Membership.moderator == True, Membership.club_id == club.id).all()
-        mods = [member.user_id for member in mod_members]
-
-        return render_template("clubs/member-details.html", club=club, unfinished=unfinished, finished=finished, admins=admins, mods=mods)
+    # If user is in the club, they will see a more detailed club page. Its member lists and meetings are cached fragments, only queried when club.version changes.
+    if role.is_member:
+        return render_if_modified(etag, "clubs/member-details.html", club=club, role=role, shelves=club.shelves())
 
     else:
-        return render_template("clubs/general-details.html", club=club)
+        return render_if_modified(etag, "clubs/general-details.html", club=club, current=club.current_books())
 
-@app.route("/clubs/create", methods=["GET", "POST"])
+@views.route("/clubs/create", methods=["GET", "POST"])
 def create_club():
     """Generates and handles submission of new club form"""
 
@@ -337,14 +509,16 @@ def create_club():
         # Give club creator admin privileges
         membership = Membership(user_id=g.user.id, club_id=c.id, join_date=join_date, admin=True, moderator=False)
         db.session.add(membership)
+        User.bump_version(g.user.id)
         db.session.commit()
+        forget_user(g.user.id)
 
         return redirect (f"/clubs/{c.id}")
     
     else:
         return render_template('clubs/new.html', form=form)
 
-@app.route("/clubs/<int:club_id>/delete", methods=["POST"])
+@views.route("/clubs/<int:club_id>/delete", methods=["POST"])
 def delete_club(club_id):
     """Deletes a member to delete a club he or she is a part of"""
 
@@ -355,9 +529,8 @@ def delete_club(club_id):
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    membership = db.session.query(Membership).filter(Membership.club_id == club_id, Membership.user_id == g.user.id).first()
-
-    if membership.admin:
+    if club_role(club_id).is_admin:
+        # Members' profiles list the club by its version, which goes with the memberships
         db.session.delete(club)
         db.session.commit()
 
@@ -371,7 +544,7 @@ def delete_club(club_id):
 # Membership routes (clubs subroutes)
     
 
-@app.route("/clubs/<int:club_id>/join", methods=["POST"])
+@views.route("/clubs/<int:club_id>/join", methods=["POST"])
 def join_club(club_id):
     """Join a club"""
 
@@ -381,24 +554,27 @@ def join_club(club_id):
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    if g.user in club.users:
+    if club_role(club_id).is_member:
         flash("You're already part of this club.'", "text-danger")
         return redirect(f"/clubs/{club_id}")
     
     # If the club is empty, the user joining automatically becomes the moderator
-    if len(club.users) == 0:
+    if not club.has_members():
         m = Membership(user_id=g.user.id, club_id=club_id, admin=True)
-        db.session.add(m)
-        db.session.commit()
     else:
         m = Membership(user_id=g.user.id, club_id=club_id)
-        db.session.add(m)
-        db.session.commit()
+
+    db.session.add(m)
+    Club.bump_version(club_id)
+    User.bump_version(g.user.id)
+    db.session.commit()
+
+    forget_user(g.user.id)
 
     return redirect(f"/clubs/{club_id}")
 
 
-@app.route("/clubs/<int:club_id>/leave", methods=["POST"])
+@views.route("/clubs/<int:club_id>/leave", methods=["POST"])
 def leave_club(club_id):
     """Leave a club"""
 
@@ -408,28 +584,29 @@ def leave_club(club_id):
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    if g.user not in club.users:
+    membership = club_role(club_id).membership
+
+    if not membership:
         flash("You're not a member of this club.'", "text-danger")
         return redirect(f"/clubs/{club_id}")
 
-    membership = Membership.query.filter(Membership.user_id == g.user.id, Membership.club_id == club_id).first()
-
     # If an admin tries to leave, ensure that there are other admins. Otherwise, prevent them from leaving until they promote another member to admin
     if membership.admin:
-        memberships = Membership.query.filter(Membership.club_id == club_id).all()
-        admins = [member for member in memberships if member.admin]
-        # pdb.set_trace()
-        if len(admins) == 1:
+        admin_count = Membership.query.filter(Membership.club_id == club_id, Membership.admin == True).count()
+        if admin_count == 1:
             flash(f"Please promote another member to admin before leaving the club.", "text-danger")
             return redirect(f"/clubs/{club.id}")
         
-    g.user.clubs.remove(club)
+    db.session.delete(membership)
+    Club.bump_version(club_id)
+    User.bump_version(g.user.id)
     db.session.commit()
+    forget_user(g.user.id)
 
     return redirect(f"/clubs/{club_id}")
 
 
-@app.route("/clubs/<int:club_id>/<int:user_id>/toggle_moderator", methods=["POST"])
+@views.route("/clubs/<int:club_id>/<int:user_id>/toggle_moderator", methods=["POST"])
 def add_moderator(club_id, user_id):
     """Allow club admin to add a moderator"""
 
@@ -437,22 +614,23 @@ def add_moderator(club_id, user_id):
         flash("You must be signed in in order to view that page.", "text-danger")
         return redirect("/")
         
-    admin = Membership.query.filter(Membership.user_id == g.user.id, Membership.club_id == club_id).first()
-    is_admin = admin.admin
+    if club_role(club_id).is_admin:
+        membership = Membership.query.get_or_404((user_id, club_id))
+        user = User.query.get_or_404(user_id)
 
-    if is_admin:
-        membership = Membership.query.filter(Membership.user_id == user_id, Membership.club_id == club_id).first()
-        user = User.query.filter(User.id == user_id).first()
+        Club.bump_version(club_id)
 
         if membership.moderator == False:
             membership.moderator = True
             db.session.commit()
+            forget_user(user_id)
             flash(f"Promoted {user.username} to Moderator!", "text-light")
             return redirect(f"/clubs/{club_id}")
         
         else:
             membership.moderator = False
             db.session.commit()
+            forget_user(user_id)
             flash(f"Demoted { user.username } from Moderator.", "text-light")
             return redirect(f"/clubs/{club_id}")
 
@@ -460,7 +638,7 @@ def add_moderator(club_id, user_id):
         flash(f"Admin status required.", "text-danger")
         return redirect(f"/clubs/{club_id}")
 
-@app.route("/clubs/<int:club_id>/<int:user_id>/make_admin", methods=["POST"])
+@views.route("/clubs/<int:club_id>/<int:user_id>/make_admin", methods=["POST"])
 def make_admin(club_id, user_id):
     """Allow club admin to add a moderator"""
 
@@ -468,16 +646,15 @@ def make_admin(club_id, user_id):
         flash("You must be signed in in order to view that page.", "text-danger")
         return redirect("/")
         
-    admin = Membership.query.filter(Membership.user_id == g.user.id, Membership.club_id == club_id).first()
-    is_admin = admin.admin
-
-    if is_admin:
-        membership = Membership.query.filter(Membership.user_id == user_id, Membership.club_id == club_id).first()
-        user = User.query.filter(User.id == user_id).first()
+    if club_role(club_id).is_admin:
+        membership = Membership.query.get_or_404((user_id, club_id))
+        user = User.query.get_or_404(user_id)
 
         if membership.admin == False:
             membership.admin = True
+            Club.bump_version(club_id)
             db.session.commit()
+            forget_user(user_id)
             flash(f"Promoted {user.username} to Admin!", "text-light")
             return redirect(f"/clubs/{club_id}")
         
@@ -496,7 +673,7 @@ def make_admin(club_id, user_id):
 # Reads routes (clubs subroutes)
 
 
-@app.route("/clubs/<int:club_id>/<int:book_id>/toggle_current", methods=["POST"])
+@views.route("/clubs/<int:club_id>/<int:book_id>/toggle_current", methods=["POST"])
 def toggle_current(club_id, book_id):
     """Marks a current book as not current and a not current book as current"""
 
@@ -504,7 +681,7 @@ def toggle_current(club_id, book_id):
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
 
@@ -515,6 +692,8 @@ def toggle_current(club_id, book_id):
         return redirect("/")
 
     # Find the club's read which matches the requested book id. If current, mark not; if not current, mark as current and mark the other current book as not current.
+    Club.bump_version(club_id)
+
     if read.current:
         read.current = False
         db.session.commit()
@@ -523,9 +702,8 @@ def toggle_current(club_id, book_id):
         return redirect(f"/clubs/{club_id}")
 
     else: 
-        for curr_read in club.reads:
-            if curr_read.current:
-                curr_read.current = False
+        # Clear the old current book in one UPDATE rather than loading every read
+        Read.query.filter(Read.club_id == club_id, Read.current == True).update({"current": False})
 
         read.current = True
         db.session.commit()
@@ -534,7 +712,7 @@ def toggle_current(club_id, book_id):
         return redirect(f"/clubs/{club_id}")
 
 
-@app.route("/clubs/<int:club_id>/<int:book_id>/toggle_complete", methods=["POST"])
+@views.route("/clubs/<int:club_id>/<int:book_id>/toggle_complete", methods=["POST"])
 def toggle_complete(club_id, book_id):
     """Marks an incomplete book as complete or reset a completed book to read again"""
 
@@ -542,7 +720,7 @@ def toggle_complete(club_id, book_id):
 
     # TO DO: Revise this function so that only the creator of the club can alter the completed book
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
 
@@ -552,6 +730,8 @@ def toggle_complete(club_id, book_id):
         flash(f"This club is not reading the selected book.")
         return redirect("/")
     
+    Club.bump_version(club_id)
+
     if read.complete:
         read.complete = False
         db.session.commit()
@@ -567,60 +747,36 @@ def toggle_complete(club_id, book_id):
         flash(f"Marked as finished!", "text-light")
         return redirect(f"/clubs/{club_id}")
 
-@app.route("/clubs/<int:club_id>/library")
+@views.route("/clubs/<int:club_id>/library")
 def show_unchecked_books(club_id):
     """Loads a page with books not currently in club"""
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    membership = db.session.query(Membership).filter(Membership.club_id == club_id, Membership.user_id == g.user.id).first()
-
-    if membership.admin or membership.moderator:
-        permission = True
-    else:
-        permission = False
-
-    if not g.user or g.user not in club.users or not permission:
+    if not club_role(club_id).can_manage:
         flash("You must have be an admin or moderator of that club in order to view that page.", "text-danger")
         return redirect("/")
 
-    # CODE REVIEW QUESTION: Is there a cleaner way to do the following query? 
-
-    # Get books that are not read by clubs which the user is a member of
-    all_books = Book.query.all()
-    all_book_ids = [book.id for book in all_books]
-    club_book_ids = [read.book_id for read in club.reads]
-
-    unread_ids = []
-    for book_id in all_book_ids:
-        if book_id not in club_book_ids:
-            unread_ids.append(book_id)
-    
-    unread_books = Book.query.filter(Book.id.in_(unread_ids))
+    # Books the club hasn't added yet, a page at a time, sorted by title
+    search = request.args.get("q", "").strip()
+    page = paginate(club.unshelved_books(search), [Book.title, Book.id], cursor=request.args.get("after"))
 
-    return render_template("books/rent.html", club=club, books=unread_books)
+    return render_template("books/rent.html", club=club, books=page, search=search)
 
-@app.route("/clubs/<int:club_id>/<int:book_id>/add", methods=["POST"])
+@views.route("/clubs/<int:club_id>/<int:book_id>/add", methods=["POST"])
 def add_book_to_club(club_id, book_id):
     """Adds a book and club id to reads table"""
 
     club = db.session.query(Club).get_or_404(club_id)
     book = db.session.query(Book).get_or_404(book_id)
 
-    membership = db.session.query(Membership).filter(Membership.club_id == club_id, Membership.user_id == g.user.id).first()
-
-
-    if membership.admin or membership.moderator:
-        permission = True
-    else:
-        permission = False
-
-    if not g.user or g.user not in club.users or not permission:
+    if not club_role(club_id).can_manage:
         flash("You must have be an admin or moderator of that club in order to view that page.", "text-danger")
         return redirect("/")
 
     read = Read(club_id=club.id, book_id=book.id, current=False, complete=False)
     db.session.add(read)
+    Club.bump_version(club_id)
     db.session.commit()
 
     return redirect(f"/clubs/{club_id}")
@@ -628,45 +784,28 @@ def add_book_to_club(club_id, book_id):
 ############################################################################
 # Meetings routes (clubs subroutes)
 
-@app.route("/clubs/<int:club_id>/meetings/<int:m_id>")
+@views.route("/clubs/<int:club_id>/meetings/<int:m_id>")
 def show_meetings(club_id, m_id):
     """Generate page with all of club's meetings"""
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
     
     meeting = Meeting.query.get_or_404(m_id)
 
-    ########################
-    # Designate admins and moderators
+    # The viewer's role, already looked up above, decides whether they may delete the meeting
+    return render_template("clubs/meetings/details.html", club=club, meeting=meeting, role=club_role(club.id), notes=meeting.member_notes())
 
-    admin = Membership.query.filter(Membership.admin == True, Membership.club_id == club.id).first()
-    mod_memberships = Membership.query.filter(Membership.moderator == True, Membership.club_id == club.id).all()
-    mm_ids = []
-    for membership in mod_memberships:
-        mm_ids.append(membership.user_id)
-    mods = User.query.filter(User.id.in_(mm_ids)).all()
-
-
-    return render_template("clubs/meetings/details.html", club=club, meeting=meeting, admin=admin, mods=mods)
-
-@app.route("/clubs/<int:club_id>/meetings/new", methods=["GET", "POST"])
+@views.route("/clubs/<int:club_id>/meetings/new", methods=["GET", "POST"])
 def create_meeting(club_id):
     """Generate and handle submission of new meeting form"""
 
     club = db.session.query(Club).get_or_404(club_id)
 
-    membership = db.session.query(Membership).filter(Membership.club_id == club_id, Membership.user_id == g.user.id).first()
-
-    if membership.admin or membership.moderator:
-        permission = True
-    else:
-        permission = False
-
-    if not g.user or g.user not in club.users or not permission:
+    if not club_role(club_id).can_manage:
         flash("You must have be an admin or moderator of that club in order to view that page.", "text-danger")
         return redirect("/")
 
@@ -679,8 +818,9 @@ def create_meeting(club_id):
     form.topic.choices = titles
 
     if form.validate_on_submit():
-        meeting = Meeting(date = form.date.data, topic = form.topic.data, url = form.url.data, club_id = club.id)
+        meeting = Meeting(starts_at = parse_datetime(form.starts_at.data), topic = form.topic.data, url = form.url.data, club_id = club.id)
         db.session.add(meeting)
+        Club.bump_version(club_id)
         db.session.commit()
         flash("New meeting added!")
         return redirect(f"/clubs/{club_id}")
@@ -689,42 +829,57 @@ def create_meeting(club_id):
         return render_template("clubs/meetings/add.html", form=form)
 
 
-@app.route("/meetings/<int:m_id>/delete", methods=["POST"])
+@views.route("/meetings/<int:m_id>/delete", methods=["POST"])
 def delete_meeting(m_id):
     """Delete meeting"""
 
     meeting = db.session.query(Meeting).get_or_404(m_id)
     club = db.session.query(Club).filter(Club.id == meeting.club_id).first()
 
-    membership = db.session.query(Membership).filter(Membership.club_id == club.id, Membership.user_id == g.user.id).first()
-
-    if membership.admin or membership.moderator:
-        permission = True
-    else:
-        permission = False
-
-    if not g.user or g.user not in club.users or not permission:
+    if not club_role(club.id).can_manage:
         flash("You must have be an admin or moderator of that club in order to view that page.", "text-danger")
         return redirect("/")
 
     db.session.delete(meeting)
+    Club.bump_version(club.id)
     db.session.commit()
     flash("Deleted meeting.", "text-light")
     return redirect(f"/clubs/{club.id}")
 
+# Most meetings one upcoming meetings request may ask for
+MAX_UPCOMING = 50
+
+@views.route("/api/meetings/upcoming")
+def upcoming_meetings():
+    """The user's next meetings across all their clubs, soonest first, as JSON. Takes ?limit= (default 10)."""
+
+    if not g.user:
+        return jsonify(error="You must be signed in in order to see your meetings."), 401
+
+    limit = min(max(request.args.get("limit", 10, type=int), 1), MAX_UPCOMING)
+
+    return jsonify(meetings=[{
+        "id": meeting.id,
+        "starts_at": meeting.starts_at.isoformat(),
+        "topic": meeting.topic,
+        "url": meeting.url,
+        "club_id": meeting.club_id,
+        "club_name": meeting.club_name
+    } for meeting in Meeting.upcoming(g.user.id, limit)])
+
 ############################################################################
 # Notes routes 
 
 
 
-@app.route("/meetings/<int:m_id>/notes/add", methods=["GET", "POST"])
+@views.route("/meetings/<int:m_id>/notes/add", methods=["GET", "POST"])
 def add_note(m_id):
     """Generate and handle submission of new note form"""
 
     meeting = db.session.query(Meeting).get_or_404(m_id)
     club = db.session.query(Club).get_or_404(meeting.club_id)
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
 
@@ -760,14 +915,14 @@ def add_note(m_id):
         return render_template("notes/add.html", form=form, meeting=meeting, club=club)
 
     
-@app.route("/meetings/<int:m_id>/notes/<int:note_id>/edit", methods=["GET", "POST"])
+@views.route("/meetings/<int:m_id>/notes/<int:note_id>/edit", methods=["GET", "POST"])
 def edit_note(m_id, note_id):
     """Generate and handle submission of new note form"""
 
     meeting = db.session.query(Meeting).get_or_404(m_id)
     club = db.session.query(Club).get_or_404(meeting.club_id)
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
 
@@ -787,14 +942,14 @@ def edit_note(m_id, note_id):
     else:
         return render_template("notes/edit.html", form=form, meeting=meeting, club=club)
 
-@app.route("/meetings/<int:m_id>/notes/<int:note_id>/delete", methods=["POST"])
+@views.route("/meetings/<int:m_id>/notes/<int:note_id>/delete", methods=["POST"])
 def delete_note(m_id, note_id):
     """Delete a note."""
 
     meeting = db.session.query(Meeting).get_or_404(m_id)
     club = db.session.query(Club).get_or_404(meeting.club_id)
 
-    if not g.user or g.user not in club.users:
+    if not club_role(club.id).is_member:
         flash("You must be signed in as a member of that club in order to view that page.", "text-danger")
         return redirect("/")
     
@@ -815,9 +970,7 @@ def delete_note(m_id, note_id):
 ############################################################################
 # Book routes
 
-OPEN_LIB_URL = 'https://openlibrary.org';
-
-@app.route("/books")
+@views.route("/books")
 def show_books():
     """Shows list of books in BookTalk's database."""
 
@@ -825,13 +978,16 @@ def show_books():
         flash("You must be signed in in order to view that page.", "text-danger")
         return redirect("/")
 
-    books = Book.query.all()
+    # Only the columns the list shows, as plain rows, a page at a time
+    query = db.session.query(Book.id, Book.title, Book.image)
+    books = paginate(query, [Book.title, Book.id], cursor=request.args.get("after"))
 
     all_books = True
 
-    return render_template("books/list.html", books=books, all_books=all_books)
+    etag = page_etag("books", [tuple(book) for book in books], books.next_cursor)
+    return render_if_modified(etag, "books/list.html", books=books, all_books=all_books)
 
-@app.route("/books/my_books")
+@views.route("/books/my_books")
 def show_my_books():
     """Shows list of books in BookTalk's database."""
 
@@ -839,28 +995,44 @@ def show_my_books():
         flash("You must be signed in in order to view that page.", "text-danger")
         return redirect("/")
 
-    # CODE REVIEW QUESTION: Is there a cleaner way to do the following query? In SQL, we're running 4 JOINs:
-    # SELECT books.id FROM books                                           
-    # JOIN reads                                                                      
-    # ON books.id = reads.book_id                                                     
-    # JOIN clubs                                                                      
-    # ON reads.club_id = clubs.id                                                     
-    # JOIN memberships                                                                
-    # ON clubs.id = memberships.club_id
-    # JOIN users
-    # ON memberships.user_id = users.id
-    # WHERE users.id = 2;
-
-    # Get books that are read by clubs which the user is a member of
-    user_memberships = db.session.query(Membership).filter_by(user_id=g.user.id).all()
-    user_club_ids = [membership.club_id for membership in user_memberships]
-    user_club_reads = db.session.query(Read).filter(Read.club_id.in_(user_club_ids)).all()
-    user_book_ids = [read.book_id for read in user_club_reads]
-    books = Book.query.filter(Book.id.in_(user_book_ids)).all()
-
-    return render_template("books/list.html", books=books)
-
-@app.route("/books/<int:book_id>")
+    # Books read by clubs which the user is a member of, in one round trip:
+    # SELECT books.id, books.title, books.image FROM books
+    # JOIN reads ON books.id = reads.book_id
+    # JOIN memberships ON reads.club_id = memberships.club_id
+    # WHERE memberships.user_id = ...
+    query = (db.session.query(Book.id, Book.title, Book.image)
+             .join(Read, Read.book_id == Book.id)
+             .join(Membership, Membership.club_id == Read.club_id)
+             .filter(Membership.user_id == g.user.id))
+
+    # Optionally group by club or by reading status
+    group = request.args.get("group")
+    status = Read.status_rank().label("status")
+
+    if group == "club":
+        club_name = Club.name.label("club_name")
+        query = query.join(Club, Club.id == Read.club_id).add_columns(club_name, status)
+        order_by = [club_name, status, Book.title, Book.id]
+    elif group == "status":
+        query = query.add_columns(status).distinct()
+        order_by = [status, Book.title, Book.id]
+    else:
+        # Ungrouped, each book only needs a read in one of the user's clubs. As a semi-join rather than DISTINCT over the joined rows, books are walked in order from ix_books_title_id and the scan stops once the page is full.
+        group = None
+        shelved = (db.session.query(Read.book_id)
+                   .join(Membership, Membership.club_id == Read.club_id)
+                   .filter(Membership.user_id == g.user.id, Read.book_id == Book.id))
+        query = db.session.query(Book.id, Book.title, Book.image).filter(shelved.exists())
+        order_by = [Book.title, Book.id]
+
+    page = paginate(query, order_by, cursor=request.args.get("after"))
+
+    favorite_ids = {book_id for (book_id,) in db.session.query(Favorite.book_id).filter(Favorite.user_id == g.user.id)}
+
+    etag = page_etag("my_books", group, [tuple(book) for book in page], page.next_cursor, sorted(favorite_ids))
+    return render_if_modified(etag, "books/list.html", books=page, group=group, statuses=Read.STATUSES, favorite_ids=favorite_ids)
+
+@views.route("/books/<int:book_id>")
 def book_details(book_id):
     """Shows details for a given book"""
 
@@ -869,10 +1041,11 @@ def book_details(book_id):
         return redirect("/")
 
     book = Book.query.get_or_404(book_id)
+    is_favorite = Favorite.exists(g.user.id, book.id)
 
-    return render_template("books/details.html", book=book)
+    return render_if_modified(page_etag("book", book.id, book.version, is_favorite), "books/details.html", book=book, is_favorite=is_favorite)
 
-@app.route("/books/<int:book_id>/favorite", methods=["POST"])
+@views.route("/books/<int:book_id>/favorite", methods=["POST"])
 def add_favorite(book_id):
     """Add book to user.favorites"""
 
@@ -888,12 +1061,13 @@ def add_favorite(book_id):
 
     else:
         g.user.favorites.append(book)
+        User.bump_version(g.user.id)
         db.session.commit()
 
         flash(f"Added {book.title} to your favorite books!", "text-light")
         return redirect("/books")
 
-@app.route("/books/<int:book_id>/remove_favorite", methods=["POST"])
+@views.route("/books/<int:book_id>/remove_favorite", methods=["POST"])
 def remove_favorite(book_id):
     """Remove book from user.favorites"""
 
@@ -909,12 +1083,13 @@ def remove_favorite(book_id):
 
     else:
         g.user.favorites.remove(book)
+        User.bump_version(g.user.id)
         db.session.commit()
 
         flash(f"Removed {book.title} from your favorite books.", "text-light")
         return redirect("/")
 
-@app.route("/books/search", methods=["GET", "POST"])
+@views.route("/books/search", methods=["GET", "POST"])
 def search_book():
     """Generate and handle submission of search book form"""
 
@@ -924,38 +1099,93 @@ def search_book():
 
     return render_template("/books/search.html")
 
-@app.route("/books/<book_id>/transform", methods=["POST"])
-def show_book(book_id):
-    """Send a request to the OpenLibrary API using the bookID sent from the client, then transform response into BookTalk object. Pass this object to the rendered template."""
+@views.route("/books/search/local")
+def search_local_books():
+    """Full text search over books already in BookTalk's DB. Returns a page of matches as JSON."""
 
     if not g.user:
-        flash("You must be signed in in order to view that page.", "text-danger")
-        return redirect("/")
+        return jsonify(error="You must be signed in in order to search."), 401
+
+    page = search_books(request.args.get("q", ""), cursor=request.args.get("after"))
 
+    return jsonify(
+        books=[{"id": book.id, "title": book.title, "author": book.author, "image": book.image} for book in page],
+        next=page.next_cursor)
 
-    # In order to get usable data, OpenLibrary requres two requests: the first to get the ISBN, which is then used for the second request which can be transformed into usable data
+# Deepest page of OpenLibrary results the search proxy will fetch
+MAX_SEARCH_PAGE = 100
 
-    res = requests.get(f"{OPEN_LIB_URL}/books/{book_id}.json")
+@views.route("/api/books/search")
+def search_openlibrary():
+    """Search OpenLibrary by title or author on the browser's behalf. Returns a page of trimmed results as JSON; popular searches are answered from cache."""
+
+    if not g.user:
+        return jsonify(error="You must be signed in in order to search."), 401
+
+    query = request.args.get("q", "").strip()
+    by = request.args.get("by", "title")
+    page = request.args.get("page", 1, type=int)
+
+    if not query or by not in ("title", "author") or not 1 <= page <= MAX_SEARCH_PAGE:
+        return jsonify(error=f"Expected a search q, by=title or author, and a page from 1 to {MAX_SEARCH_PAGE}."), 400
 
-    print(res.json())
     try:
-        ISBN = res.json()['isbn_13'][0]
-    except KeyError:
-        flash(f"Our database doesn't include an ISBN number for the book you selected. Try choosing another.", "text-danger")
-        return redirect("/books/search")
+        results = openlibrary.search(query, by=by, page=page)
+    except OpenLibraryError:
+        return jsonify(error="We couldn't reach OpenLibrary just now. Please try again in a moment."), 502
 
-    ISBNres = requests.get(f"{OPEN_LIB_URL}/api/books?bibkeys=ISBN:{ISBN}&format=json&jscmd=data")
+    more = page * SEARCH_PAGE_SIZE < results["total"] and page < MAX_SEARCH_PAGE
 
-    bookData = ISBNres.json()[f"ISBN:{ISBN}"]
-    book = transform_book_res(bookData)
-    print(f"Book Object: {book}")
+    return jsonify(books=results["books"], total=results["total"], next=page + 1 if more else None)
+
+@views.route("/books/<book_id>/transform", methods=["POST"])
+def show_book(book_id):
+    """Send a request to the OpenLibrary API using the bookID sent from the client, then transform response into BookTalk object. Pass this object to the rendered template."""
+
+    if not g.user:
+        flash("You must be signed in in order to view that page.", "text-danger")
+        return redirect("/")
+
+
+    # Books already in the catalog are served from it, without asking OpenLibrary
+    book = Book.find_data(ol_edition_key=book_id)
+
+    if not book:
+        # In order to get usable data, OpenLibrary requres two requests: the first to get the ISBN, which is then used for the second request which can be transformed into usable data. Both are cached by the client.
+        try:
+            edition = openlibrary.edition(book_id)
+            if edition is None:
+                abort(404)
+            ISBN = edition['isbn_13'][0]
+            book = Book.find_data(isbn13=ISBN)
+            bookData = openlibrary.book_by_isbn(ISBN) if ISBN and not book else None
+        except OpenLibraryError:
+            flash(f"We couldn't reach OpenLibrary just now. Please try again in a moment.", "text-danger")
+            return redirect("/books/search")
+        except (KeyError, IndexError):
+            flash(f"Our database doesn't include an ISBN number for the book you selected. Try choosing another.", "text-danger")
+            return redirect("/books/search")
+
+        if not book:
+            if not bookData:
+                flash(f"OpenLibrary doesn't have details for the book you selected. Try choosing another.", "text-danger")
+                return redirect("/books/search")
+
+            # Remember the edition that was asked for, so the next lookup for it is answered locally
+            book = {**transform_book_res(bookData), "ol_edition_key": book_id}
+
+        elif not book["ol_edition_key"]:
+            # Found in the catalog by ISBN alone; store the edition key too, for the same reason
+            Book.add_edition_key(book["isbn13"], book_id)
+            db.session.commit()
+            book["ol_edition_key"] = book_id
 
     session['book'] = book
     # pdb.set_trace()
 
     return redirect("/books/show")
 
-@app.route("/books/show")  
+@views.route("/books/show")  
 def display_book():
     """Receives book data from transform route, and then uses to render template"""
 
@@ -965,7 +1195,7 @@ def display_book():
 
     return render_template("/books/show.html")
 
-@app.route("/books/add", methods=["POST"])
+@views.route("/books/add", methods=["POST"])
 def add_book_to_db():
     """Takes book from session and adds it to BookTalk DB"""
 
@@ -976,18 +1206,131 @@ def add_book_to_db():
     book = session['book']
 
 
-    # Check that book is not already in DB
-    books = db.session.query(Book).all()
-    titles = [book.title for book in books]
-
-    if book['title'] not in titles:
-        new_book = Book(title=book['title'], author=book['author'], image=book['image'], num_pages=book['num_pages'], publish_date=book['publish_date'])
-        db.session.add(new_book)
-        db.session.commit()
+    # Adds the book unless one with the same normalized title and author is already in the DB
+    book_id, created = Book.get_or_create(book)
+    db.session.commit()
 
+    if created:
         flash(f"Added {book['title']} to BookTalk!", "text-light")
         return redirect("/books")
 
     else:
         flash(f"{book['title']} is already in BookTalk's Library.", "text-danger")
         return redirect("/books")
+
+# Most keys one bulk import request may contain
+MAX_IMPORT_KEYS = 500
+
+@views.route("/api/books/import", methods=["POST"])
+def import_books():
+    """Bulk add books to BookTalk's DB from a JSON list of OpenLibrary edition keys and/or ISBNs.
+
+    Body: {"keys": ["OL7353617M", "9780261102217", ...], "club_id": optional}. The keys are resolved with batched api/books requests and inserted in one transaction. If club_id is given and the user can manage that club, the books are also added to its shelf."""
+
+    if not g.user:
+        return jsonify(error="You must be signed in in order to import books."), 401
+
+    data = request.get_json(silent=True) or {}
+    keys = data.get("keys")
+    club_id = data.get("club_id")
+
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        return jsonify(error="Expected a JSON body with a list of keys."), 400
+    if len(keys) > MAX_IMPORT_KEYS:
+        return jsonify(error=f"Import at most {MAX_IMPORT_KEYS} keys at a time."), 400
+    if club_id is not None and (not isinstance(club_id, int) or isinstance(club_id, bool)):
+        return jsonify(error="Expected club_id to be a club's id."), 400
+    if club_id is not None and not club_role(club_id).can_manage:
+        return jsonify(error="You must be an admin or moderator of that club to add books to it."), 403
+
+    bibkeys = {key: to_bibkey(key) for key in keys}
+    invalid = [key for key, bibkey in bibkeys.items() if bibkey is None]
+
+    try:
+        found = openlibrary.books([bibkey for bibkey in bibkeys.values() if bibkey])
+    except OpenLibraryError:
+        return jsonify(error="We couldn't reach OpenLibrary just now. Please try again in a moment."), 502
+
+    records = {key: transform_book_res(found[bibkey]) for key, bibkey in bibkeys.items() if bibkey in found}
+    not_found = [key for key, bibkey in bibkeys.items() if bibkey and bibkey not in found]
+
+    results = Book.get_or_create_many(records.values())
+    books = {key: results[Book.make_key(book["title"], book["author"])] for key, book in records.items()}
+
+    if club_id is not None and books:
+        shelf = insert(Read).values([{"club_id": club_id, "book_id": book_id, "current": False, "complete": False} for book_id in {book_id for book_id, created in books.values()}])
+        db.session.execute(shelf.on_conflict_do_nothing(index_elements=[Read.club_id, Read.book_id]))
+        Club.bump_version(club_id)
+
+    db.session.commit()
+
+    return jsonify(
+        added=sum(1 for book_id, created in results.values() if created),
+        existing=sum(1 for book_id, created in results.values() if not created),
+        books={key: book_id for key, (book_id, created) in books.items()},
+        not_found=not_found,
+        invalid=invalid)
+
+
+########################################################################
+# Monitoring
+
+
+@views.route("/api/metrics/db")
+def db_metrics():
+    """Connection pool metrics for this worker, as JSON. Needs METRICS_TOKEN as a bearer token."""
+
+    token = current_app.config['METRICS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(404)
+
+    return jsonify(pool_metrics.snapshot(db.engine.pool))
+
+
+########################################################################
+# App factory
+
+
+def create_app(config=None):
+    """Build the app with one of the profiles in config.CONFIGS, or a config class. Defaults to $BOOKTALK_CONFIG, or dev."""
+
+    config = config or os.environ.get("BOOKTALK_CONFIG", "dev")
+
+    app = Flask(__name__)
+    app.config.from_object(CONFIGS[config] if isinstance(config, str) else config)
+
+    connect_db(app)
+    hasher.init_app(app)
+    openlibrary.init_app(app)
+    images.init_app(app)
+    assets.init_app(app)
+    query_counter.init_app(app)
+
+    # Only import the toolbar where it's used; it hooks every request
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    user_cache.maxsize, user_cache.ttl = app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL']
+    fragment_cache.maxsize, fragment_cache.ttl = app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL']
+
+    app.config['ETAG_SALT'] = app.config['ETAG_SALT'] or templates_version(app)
+
+    app.register_blueprint(views)
+    return app
+
+def warmup(app):
+    """Do the work a new worker would otherwise do during its first requests: compile every template, set up the ORM and URL map, and open some database connections"""
+
+    with app.app_context():
+        for name in app.jinja_env.list_templates(extensions=["html"]):
+            app.jinja_env.get_template(name)
+
+        configure_mappers()
+        app.url_map.update()
+
+        # Check out several connections at once so the pool keeps them all
+        connections = [db.engine.connect() for _ in range(app.config['WARMUP_CONNECTIONS'])]
+        for connection in connections:
+            connection.execute(db.text("SELECT 1"))
+            connection.close()
@@ -0,0 +1,181 @@
+"""Build fingerprinted, precompressed copies of BookTalk's static files."""
+
+# run it like:
+#
+#    python assets.py
+#
+# Every servable file in static/ is copied into static/dist/ under a name containing a hash of its content (css/styles.3f2a9c1b.css). Raster images are optimized on the way, and text files get .gz and .br copies alongside.
+# static/dist/manifest.json maps original names to built ones. Once it exists, url_for('static', filename=...) links to the built files, which never change and are served with immutable cache headers.
+# On Heroku this runs at slug build time from bin/post_compile.
+
+
+from hashlib import sha256
+from io import BytesIO
+import gzip
+import json
+import mimetypes
+import os
+import shutil
+import sys
+
+from flask import current_app, request, send_from_directory
+from PIL import Image
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+
+# Design files (.pptx, .pdf, .bmp...) stay out of the build; nothing links to them
+BUILD_EXTENSIONS = {".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp"}
+COMPRESS_EXTENSIONS = {".css", ".js", ".svg"}
+
+# Images are scaled down to fit in this many pixels a side; nothing on the site is shown wider than 400 CSS pixels, so this covers 2x screens
+MAX_IMAGE_SIZE = 800
+
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+########################################################################
+# Build
+
+
+def fingerprint(name, data):
+    """Return name with a hash of data before its extension"""
+
+    root, ext = os.path.splitext(name)
+    return f"{root}.{sha256(data).hexdigest()[:8]}{ext}"
+
+def optimize_image(name, data):
+    """Return a smaller encoding of a PNG or JPEG, or data unchanged if that doesn't help"""
+
+    ext = os.path.splitext(name)[1].lower()
+    if ext not in (".png", ".jpg", ".jpeg"):
+        return data
+
+    image = Image.open(BytesIO(data))
+    image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
+
+    out = BytesIO()
+    if ext == ".png":
+        image.save(out, "png", optimize=True)
+    else:
+        image.convert("RGB").save(out, "jpeg", quality=85, optimize=True, progressive=True)
+
+    return out.getvalue() if out.tell() < len(data) else data
+
+def build(static_folder, report=print):
+    """Rebuild static_folder/dist from static_folder and return the manifest"""
+
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    manifest = {}
+    before = after = 0
+
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and os.path.join(root, d) != dist)
+
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() not in BUILD_EXTENSIONS:
+                continue
+
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, static_folder).replace(os.sep, "/")
+
+            with open(path, "rb") as f:
+                data = f.read()
+            optimized = optimize_image(name, data)
+
+            built = fingerprint(name, optimized)
+            out = os.path.join(dist, built)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, "wb") as f:
+                f.write(optimized)
+
+            if os.path.splitext(file)[1].lower() in COMPRESS_EXTENSIONS:
+                with open(f"{out}.gz", "wb") as f:
+                    f.write(gzip.compress(optimized, compresslevel=9, mtime=0))
+                if brotli:
+                    with open(f"{out}.br", "wb") as f:
+                        f.write(brotli.compress(optimized, quality=11))
+
+            manifest[name] = built
+            before += len(data)
+            after += len(optimized)
+
+    with open(os.path.join(dist, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    report(f"Built {len(manifest)} assets: {before / 1e6:.1f}MB -> {after / 1e6:.1f}MB")
+    return manifest
+
+
+########################################################################
+# Serving
+
+
+class Assets:
+    """Points url_for('static', ...) at built assets and serves them precompressed with immutable cache headers.
+
+    Files without a built copy (or every file, before the first build) are served by Flask as usual."""
+
+    def __init__(self, app=None):
+        self.static_folder = None
+        self.manifest = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(app.static_folder)
+
+        app.url_defaults(self.fingerprint_url)
+        app.view_functions["static"] = self.send_static
+
+    def configure(self, static_folder):
+        self.static_folder = static_folder
+
+        try:
+            with open(os.path.join(static_folder, DIST, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def url(self, filename):
+        """URL path of a static file, fingerprinted if it has been built"""
+
+        if filename in self.manifest:
+            return f"/static/{DIST}/{self.manifest[filename]}"
+        return f"/static/{filename}"
+
+    def fingerprint_url(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.manifest:
+            values["filename"] = f"{DIST}/{self.manifest[values['filename']]}"
+
+    def send_static(self, filename):
+        if not filename.startswith(f"{DIST}/"):
+            return current_app.send_static_file(filename)
+
+        # Send the smallest precompressed copy the browser accepts
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(self.static_folder, filename + suffix)):
+                resp = send_from_directory(self.static_folder, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+                resp.headers["Content-Encoding"] = encoding
+                break
+        else:
+            resp = send_from_directory(self.static_folder, filename)
+
+        resp.headers["Cache-Control"] = ASSET_CACHE_CONTROL
+        resp.headers["Vary"] = "Accept-Encoding"
+        return resp
+
+
+assets = Assets()
+
+
+if __name__ == "__main__":
+    build(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
@@ -0,0 +1,457 @@
+"""Benchmarks for BookTalk's hot paths."""
+
+# run these like:
+#
+#    python benchmarks.py passwords
+#    python benchmarks.py search --rows 1000000
+#    python benchmarks.py routes --scale 0.1 --save-baseline
+#
+# Benchmarks that need a database drop and recreate every table in BENCH_DATABASE_URL (postgresql:///booktalk_bench by default).
+
+
+import argparse
+import inspect
+import os
+import random
+import statistics
+import sys
+import time
+
+from passwords import PasswordHasher
+from dataset import WORDS, VOCABULARY, random_title
+
+
+def bench_passwords(costs=(4, 8, 10, 12), logins=20, pool_sizes=(0, 2, 4)):
+    """Report logins/sec (one bcrypt check each) at each cost factor and pool size"""
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    print(f"{'cost':>4} {'pool':>4} {'logins/sec':>12}")
+
+    for cost in costs:
+        for pool_size in pool_sizes:
+            hasher = PasswordHasher()
+            hasher.configure(rounds=cost, pool_size=pool_size, queue_size=max(pool_size, 1) * 4)
+            pwd_hash = hasher.hash("password")
+
+            # Warm the pool so process start up isn't counted
+            hasher.check(pwd_hash, "password")
+
+            # Simulate concurrent request threads all logging in at once
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=8) as threads:
+                list(threads.map(lambda _: hasher.check(pwd_hash, "password"), range(logins)))
+            elapsed = time.perf_counter() - start
+
+            hasher.shutdown()
+            print(f"{cost:>4} {pool_size:>4} {logins / elapsed:>12.1f}")
+
+
+def bench_db(fresh=True):
+    """Point the app at a scratch database and create empty tables in it, or keep what's there if not fresh"""
+
+    from app import create_app
+    from models import db
+
+    app = create_app("prod")
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///booktalk_bench')
+
+    if fresh:
+        db.drop_all()
+        db.create_all()
+
+    return app, db
+
+
+def bench_membership(sizes=(10, 100, 1000, 10000), checks=200):
+    """Compare `user in club.users` with Club.has_member as clubs grow"""
+
+    app, db = bench_db()
+    from models import User, Club, Membership
+
+    print(f"{'members':>8} {'in club.users (ms)':>20} {'has_member (ms)':>16}")
+
+    for size in sizes:
+        club = Club(name=f"Club {size}")
+        db.session.add(club)
+        db.session.commit()
+
+        first_id = db.session.query(db.func.coalesce(db.func.max(User.id), 0)).scalar() + 1
+        db.session.bulk_insert_mappings(User, [
+            {"id": first_id + i, "username": f"u{size}_{i}", "password": "x", "email": "x", "first_name": "x", "last_name": "x"}
+            for i in range(size)])
+        db.session.bulk_insert_mappings(Membership, [
+            {"user_id": first_id + i, "club_id": club.id} for i in range(size)])
+        db.session.commit()
+
+        # Check for the last member, the worst case for a list scan
+        user = User.query.get(first_id + size - 1)
+        club_id = club.id
+
+        start = time.perf_counter()
+        for _ in range(checks):
+            db.session.expire_all()
+            assert user in Club.query.get(club_id).users
+        scan = (time.perf_counter() - start) / checks * 1000
+
+        start = time.perf_counter()
+        for _ in range(checks):
+            db.session.expire_all()
+            assert Club.query.get(club_id).has_member(user.id)
+        exists = (time.perf_counter() - start) / checks * 1000
+
+        print(f"{size:>8} {scan:>20.2f} {exists:>16.2f}")
+
+
+def bench_search(rows=1000000, queries=200):
+    """Time local full text searches against a catalog of `rows` books"""
+
+    app, db = bench_db()
+    from models import Book
+    from search import search_books
+
+    random.seed(0)
+    authors = [f"{random.choice(WORDS).title()} {random.choice(WORDS).title()}" for _ in range(5000)]
+
+    start = time.perf_counter()
+    for chunk in range(0, rows, 10000):
+        mappings = []
+        for i in range(chunk, min(chunk + 10000, rows)):
+            title = f"{random_title()} {i}"
+            author = random.choice(authors)
+            mappings.append({"title": title, "author": author, "publish_date": "2021", "norm_key": Book.make_key(title, author)})
+        db.session.execute(Book.__table__.insert(), mappings)
+        db.session.commit()
+    db.session.execute(db.text("ANALYZE books"))
+    db.session.commit()
+    print(f"Loaded {rows} books in {time.perf_counter() - start:.1f}s")
+
+    # From very broad (a top-20 word matches ~9% of the catalog) to a specific title
+    searches = ["dragon", "kin", "silent pat", authors[0], VOCABULARY[400], f"{VOCABULARY[300][:4]} {VOCABULARY[900]}", "wolf crown 12"]
+
+    print(f"{'search':>20} {'p50 (ms)':>10} {'p95 (ms)':>10} {'hits':>6}")
+    for search in searches:
+        timings = []
+        for _ in range(queries // len(searches)):
+            start = time.perf_counter()
+            page = search_books(search)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"{search:>20} {statistics.median(timings):>10.2f} {timings[int(len(timings) * 0.95)]:>10.2f} {len(page):>6}")
+
+
+def bench_openlibrary(lookups=200, delay=0.05):
+    """Time show_book's two OpenLibrary lookups against the local stub, cold and then cached"""
+
+    from openlibrary import OpenLibraryClient
+    from openlibrary_stub import StubServer, SAMPLE_BOOKS
+
+    with StubServer(delay=delay) as stub:
+        client = OpenLibraryClient()
+        client.configure(base_url=stub.url)
+
+        for label in ("cold", "cached"):
+            start = time.perf_counter()
+            for i in range(lookups):
+                edition_id = list(SAMPLE_BOOKS)[i % len(SAMPLE_BOOKS)]
+                client.book_by_isbn(client.edition(edition_id)["isbn_13"][0])
+                if label == "cold":
+                    client.cache.clear()
+            elapsed = time.perf_counter() - start
+
+            print(f"{label:>7}: {lookups / elapsed:8.1f} lookups/sec, {stub.hits} upstream requests so far")
+
+
+def startup_child(profile, warm, requests):
+    """Runs in a fresh interpreter: time building the app, its first request, and the requests after that"""
+
+    start = time.perf_counter()
+    from app import create_app, warmup, CURR_USER_KEY
+    from models import db, User
+
+    # The dev profile logs SQL to stdout; still pay for writing it, just not to the screen
+    sys.stdout = open(os.devnull, "w")
+
+    app = create_app(profile)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('BENCH_DATABASE_URL', 'postgresql:///booktalk_bench')
+    if warm:
+        warmup(app)
+    ready = time.perf_counter() - start
+
+    with app.app_context():
+        user_id = db.session.query(db.func.min(User.id)).scalar()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    start = time.perf_counter()
+    client.get(f"/users/{user_id}")
+    first = time.perf_counter() - start
+
+    timings = []
+    for i in range(requests):
+        start = time.perf_counter()
+        client.get("/users" if i % 2 else f"/users/{user_id}")
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+
+    return ready * 1000, first * 1000, statistics.median(timings), timings[int(len(timings) * 0.95)]
+
+
+def bench_startup(requests=300, runs=5):
+    """Compare worker start up and per-request time for each config profile, with and without warmup"""
+
+    import multiprocessing
+
+    app, db = bench_db()
+    from models import User
+    db.session.add_all([User(username=f"u{i}", password="x", email="x", first_name="x", last_name="x") for i in range(50)])
+    db.session.commit()
+
+    # Each run gets a new interpreter, so imports and connections start cold like a new gunicorn worker
+    spawn = multiprocessing.get_context("spawn")
+
+    print(f"{'profile':>8} {'warmup':>6} {'ready (ms)':>11} {'first (ms)':>11} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for profile, warm in (("dev", False), ("prod", False), ("prod", True)):
+        results = []
+        for _ in range(runs):
+            with spawn.Pool(1) as pool:
+                results.append(pool.apply(startup_child, (profile, warm, requests)))
+
+        ready, first, p50, p95 = (statistics.median(column) for column in zip(*results))
+        print(f"{profile:>8} {str(warm):>6} {ready:>11.0f} {first:>11.1f} {p50:>9.2f} {p95:>9.2f}")
+
+
+ROUTE_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+
+# A route is reported as a regression when its p50 grows by this fraction (and at least a millisecond), or it runs more queries
+SLOWER_BY = 0.25
+
+def route_steps(token):
+    """Every route in app.py as (name, method, path, body) steps. Paths and bodies are functions of the fixture ids and iteration.
+
+    Steps run in order each iteration, and what one creates a later one deletes where there is a route for it (books added to the shelf stay). token keeps names created by this run unique."""
+
+    from openlibrary_stub import SAMPLE_BOOKS
+
+    edit_user = lambda f, i: {"username": f["username"], "password": f["password"], "email": "bench@example.com", "image": "/static/images/placeholder.png", "first_name": "Bench", "last_name": "Mark", "bio": "benchmarking"}
+
+    return [
+        ("GET /", "get", "/", None),
+        ("GET /users", "get", "/users", None),
+        ("GET /users/<id>", "get", "/users/{user}", None),
+        ("GET /users/<id>/edit", "get", "/users/{user}/edit", None),
+        ("POST /users/<id>/edit", "post", "/users/{user}/edit", edit_user),
+        ("GET /clubs", "get", "/clubs", None),
+        ("GET /clubs/<id> (member)", "get", "/clubs/{club}", None),
+        ("GET /clubs/<id> (visitor)", "get", "/clubs/{other_club}", None),
+        ("GET /clubs/create", "get", "/clubs/create", None),
+        ("POST /clubs/create", "post", "/clubs/create", lambda f, i: {"name": f"B{token}-{i}"}),
+        ("POST /clubs/<id>/delete", "post", "/clubs/{new_club}/delete", None),
+        ("POST /clubs/<id>/join", "post", "/clubs/{other_club}/join", None),
+        ("POST /clubs/<id>/leave", "post", "/clubs/{other_club}/leave", None),
+        ("POST /clubs/<id>/<id>/toggle_moderator", "post", "/clubs/{club}/{member}/toggle_moderator", None),
+        ("POST /clubs/<id>/<id>/toggle_moderator", "post", "/clubs/{club}/{member}/toggle_moderator", None),
+        ("POST /clubs/<id>/<id>/make_admin", "post", "/clubs/{club}/{user}/make_admin", None),
+        ("POST /clubs/<id>/<id>/toggle_current", "post", "/clubs/{club}/{shelf_book}/toggle_current", None),
+        ("POST /clubs/<id>/<id>/toggle_current", "post", "/clubs/{club}/{shelf_book}/toggle_current", None),
+        ("POST /clubs/<id>/<id>/toggle_complete", "post", "/clubs/{club}/{shelf_book}/toggle_complete", None),
+        ("POST /clubs/<id>/<id>/toggle_complete", "post", "/clubs/{club}/{shelf_book}/toggle_complete", None),
+        ("GET /clubs/<id>/library", "get", "/clubs/{club}/library", None),
+        ("POST /clubs/<id>/<id>/add", "post", "/clubs/{club}/{unshelved_book}/add", None),
+        ("GET /clubs/<id>/meetings/<id>", "get", "/clubs/{club}/meetings/{meeting}", None),
+        ("GET /clubs/<id>/meetings/new", "get", "/clubs/{club}/meetings/new", None),
+        ("POST /clubs/<id>/meetings/new", "post", "/clubs/{club}/meetings/new", lambda f, i: {"starts_at": "2031-01-01 19:00", "topic": f["shelf_title"], "url": ""}),
+        ("GET /meetings/<id>/notes/add", "get", "/meetings/{meeting}/notes/add", None),
+        ("POST /meetings/<id>/notes/add", "post", "/meetings/{meeting}/notes/add", lambda f, i: {"book": f["shelf_title"], "text": "Benchmark note"}),
+        ("GET /meetings/<id>/notes/<id>/edit", "get", "/meetings/{meeting}/notes/{new_note}/edit", None),
+        ("POST /meetings/<id>/notes/<id>/edit", "post", "/meetings/{meeting}/notes/{new_note}/edit", lambda f, i: {"text": "Edited note"}),
+        ("POST /meetings/<id>/notes/<id>/delete", "post", "/meetings/{meeting}/notes/{new_note}/delete", None),
+        ("POST /meetings/<id>/delete", "post", "/meetings/{new_meeting}/delete", None),
+        ("GET /api/meetings/upcoming", "get", "/api/meetings/upcoming?limit=20", None),
+        ("GET /books", "get", "/books", None),
+        ("GET /books/my_books", "get", "/books/my_books", None),
+        ("GET /books/<id>", "get", "/books/{book}", None),
+        ("POST /books/<id>/favorite", "post", "/books/{unfavorite_book}/favorite", None),
+        ("POST /books/<id>/remove_favorite", "post", "/books/{unfavorite_book}/remove_favorite", None),
+        ("GET /books/search", "get", "/books/search", None),
+        ("GET /books/search/local", "get", "/books/search/local?q=dragon", None),
+        ("GET /api/books/search", "get", "/api/books/search?q=hobbit", None),
+        ("POST /books/<id>/transform", "post", "/books/OL7353617M/transform", None),
+        ("GET /books/show", "get", "/books/show", None),
+        ("POST /books/add", "post", "/books/add", None),
+        ("POST /api/books/import", "post", "/api/books/import", lambda f, i: {"keys": list(SAMPLE_BOOKS), "club_id": f["club"]}),
+        ("GET /images/proxy", "get", "{image_proxy}", None),
+        ("GET /images/<filename>", "get", "/images/{image_file}", None),
+        ("GET /api/metrics/db", "get", "/api/metrics/db", None),
+        ("GET /logout", "get", "/logout", None),
+        ("GET /login", "get", "/login", None),
+        ("GET /register", "get", "/register", None),
+        ("POST /register", "post", "/register", lambda f, i: {"username": f"r{token}-{i}", "password": "password", "email": "new@example.com", "image": "", "first_name": "New", "last_name": "User", "bio": "new"}),
+        ("POST /users/<id>/delete", "post", "/users/{new_user}/delete", None),
+        ("POST /login", "post", "/login", lambda f, i: {"username": f["username"], "password": f["password"]}),
+    ]
+
+def route_fixtures(stub_url, token, i):
+    """Ids the route steps visit: the admin of the biggest club, its busiest meeting, the most favorited book... so every page is at its heaviest.
+
+    Ids of things earlier steps created (new_club, new_note...) are looked up as they're needed."""
+
+    from urllib.parse import urlencode
+    from dataset import PASSWORD
+    from images import images
+    from models import db, User, Club, Book, Membership, Read, Meeting, Note, Favorite
+
+    club = db.session.query(Membership.club_id).group_by(Membership.club_id).order_by(db.func.count().desc()).limit(1).scalar()
+    user = db.session.query(Membership.user_id).filter(Membership.club_id == club, Membership.admin == True).order_by(Membership.user_id).limit(1).scalar()
+    shelf_book, shelf_title = (db.session.query(Book.id, Book.title).join(Read, Read.book_id == Book.id)
+                               .filter(Read.club_id == club).order_by(Book.id).first())
+    cover = f"{stub_url}/b/id/6979861-M.jpg"
+    latest = lambda column, *criteria: lambda: db.session.query(db.func.max(column)).filter(*criteria).scalar()
+
+    return {
+        "user": user,
+        "username": db.session.query(User.username).filter(User.id == user).scalar(),
+        "password": PASSWORD,
+        "club": club,
+        "other_club": db.session.query(Club.id).filter(~Club.memberships.any(Membership.user_id == user)).order_by(Club.id).limit(1).scalar(),
+        "member": db.session.query(Membership.user_id).filter(Membership.club_id == club, Membership.user_id != user).order_by(Membership.user_id).limit(1).scalar(),
+        "shelf_book": shelf_book,
+        "shelf_title": shelf_title,
+        "unshelved_book": db.session.query(Book.id).filter(~Book.reads.any(Read.club_id == club)).order_by(Book.id.desc()).limit(1).scalar(),
+        "meeting": db.session.query(Note.meeting_id).filter(Note.meeting_id.in_(db.session.query(Meeting.id).filter(Meeting.club_id == club)))
+                   .group_by(Note.meeting_id).order_by(db.func.count().desc()).limit(1).scalar(),
+        "book": db.session.query(Favorite.book_id).group_by(Favorite.book_id).order_by(db.func.count().desc()).limit(1).scalar(),
+        "unfavorite_book": db.session.query(Book.id).filter(~Book.id.in_(db.session.query(Favorite.book_id).filter(Favorite.user_id == user))).order_by(Book.id).limit(1).scalar(),
+        "image_proxy": f"/images/proxy?{urlencode({'url': cover, 'size': 180, 'sig': images.sign(cover, 180)})}",
+        "image_file": lambda: images.filename(images.lookup(cover), 180),
+        "new_club": lambda: db.session.query(Club.id).filter(Club.name == f"B{token}-{i}").scalar(),
+        "new_note": latest(Note.id, Note.user_id == user),
+        "new_meeting": latest(Meeting.id, Meeting.club_id == club),
+        "new_user": lambda: db.session.query(User.id).filter(User.username == f"r{token}-{i}").scalar(),
+    }
+
+
+def bench_routes(scale=0.1, iterations=20, save_baseline=False, reuse=False):
+    """Drive every route through the test client on a synthetic dataset, and report p50/p95 latency and query counts against the stored baseline"""
+
+    import json
+    import tempfile
+
+    from app import CURR_USER_KEY
+    from dataset import generate
+    from images import images
+    from openlibrary import openlibrary
+    from openlibrary_stub import StubServer
+    from queries import record_queries
+
+    app, db = bench_db(fresh=not reuse)
+    if not reuse:
+        generate(scale)
+
+    # Forms are posted without CSRF tokens, and the token for the metrics endpoint is made up
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['METRICS_TOKEN'] = "bench"
+    token = int(time.time()) % 1000000
+
+    timings, queries = {}, {}
+
+    with StubServer() as stub, tempfile.TemporaryDirectory() as image_dir, app.app_context():
+        openlibrary.configure(base_url=stub.url)
+        images.configure(image_dir, app.config['SECRET_KEY'], allow_private=True)
+
+        client = app.test_client()
+        fixtures = route_fixtures(stub.url, token, 0)
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = fixtures["user"]
+
+        # The first iteration fills caches and isn't counted
+        for i in range(iterations + 1):
+            fixtures = route_fixtures(stub.url, token, i)
+
+            for name, method, path, body in route_steps(token):
+                values = {key: value() if callable(value) else value for key, value in fixtures.items() if "{" + key + "}" in path}
+                url = path.format(**values)
+                data = body(fixtures, i) if body else None
+                kwargs = {"json": data} if url.startswith("/api/") else {"data": data}
+
+                start = time.perf_counter()
+                with record_queries() as stats:
+                    resp = getattr(client, method)(url, headers={"Authorization": "Bearer bench"}, **kwargs)
+                elapsed = (time.perf_counter() - start) * 1000
+
+                if resp.status_code >= 400:
+                    raise RuntimeError(f"{name} ({url}) answered {resp.status_code}")
+
+                if i:
+                    timings.setdefault(name, []).append(elapsed)
+                    queries.setdefault(name, []).append(stats.count)
+
+    results = {}
+    for name, times in timings.items():
+        times.sort()
+        results[name] = {
+            "p50": round(statistics.median(times), 2),
+            "p95": round(times[int(len(times) * 0.95)], 2),
+            "queries": statistics.median(queries[name])}
+
+    try:
+        with open(ROUTE_BASELINE) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {"scale": None, "routes": {}}
+
+    if baseline["scale"] not in (None, scale):
+        print(f"Baseline was recorded at scale {baseline['scale']}, not {scale}; comparisons are rough")
+
+    regressions = []
+    print(f"{'route':<45} {'p50 (ms)':>9} {'p95 (ms)':>9} {'queries':>8} {'base p50':>9} {'base q':>7}")
+    for name, result in results.items():
+        base = baseline["routes"].get(name)
+        flags = ""
+        if base:
+            if result["p50"] > base["p50"] * (1 + SLOWER_BY) and result["p50"] - base["p50"] > 1:
+                flags += " SLOWER"
+            if result["queries"] > base["queries"]:
+                flags += " MORE QUERIES"
+        if flags:
+            regressions.append(name)
+
+        print(f"{name:<45} {result['p50']:>9.2f} {result['p95']:>9.2f} {result['queries']:>8g} "
+              f"{base['p50'] if base else '-':>9} {base['queries'] if base else '-':>7}{flags}")
+
+    if save_baseline:
+        with open(ROUTE_BASELINE, "w") as f:
+            json.dump({"scale": scale, "iterations": iterations, "routes": results}, f, indent=2)
+        print(f"Saved baseline to {ROUTE_BASELINE}")
+
+    return regressions
+
+
+BENCHMARKS = {
+    "passwords": bench_passwords,
+    "membership": bench_membership,
+    "search": bench_search,
+    "openlibrary": bench_openlibrary,
+    "startup": bench_startup,
+    "routes": bench_routes,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--rows", type=int, help="dataset size, for benchmarks that build one")
+    parser.add_argument("--scale", type=float, help="dataset.py scale, for benchmarks that generate one")
+    parser.add_argument("--iterations", type=int, help="times to repeat each step, for benchmarks that take it")
+    parser.add_argument("--reuse", action="store_true", help="run on the dataset already in the bench database instead of generating one")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline later runs are compared against")
+    args = parser.parse_args()
+
+    benchmark = BENCHMARKS[args.benchmark]
+    parameters = inspect.signature(benchmark).parameters
+    kwargs = {name: value for name, value in vars(args).items() if name in parameters and value not in (None, False)}
+
+    # Benchmarks that compare against a baseline return the names of whatever regressed
+    if benchmark(**kwargs):
+        sys.exit(1)
@@ -0,0 +1,111 @@
+"""Configuration profiles for create_app()."""
+
+# Pick one with BOOKTALK_CONFIG=dev|test|prod (dev if unset). Anything here can be overridden from the environment where noted.
+
+import os
+
+
+class Config:
+    """Settings shared by every profile"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///booktalk')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # Connection pool, per worker (see dbpool.py). Recycle connections before Postgres or a load balancer drops them, and ping them on checkout so a failover doesn't hand requests dead connections.
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 4))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 30 * 60))
+    DB_POOL_PRE_PING = True
+
+    # Milliseconds any one statement may run; 0 for no limit
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 15000))
+
+    # Set when DATABASE_URL points at PgBouncer in transaction pooling mode, which can't keep session state
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '').lower() in ('1', 'true', 'yes')
+
+    # Bearer token for /api/metrics/db; the endpoint is off unless set
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', '1c47bdd72341acb7c0c9b991ef6db584c53cee37e8fc19c38688b3f0fb8e29bc')
+
+    # Reported per request by queries.QueryCounter when on
+    QUERY_STATS = False
+    QUERY_N_PLUS_ONE_THRESHOLD = int(os.environ.get('QUERY_N_PLUS_ONE_THRESHOLD', 5))
+
+    # The debug toolbar is only loaded by profiles that turn it on
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # Logged in users are cached per worker so g.user doesn't cost a query on every request
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+
+    # Rendered template fragments, per worker. Keys include a version that mutations bump, so the TTL only bounds memory.
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 2048))
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 600))
+
+    # Part of every page's ETag; computed from the templates if not set. Set it to roll every cached page on a deploy that changes nothing on disk.
+    ETAG_SALT = os.environ.get('ETAG_SALT')
+
+    # Database connections a worker opens up front in warmup(), so its first requests don't pay for connecting
+    WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 2))
+
+    # bcrypt cost for new password hashes, and the processes per worker that run bcrypt off the request thread (see passwords.py). A pool size of 0 runs it inline.
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_POOL_SIZE = int(os.environ.get('PASSWORD_POOL_SIZE', 2))
+    PASSWORD_POOL_QUEUE = int(os.environ.get('PASSWORD_POOL_QUEUE', PASSWORD_POOL_SIZE * 4))
+
+    # OpenLibrary client (see openlibrary.py). Point OPEN_LIB_URL at openlibrary_stub.py to work offline, and set OPENLIBRARY_CACHE_DIR to share cached responses between workers and restarts.
+    OPEN_LIB_URL = os.environ.get('OPEN_LIB_URL', 'https://openlibrary.org')
+    OPENLIBRARY_CONNECT_TIMEOUT = 2
+    OPENLIBRARY_READ_TIMEOUT = 5
+    OPENLIBRARY_RETRIES = 2
+    OPENLIBRARY_CACHE_SIZE = 2048
+    OPENLIBRARY_CACHE_TTL = 24 * 60 * 60
+    OPENLIBRARY_CACHE_DIR = os.environ.get('OPENLIBRARY_CACHE_DIR')
+    OPENLIBRARY_SEARCH_CACHE_SIZE = 1024
+    OPENLIBRARY_SEARCH_CACHE_TTL = 60 * 60
+
+    # Resized cover and avatar images (see images.py), kept in instance/images unless IMAGE_CACHE_DIR is set
+    IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR')
+    IMAGE_FETCH_TIMEOUT = (2, 5)
+    IMAGE_ALLOW_PRIVATE_HOSTS = False
+
+
+class DevConfig(Config):
+    """Local development: log SQL and show the debug toolbar"""
+
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+
+    DB_POOL_SIZE = 2
+    DB_MAX_OVERFLOW = 2
+
+    # Query count and DB time in response headers and the log, with warnings about N+1 queries
+    QUERY_STATS = True
+
+
+class TestConfig(Config):
+    """Unit tests, against their own database"""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'postgresql:///booktalk_test')
+    WTF_CSRF_ENABLED = False
+
+    # The test database is local and never fails over
+    DB_POOL_PRE_PING = False
+
+    # bcrypt's lowest cost, so creating test users doesn't dominate the run
+    BCRYPT_LOG_ROUNDS = 4
+
+
+class ProdConfig(Config):
+    """Heroku"""
+
+    # Templates never change while a worker runs, so don't stat them on every render
+    TEMPLATES_AUTO_RELOAD = False
+
+
+CONFIGS = {"dev": DevConfig, "test": TestConfig, "prod": ProdConfig}
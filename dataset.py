@@ -0,0 +1,184 @@
+"""Generate a large synthetic BookTalk dataset for benchmarking."""
+
+# run it like:
+#
+#    python dataset.py                      # 100k users, 10k clubs, 1M reads and notes
+#    python dataset.py --scale 0.1          # a tenth of that
+#
+# Everything in BENCH_DATABASE_URL (postgresql:///booktalk_bench by default) is dropped first.
+#
+# Sizes are skewed the way real usage is: club sizes, shelves and meetings follow a Zipf-like curve (a few huge clubs, a long tail of small ones), and the same few books turn up on most shelves and favorites lists. Rows are written with COPY, and every user shares one precomputed bcrypt hash, so generation is bound by Postgres rather than Python or bcrypt.
+
+
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import argparse
+import csv
+import io
+import random
+import time
+
+from models import db, Book
+from importer import batches
+from passwords import hasher
+
+# Every generated user logs in with this
+PASSWORD = "password"
+
+# Row counts at scale 1
+SIZES = {
+    "users": 100000,
+    "clubs": 10000,
+    "books": 200000,
+    "memberships": 300000,
+    "reads": 1000000,
+    "meetings": 50000,
+    "notes": 1000000,
+    "favorites": 200000,
+}
+
+COPY_CHUNK = 50000
+
+# Meetings are spread over this many years around the time the data is generated
+MEETING_SPAN = timedelta(days=10 * 365)
+
+WORDS = ("shadow night river king queen stone fire winter garden house secret city ocean "
+         "dragon silent patient meaning radiance hobbit fellowship empire glass road storm "
+         "memory letter island wolf crown mirror forest summer daughter song").split()
+
+# Pad the vocabulary with made up words and pick them with a Zipf-like skew, so a few words are very common and most are rare, like real titles
+SYLLABLES = "ka lo mir an del ros ith ven tor sa bel quin dra mor lu".split()
+VOCABULARY = WORDS + sorted({"".join(random.Random(i).choices(SYLLABLES, k=3)) for i in range(5000)})
+WEIGHTS = [1 / rank for rank in range(1, len(VOCABULARY) + 1)]
+CUM_WEIGHTS = list(accumulate(WEIGHTS))
+
+def random_title(rng=random):
+    return " ".join(rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=rng.randint(2, 5))).title()
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights that make item 0 the most likely of n, falling off as 1 / rank ** skew"""
+
+    return list(accumulate(1 / rank ** skew for rank in range(1, n + 1)))
+
+
+def copy_rows(table, columns, rows):
+    """COPY an iterable of row tuples into table, COPY_CHUNK rows at a time. Return how many were written."""
+
+    connection = db.session.connection()
+    # Loading a big table can outlast the app's statement timeout
+    connection.exec_driver_sql("SET LOCAL statement_timeout = 0")
+    cursor = connection.connection.cursor()
+
+    written = 0
+    for chunk in batches(rows, COPY_CHUNK):
+        data = io.StringIO()
+        csv.writer(data).writerows(chunk)
+        data.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", data)
+        written += len(chunk)
+
+    db.session.commit()
+    return written
+
+
+def generate(scale=1.0, seed=0, report=print):
+    """Fill empty tables with a synthetic dataset scale times the size of SIZES. Return the row count of each table."""
+
+    rng = random.Random(seed)
+    sizes = {table: max(int(size * scale), 1) for table, size in SIZES.items()}
+    counts = {}
+    start = time.perf_counter()
+
+    def load(table, columns, rows):
+        counts[table] = copy_rows(table, columns, rows)
+        report(f"{table}: {counts[table]} rows ({time.perf_counter() - start:.0f}s)")
+
+    user_ids = range(1, sizes["users"] + 1)
+    club_ids = range(1, sizes["clubs"] + 1)
+    book_ids = range(1, sizes["books"] + 1)
+
+    pwd_hash = hasher.hash(PASSWORD)
+    load("users", ["id", "username", "password", "email", "first_name", "last_name", "bio"],
+         ((i, f"user{i}", pwd_hash, f"user{i}@example.com", rng.choice(WORDS).title(), rng.choice(WORDS).title(), random_title(rng))
+          for i in user_ids))
+
+    load("clubs", ["id", "name"], ((i, f"{rng.choice(WORDS).title()} {i}") for i in club_ids))
+
+    authors = [f"{rng.choice(WORDS).title()} {rng.choice(VOCABULARY).title()}" for _ in range(max(sizes["books"] // 20, 1))]
+    def book_rows():
+        for i in book_ids:
+            title, author = f"{random_title(rng)} {i}", rng.choice(authors)
+            yield i, title, author, rng.choice(["1937", "1954", "1965", "1990", "2004", "2019"]), rng.randint(80, 1200), Book.make_key(title, author)
+    load("books", ["id", "title", "author", "publish_date", "num_pages", "norm_key"], book_rows())
+
+    # Club sizes fall off steeply, so the first few clubs have thousands of members. Every club has at least its admin.
+    club_weights = zipf_weights(len(club_ids), 1.1)
+    user_weights = zipf_weights(len(user_ids), 0.5)
+    book_weights = zipf_weights(len(book_ids), 1.0)
+
+    members = {club_id: {rng.choice(user_ids): True} for club_id in club_ids}
+    for club_id, user_id in zip(rng.choices(club_ids, cum_weights=club_weights, k=sizes["memberships"]),
+                                rng.choices(user_ids, cum_weights=user_weights, k=sizes["memberships"])):
+        members[club_id].setdefault(user_id, False)
+    members = {club_id: list(users.items()) for club_id, users in members.items()}
+
+    load("memberships", ["user_id", "club_id", "join_date", "admin", "moderator"],
+         ((user_id, club_id, "2021-09-01", admin, not admin and rng.random() < 0.02)
+          for club_id, users in members.items() for user_id, admin in users))
+
+    # Big clubs have long shelves, and popular books are on most of them
+    shelves = {}
+    for club_id, book_id in zip(rng.choices(club_ids, cum_weights=zipf_weights(len(club_ids), 0.8), k=sizes["reads"]),
+                                rng.choices(book_ids, cum_weights=book_weights, k=sizes["reads"])):
+        shelves.setdefault(club_id, {})[book_id] = None
+    shelves = {club_id: list(books) for club_id, books in shelves.items()}
+
+    def read_rows():
+        for club_id, books in shelves.items():
+            for n, book_id in enumerate(books):
+                yield club_id, book_id, n < 2, n >= 2 and rng.random() < 0.4
+    load("reads", ["club_id", "book_id", "current", "complete"], read_rows())
+
+    # Meetings and notes only happen in clubs that have books
+    active_clubs = list(shelves)
+    meeting_clubs = rng.choices(active_clubs, cum_weights=zipf_weights(len(active_clubs), 1.0), k=sizes["meetings"])
+    # Half of each club's meetings are in the past, half still to come
+    first_meeting = datetime.now(timezone.utc) - MEETING_SPAN / 2
+    load("meetings", ["id", "starts_at", "topic", "url", "club_id"],
+         ((i, (first_meeting + rng.random() * MEETING_SPAN).replace(minute=0, second=0, microsecond=0).isoformat(), random_title(rng), "https://meet.example.com", club_id)
+          for i, club_id in enumerate(meeting_clubs, 1)))
+
+    def note_rows():
+        meetings = rng.choices(range(len(meeting_clubs)), cum_weights=zipf_weights(len(meeting_clubs), 0.7), k=sizes["notes"])
+        for i, meeting in enumerate(meetings, 1):
+            club_id = meeting_clubs[meeting]
+            yield i, random_title(rng), rng.choice(members[club_id])[0], rng.choice(shelves[club_id]), meeting + 1
+    load("notes", ["id", "text", "user_id", "book_id", "meeting_id"], note_rows())
+
+    favorites = set(zip(rng.choices(user_ids, cum_weights=user_weights, k=sizes["favorites"]),
+                        rng.choices(book_ids, cum_weights=book_weights, k=sizes["favorites"])))
+    load("favorites", ["user_id", "book_id"], sorted(favorites))
+
+    # Rows were given explicit ids, so move the sequences past them
+    for table in ("users", "clubs", "books", "meetings", "notes"):
+        db.session.execute(db.text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+    db.session.commit()
+
+    with db.engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM ANALYZE")
+    report(f"Done in {time.perf_counter() - start:.0f}s")
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every table's size by this")
+    parser.add_argument("--seed", type=int, default=0, help="random seed; the same seed and scale make the same data (give or take meeting times, which are spread around today)")
+    args = parser.parse_args()
+
+    from benchmarks import bench_db
+
+    bench_db()
+    generate(args.scale, args.seed)
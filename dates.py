@@ -0,0 +1,83 @@
+"""Reading and showing meeting times."""
+
+# Meeting times are stored as timezone-aware timestamps. Users type them in whatever format they like, so parse_datetime() accepts most of the ways people write a date and time; it also reads the free-form strings meetings were saved with before they had a typed column.
+#
+# There's no per-user timezone yet, so times without an offset are taken to be UTC, and shown in UTC.
+
+from datetime import datetime, timezone
+import re
+
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%b %d %Y", "%d %b %Y", "%B %d %Y", "%d %B %Y", "%m/%d", "%b %d", "%B %d"]
+TIME_FORMATS = ["", "%H:%M", "%H:%M:%S", "%I:%M %p", "%I %p"]
+
+# Words that only decorate a date: weekdays, "at", "on", and UTC itself
+NOISE = re.compile(r"\b(mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun)(day|nesday|sday|urday)?\b|\b(at|on|utc|gmt)\b", re.IGNORECASE)
+
+
+def normalize(text):
+    """Strip what strptime can't read out of a typed date: weekdays, commas, ordinal suffixes, "Sept", "7p.m.", "@" and extra spaces"""
+
+    text = NOISE.sub(" ", text)
+    text = re.sub(r"(\d)(st|nd|rd|th)\b", r"\1", text, flags=re.IGNORECASE)
+    text = re.sub(r"\bsept\b", "sep", text, flags=re.IGNORECASE)
+    text = re.sub(r"(\d)\s*([ap])\.?m\b\.?", r"\1 \2m", text, flags=re.IGNORECASE)
+    return " ".join(text.replace(",", " ").replace("@", " ").split())
+
+# strptime fills in 1900 for dates without a year, which would turn away Feb 29. They're read in this leap year instead, then moved to the real one.
+PLACEHOLDER_YEAR = 1904
+
+
+def parse_datetime(text, tz=timezone.utc, today=None, assume_year=True):
+    """Read a date, with or without a time, from text like "2021-09-20T19:00:00+02:00", "9/20/21", "Monday, Sept 20th at 7pm" or "20 September 2021 19:30".
+
+    Return a timezone-aware datetime, in tz unless the text gives an offset, or None if the text isn't a date. Dates without a year are taken to be in today's year, or are None with assume_year=False; dates without a time are at midnight."""
+
+    if not text or not text.strip():
+        return None
+
+    try:
+        parsed = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    except ValueError:
+        parsed = None
+
+    if parsed is None:
+        text = normalize(text)
+        for date_format in DATE_FORMATS:
+            has_year = "%Y" in date_format or "%y" in date_format
+            if not has_year and not assume_year:
+                continue
+            for time_format in TIME_FORMATS:
+                full_format = f"{date_format} {time_format}".strip()
+                try:
+                    if has_year:
+                        parsed = datetime.strptime(text, full_format)
+                    else:
+                        parsed = datetime.strptime(f"{text} {PLACEHOLDER_YEAR}", f"{full_format} %Y")
+                except ValueError:
+                    continue
+                if not has_year:
+                    try:
+                        parsed = parsed.replace(year=(today or datetime.now(tz)).year)
+                    except ValueError:
+                        # Feb 29, outside a leap year
+                        return None
+                break
+            if parsed is not None:
+                break
+
+    if parsed is None:
+        return None
+
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=tz)
+
+def format_datetime(value):
+    """Show a meeting time like "Mon, Sep 20 2021, 7:00 PM UTC", leaving out midnight, which usually means no time was given"""
+
+    if value is None:
+        return "Date to be announced"
+
+    value = value.astimezone(timezone.utc)
+    shown = f"{value:%a, %b} {value.day} {value.year}"
+    if (value.hour, value.minute) != (0, 0):
+        shown += f", {value.hour % 12 or 12}:{value:%M %p} UTC"
+    return shown
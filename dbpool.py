@@ -0,0 +1,120 @@
+"""Database engine settings and connection pool metrics."""
+
+# connect_db() turns the DB_* settings of a config profile into SQLAlchemy engine options with engine_options().
+#
+# With several gunicorn workers each holding its own pool, workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) has to stay under Postgres' max_connections (20 on Heroku's hobby plans), or under PgBouncer's pool if one sits in front.
+
+from threading import Lock
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the DB_* settings in config"""
+
+    options = {
+        "poolclass": MeteredQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+    # statement_timeout is a Postgres setting; SQLite (local development) has nothing like it and rejects the connect option
+    postgres = make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() == "postgresql"
+
+    timeout = config["DB_STATEMENT_TIMEOUT"] if postgres else None
+    if timeout and config["DB_PGBOUNCER"]:
+        # In transaction pooling mode PgBouncer hands every transaction to whichever server connection is free, and rejects startup options. A session setting would leak to other clients, so set it per transaction instead.
+        options["execution_options"] = {"statement_timeout": timeout}
+    elif timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(timeout)}"}
+
+    return options
+
+
+@event.listens_for(Engine, "begin")
+def set_local_statement_timeout(conn):
+    """Start each transaction with SET LOCAL statement_timeout, on engines that ask for it"""
+
+    timeout = conn.get_execution_options().get("statement_timeout")
+    if timeout:
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+class PoolMetrics:
+    """Counts connection pool checkouts, the time spent waiting for them, and how often the pool ran into overflow or out of connections.
+
+    Counters are per process, so each gunicorn worker reports its own."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkouts = 0
+            self.overflows = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record_checkout(self, wait, overflow=False):
+        with self.lock:
+            self.checkouts += 1
+            self.overflows += overflow
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_timeout(self, wait):
+        with self.lock:
+            self.timeouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self, pool=None):
+        """Return the counters, plus the pool's current state if given, as a dict"""
+
+        with self.lock:
+            data = {
+                "checkouts": self.checkouts,
+                "overflows": self.overflows,
+                "timeouts": self.timeouts,
+                "wait_ms_total": round(self.wait_total * 1000, 3),
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+                "wait_ms_mean": round(self.wait_total * 1000 / max(self.checkouts + self.timeouts, 1), 3),
+            }
+
+        if pool is not None:
+            data.update({
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+            })
+
+        return data
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records every checkout in pool_metrics"""
+
+    def connect(self):
+        # Waiting includes opening a new connection and the pre-ping, both of which a request sits through
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            pool_metrics.record_timeout(time.perf_counter() - start)
+            raise
+
+        pool_metrics.record_checkout(time.perf_counter() - start, overflow=self.checkedout() > self.size())
+        return connection
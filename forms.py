@@ -1,9 +1,11 @@
 from flask_wtf import FlaskForm
 from flask_wtf.recaptcha import validators
 from wtforms import StringField, SelectField, PasswordField, TextAreaField, IntegerField
-from wtforms.validators import Email, InputRequired
+from wtforms.validators import Email, InputRequired, ValidationError
 from wtforms.fields.html5 import EmailField
 
+from dates import parse_datetime
+
 class RegisterForm(FlaskForm):
     username = StringField("Username", validators=[InputRequired()])
     password = PasswordField("Password", validators=[InputRequired()])
@@ -37,13 +39,18 @@ class EditNoteForm(FlaskForm):
     text = TextAreaField("New Note Text", validators=[InputRequired()])
     
 class MeetingForm(FlaskForm):
-    date = StringField("Date", validators=[InputRequired()])
+    # Free text, read by parse_datetime(), so people can type a date however they usually would
+    starts_at = StringField("Date and time (UTC)", validators=[InputRequired()], description="e.g. 2021-09-20 19:00 or 9/20/21 7pm")
     # Topic will be selected from club's books
     topic = SelectField("Topic", validators=[InputRequired()])
     url = StringField("URL")
 
     # Club ID will be added automatically
 
+    def validate_starts_at(form, field):
+        if parse_datetime(field.data) is None:
+            raise ValidationError("We couldn't read that date. Try something like 2021-09-20 19:00.")
+
 class BookSearchForm(FlaskForm):
     query = StringField("Enter the title or author of the book you'd like to add", validators=[InputRequired()])
 
@@ -0,0 +1,8 @@
+"""Gunicorn settings for BookTalk (see Procfile)."""
+
+
+def post_worker_init(worker):
+    # Runs in each worker after it has loaded the app and before it accepts requests, so nobody waits on a cold worker
+    from app import warmup
+
+    warmup(worker.wsgi)
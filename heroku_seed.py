@@ -1,8 +1,12 @@
 """Seed file to make sample data for Heroku db."""
 
 from models import Meeting, db, User, Club, Book, Membership, Read, Note, Favorite
-from app import app
+from app import create_app
+from migrations import stamp
 
-# Create all tables
+app = create_app()
+
+# Create all tables, already at the latest migration
 db.drop_all()
-db.create_all()
\ No newline at end of file
+db.create_all()
+stamp()
\ No newline at end of file
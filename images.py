@@ -0,0 +1,209 @@
+from hashlib import sha256
+from io import BytesIO
+from urllib.parse import urljoin, urlparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import tempfile
+
+from PIL import Image, UnidentifiedImageError, features
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import requests
+
+from cache import TTLCache
+
+# Widths (and max heights) of the thumbnails made for every image
+THUMBNAIL_SIZES = (64, 180, 400)
+
+# Refuse to download or decode anything bigger than these
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+MAX_REDIRECTS = 3
+
+
+class ImageError(Exception):
+    """An image couldn't be fetched or isn't an image we can resize"""
+
+
+def is_public(address):
+    return ipaddress.ip_address(address.split("%")[0]).is_global
+
+
+class PublicPeerMixin:
+    """Drop any connection whose peer isn't a public address. check_host resolves the name once and the connection resolves it again, so a name can answer public then private (DNS rebinding); this checks the socket actually opened."""
+
+    def _new_conn(self):
+        sock = super()._new_conn()
+        address = sock.getpeername()[0]
+        if not is_public(address):
+            sock.close()
+            raise ImageError(f"{self.host} connected to private address {address}")
+        return sock
+
+
+class PublicHTTPConnection(PublicPeerMixin, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicPeerMixin, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAdapter(HTTPAdapter):
+    """Transport adapter whose connections only ever reach public addresses. TLS still verifies the certificate and sends SNI for the URL's hostname."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": PublicHTTPConnectionPool, "https": PublicHTTPSConnectionPool}
+
+
+class ImageStore:
+    """Fetches remote cover and avatar images once and keeps resized copies on local disk.
+
+    Each image's thumbnails are named after a hash of its content (e.g. 3f2a...-180.webp), so they never change and can be cached by browsers forever. A small index maps each source URL to that hash."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            app.config["IMAGE_CACHE_DIR"] or os.path.join(app.instance_path, "images"),
+            app.config["SECRET_KEY"],
+            timeout=app.config["IMAGE_FETCH_TIMEOUT"],
+            allow_private=app.config["IMAGE_ALLOW_PRIVATE_HOSTS"])
+
+    def configure(self, path, secret, timeout=(2, 5), allow_private=False):
+        self.path = path
+        self.secret = secret.encode("utf8")
+        self.timeout = timeout
+        self.allow_private = allow_private
+        self.session = requests.Session()
+        if not allow_private:
+            self.session.mount("http://", PublicAdapter())
+            self.session.mount("https://", PublicAdapter())
+            # A proxy from the environment would be the peer of every connection, hiding where requests really go
+            self.session.trust_env = False
+        self.format = "webp" if features.check("webp") else "jpeg"
+
+        # Remember which sources are already on disk, so pages don't stat a file per image
+        self.index = TTLCache(maxsize=4096, ttl=60 * 60)
+
+        os.makedirs(os.path.join(path, "sources"), exist_ok=True)
+
+    def sign(self, url, size):
+        """Signature for a proxy request, so the proxy only fetches URLs our own pages asked for"""
+
+        return hmac.new(self.secret, f"{size}:{url}".encode("utf8"), sha256).hexdigest()[:32]
+
+    def verify(self, url, size, signature):
+        return size in THUMBNAIL_SIZES and hmac.compare_digest(self.sign(url, size), signature or "")
+
+    def _source_file(self, url):
+        return os.path.join(self.path, "sources", sha256(url.encode("utf8")).hexdigest() + ".json")
+
+    def filename(self, content_hash, size):
+        return f"{content_hash}-{size}.{self.format}"
+
+    def lookup(self, url):
+        """Return the content hash of an already stored source URL, or None"""
+
+        content_hash = self.index.get(url)
+        if content_hash is not None:
+            return content_hash
+
+        try:
+            with open(self._source_file(url)) as f:
+                content_hash = json.load(f)["hash"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        self.index.set(url, content_hash)
+        return content_hash
+
+    def check_host(self, url):
+        """Raise ImageError unless url is http(s) on a public host. User images are URLs anyone can type, so don't let them point us at the internal network."""
+
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ImageError(f"{url} isn't an http(s) URL")
+        if self.allow_private:
+            return
+
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(parsed.hostname, None)}
+        except (socket.gaierror, UnicodeError) as e:
+            raise ImageError(str(e)) from e
+
+        if not all(map(is_public, addresses)):
+            raise ImageError(f"{url} points at a private address")
+
+    def download(self, url):
+        """Return the bytes at url, following a few redirects and checking every hop's host"""
+
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                self.check_host(url)
+                res = self.session.get(url, timeout=self.timeout, stream=True, allow_redirects=False)
+                if not res.is_redirect:
+                    break
+                url = urljoin(url, res.headers["Location"])
+            else:
+                raise ImageError(f"Too many redirects for {url}")
+
+            res.raise_for_status()
+            return res.raw.read(MAX_IMAGE_BYTES + 1, decode_content=True)
+        except requests.RequestException as e:
+            raise ImageError(str(e)) from e
+
+    def fetch(self, url):
+        """Download url, store a thumbnail at every size, and return the image's content hash"""
+
+        data = self.download(url)
+
+        if len(data) > MAX_IMAGE_BYTES:
+            raise ImageError(f"{url} is larger than {MAX_IMAGE_BYTES} bytes")
+
+        content_hash = sha256(data).hexdigest()[:32]
+
+        try:
+            image = Image.open(BytesIO(data))
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise ImageError(f"{url} is larger than {MAX_IMAGE_PIXELS} pixels")
+            image.load()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+            raise ImageError(str(e)) from e
+
+        image = image.convert("RGBA" if self.format == "webp" and image.mode in ("RGBA", "LA", "P") else "RGB")
+
+        for size in THUMBNAIL_SIZES:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            self._write(self.filename(content_hash, size), lambda f: thumbnail.save(f, self.format, quality=80))
+
+        self._write(self._source_file(url), lambda f: f.write(json.dumps({"url": url, "hash": content_hash}).encode("utf8")))
+        self.index.set(url, content_hash)
+
+        return content_hash
+
+    def _write(self, name, write):
+        # Write to a temp file and rename, so other workers never serve a half written image
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+
+images = ImageStore()
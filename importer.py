@@ -0,0 +1,346 @@
+"""Stream an OpenLibrary editions or works dump into the books table."""
+
+# run it like:
+#
+#    python importer.py ol_dump_editions_latest.txt.gz --authors ol_dump_authors_latest.txt.gz
+#    python importer.py sample.txt --batch 1000 --method insert
+#    python importer.py --backfill
+#
+# Dumps are listed at https://openlibrary.org/developers/dumps. Each line is tab separated: type, key, revision, last_modified, JSON record.
+# Works, and most editions, only link their authors by key. With --authors, the names in the authors dump are loaded first and looked up a batch at a time; without it, records that don't name an author are skipped.
+# Progress is checkpointed after every committed batch; re-run the same command after an interruption and it picks up where it stopped.
+# --backfill fills in OpenLibrary edition keys and ISBNs for books added before the catalog stored them, once migrations.py has added the columns.
+
+
+from itertools import islice
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import time
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Book
+from openlibrary import openlibrary, BIBKEYS_PER_REQUEST
+from transforms import transform_book_res, transform_book_res_many
+
+# Dump record types that describe a book
+IMPORT_TYPES = {"/type/edition", "/type/work"}
+AUTHOR_TYPE = "/type/author"
+
+BATCH_SIZE = 5000
+
+# Seconds between progress reports
+REPORT_EVERY = 5
+
+BOOK_COLUMNS = ["title", "author", "image", "num_pages", "publish_date", "ol_edition_key", "isbn13", "norm_key"]
+
+
+########################################################################
+# Pipeline
+#
+# Each stage is a generator, so only one batch is ever held in memory no matter how big the dump is.
+
+
+def read_lines(path, skip=0):
+    """Yield (line number, line) from a plain or gzipped dump, starting after line `skip`"""
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf8") as f:
+        for number, line in enumerate(f, 1):
+            if number > skip:
+                yield number, line
+
+def parse_records(lines):
+    """Yield (line number, record) for each edition or work, dropping other record types and malformed lines"""
+
+    for number, line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 5 or fields[0] not in IMPORT_TYPES:
+            continue
+
+        try:
+            yield number, json.loads(fields[4])
+        except ValueError:
+            continue
+
+def parse_authors(lines):
+    """Yield (key, name) for each named author in an authors dump"""
+
+    for number, line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 5 or fields[0] != AUTHOR_TYPE:
+            continue
+
+        try:
+            name = json.loads(fields[4]).get("name")
+        except (ValueError, AttributeError):
+            continue
+
+        if isinstance(name, str) and name.strip():
+            yield fields[1], name.replace("\x00", "")
+
+def batches(records, size):
+    """Group an iterable into lists of at most size items"""
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def clean_book(book):
+    """Return a transformed book as a row ready to load, or None if it can't be told apart from other books"""
+
+    if book["title"] in ("", "Title not available") or book["author"] in ("", "Author not available"):
+        return None
+
+    # Postgres text can't hold NUL, and a few dump records have strings where numbers belong
+    row = {key: value.replace("\x00", "") if isinstance(value, str) else value for key, value in book.items()}
+    if not isinstance(row["num_pages"], int):
+        row["num_pages"] = None
+
+    # COPY reads an empty csv field as NULL, so required columns need a value and optional ones are NULL either way
+    row["publish_date"] = row["publish_date"] or "Publish date not available"
+    row["image"] = row["image"] or "/static/images/placeholder.png"
+    row["ol_edition_key"] = row["ol_edition_key"] or None
+    row["isbn13"] = row["isbn13"] or None
+
+    row["norm_key"] = Book.make_key(row["title"], row["author"])
+    return row
+
+def author_key(record):
+    """Return the key of a record's first author if the record doesn't name them. Editions link {"key": ...}, works {"author": {"key": ...}}."""
+
+    try:
+        author = record["authors"][0]
+        return None if author.get("name") else (author.get("author") or author)["key"]
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+def name_authors(batch):
+    """Fill in the first author's name on records that only link it by key, from import_authors, with one query per batch"""
+
+    keys = {author_key(record) for number, record in batch} - {None}
+    if not keys:
+        return
+
+    names = dict(db.session.execute(db.text("SELECT key, name FROM import_authors WHERE key = ANY(:keys)"), {"keys": list(keys)}).all())
+    for number, record in batch:
+        name = names.get(author_key(record))
+        if name:
+            record["authors"] = [{"name": name}]
+
+def book_rows(batch):
+    """Transform a batch of dump records into unique book rows"""
+
+    rows = {}
+    for book in transform_book_res_many(record for number, record in batch):
+        row = clean_book(book)
+        if row is not None:
+            rows.setdefault(row["norm_key"], row)
+
+    return list(rows.values())
+
+
+########################################################################
+# Loading
+#
+# Either way books already in the catalog are left alone, so overlapping dumps and re-runs don't make duplicates.
+
+
+def copy_books(rows):
+    """COPY rows into a temp table, then move the new ones into books. Return how many were inserted."""
+
+    connection = db.session.connection()
+    connection.execute(db.text(
+        "CREATE TEMP TABLE IF NOT EXISTS import_books "
+        "(title text, author text, image text, num_pages integer, publish_date text, ol_edition_key text, isbn13 text, norm_key text) ON COMMIT DELETE ROWS"))
+
+    data = io.StringIO()
+    csv.writer(data).writerows([row[column] for column in BOOK_COLUMNS] for row in rows)
+    data.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY import_books ({', '.join(BOOK_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", data)
+
+    columns = ", ".join(BOOK_COLUMNS)
+    result = connection.execute(db.text(
+        f"INSERT INTO books ({columns}) SELECT {columns} FROM import_books ON CONFLICT (norm_key) DO NOTHING"))
+    return result.rowcount
+
+def insert_books(rows):
+    """Insert rows with one multi-row INSERT. Return how many were inserted."""
+
+    stmt = insert(Book).values(rows).on_conflict_do_nothing(index_elements=[Book.norm_key]).returning(Book.id)
+    return len(db.session.execute(stmt).all())
+
+LOADERS = {"copy": copy_books, "insert": insert_books}
+
+def load_authors(path, batch_size=BATCH_SIZE, report=print):
+    """COPY the names in an authors dump into the import_authors table, replacing what was there. Return how many were loaded."""
+
+    # A scratch table for the length of an import, rebuilt from the dump each run, so it's unlogged and indexed only once it's full
+    connection = db.session.connection()
+    connection.execute(db.text("DROP TABLE IF EXISTS import_authors"))
+    connection.execute(db.text("CREATE UNLOGGED TABLE import_authors (key text NOT NULL, name text NOT NULL)"))
+
+    cursor = connection.connection.cursor()
+    loaded = 0
+    for batch in batches(parse_authors(read_lines(path)), batch_size):
+        data = io.StringIO()
+        csv.writer(data).writerows(batch)
+        data.seek(0)
+        cursor.copy_expert("COPY import_authors (key, name) FROM STDIN WITH (FORMAT csv)", data)
+        loaded += len(batch)
+
+    connection.execute(db.text("CREATE INDEX ON import_authors (key)"))
+    connection.execute(db.text("ANALYZE import_authors"))
+    db.session.commit()
+
+    report(f"Loaded {loaded} authors")
+    return loaded
+
+def drop_authors():
+    """Drop the import_authors table once an import no longer needs it"""
+
+    db.session.execute(db.text("DROP TABLE IF EXISTS import_authors"))
+    db.session.commit()
+
+
+########################################################################
+# Checkpoints
+
+
+def load_checkpoint(path, dump):
+    """Return the last line of dump that was committed, or 0 to start from the top"""
+
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+
+    return checkpoint["line"] if checkpoint.get("dump") == os.path.abspath(dump) else 0
+
+def save_checkpoint(path, dump, line):
+    """Record that everything up to line has been committed"""
+
+    # Write then rename, so an interruption never leaves a half written checkpoint
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"dump": os.path.abspath(dump), "line": line}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def import_dump(path, batch_size=BATCH_SIZE, method="copy", checkpoint=None, authors=None, report=print):
+    """Stream the dump at path into books, committing every batch_size records. Return a dict of totals.
+
+    authors is the path of an authors dump, used to name the authors that records only link by key."""
+
+    load = LOADERS[method]
+    if authors:
+        load_authors(authors, report=report)
+
+    skip = load_checkpoint(checkpoint, path) if checkpoint else 0
+    if skip:
+        report(f"Resuming after line {skip}")
+
+    totals = {"records": 0, "inserted": 0, "seconds": 0}
+    start = last_report = time.perf_counter()
+
+    for batch in batches(parse_records(read_lines(path, skip)), batch_size):
+        if authors:
+            name_authors(batch)
+        rows = book_rows(batch)
+        totals["inserted"] += load(rows) if rows else 0
+        totals["records"] += len(batch)
+        db.session.commit()
+
+        if checkpoint:
+            save_checkpoint(checkpoint, path, batch[-1][0])
+
+        now = time.perf_counter()
+        if now - last_report >= REPORT_EVERY:
+            report(f"{totals['records']} records, {totals['inserted']} new books, {totals['records'] / (now - start):.0f} rows/sec")
+            last_report = now
+
+    if authors:
+        drop_authors()
+
+    totals["seconds"] = time.perf_counter() - start
+    report(f"Done: {totals['records']} records, {totals['inserted']} new books in {totals['seconds']:.1f}s "
+           f"({totals['records'] / max(totals['seconds'], 1e-9):.0f} rows/sec)")
+
+    return totals
+
+
+
+########################################################################
+# Backfill
+
+
+def backfill_identifiers(report=print):
+    """Look up books missing an edition key on OpenLibrary and store the key and ISBN-13 of an exact title + author match. Return how many were filled in.
+
+    The columns come from migration 0001; run migrations.py first on a database from before them."""
+
+    filled = 0
+    after = 0
+    while True:
+        batch = (db.session.query(Book.id, Book.title, Book.author, Book.norm_key)
+                 .filter(Book.ol_edition_key == None, Book.id > after)
+                 .order_by(Book.id)
+                 .limit(BIBKEYS_PER_REQUEST)
+                 .all())
+        if not batch:
+            break
+        after = batch[-1].id
+
+        # Only trust a search result whose normalized title and author are exactly the book's
+        matches = {}
+        for book in batch:
+            for result in openlibrary.search(book.title)["books"]:
+                if Book.make_key(result["title"], result["author"]) == book.norm_key:
+                    matches[book.id] = result["id"]
+                    break
+
+        # Then fetch every match's ISBN in one request
+        found = openlibrary.books([f"OLID:{edition_id}" for edition_id in matches.values()])
+        updates = [{"book_id": book_id, "ol_edition_key": edition_id, "isbn13": transform_book_res(found.get(f"OLID:{edition_id}", {}))["isbn13"]}
+                   for book_id, edition_id in matches.items()]
+
+        if updates:
+            db.session.execute(db.text("UPDATE books SET ol_edition_key = :ol_edition_key, isbn13 = coalesce(isbn13, :isbn13), version = version + 1 WHERE id = :book_id"), updates)
+        db.session.commit()
+
+        filled += len(updates)
+        report(f"{filled} books filled in so far")
+
+    return filled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("dump", nargs="?", help="path to an editions or works dump, optionally gzipped")
+    parser.add_argument("--authors", help="path to an authors dump, to name authors that records only link by key")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="records per transaction")
+    parser.add_argument("--method", choices=sorted(LOADERS), default="copy", help="how each batch is loaded")
+    parser.add_argument("--checkpoint", help="where to record progress (default: <dump>.checkpoint)")
+    parser.add_argument("--backfill", action="store_true", help="fill in identifiers for books already in the catalog instead")
+    args = parser.parse_args()
+
+    if not args.dump and not args.backfill:
+        parser.error("give a dump to import, or --backfill")
+
+    # Building the app connects models to the configured DATABASE_URL
+    from app import create_app
+    app = create_app("prod")
+
+    if args.backfill:
+        backfill_identifiers()
+    else:
+        import_dump(args.dump, batch_size=args.batch, method=args.method, checkpoint=args.checkpoint or f"{args.dump}.checkpoint", authors=args.authors)
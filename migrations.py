@@ -0,0 +1,316 @@
+"""Versioned schema migrations, for databases created before the models they now run against."""
+
+# run them like:
+#
+#    python migrations.py               # apply every migration that hasn't been
+#    python migrations.py status
+#    python migrations.py stamp         # record every migration as applied, after db.create_all() built the current schema
+#
+# Heroku runs them in the release phase (see Procfile), before new code takes traffic. Behind PgBouncer, set MIGRATION_DATABASE_URL to the direct database URL: migrations need session settings and CREATE INDEX CONCURRENTLY, which transaction pooling can't carry.
+#
+# Migrations are applied in version order and recorded in schema_migrations. They run against a live database, so:
+# - every statement is its own short transaction with a lock_timeout, so a statement waiting on a busy table gives up (and is retried) instead of queueing every query behind it
+# - indexes are built CONCURRENTLY, which doesn't block writes
+# - backfills update a batch of rows per transaction
+# A migration that fails partway is simply run again from the top, so every step must be idempotent.
+
+
+import argparse
+import os
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from dates import parse_datetime
+from models import db, Book
+from search import SEARCH_VECTOR_TRIGGER
+
+# How long a statement may wait for its locks before giving up, and how many times it's retried
+LOCK_TIMEOUT = "3s"
+LOCK_RETRIES = 5
+
+# Rows a backfill updates per transaction
+BACKFILL_BATCH = 5000
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register the decorated function as a migration. It's called with an autocommit connection, and a function to report progress to."""
+
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        MIGRATIONS.sort()
+        return upgrade
+    return register
+
+
+########################################################################
+# Helpers for writing migrations
+
+
+def execute(conn, *statements, params={}):
+    """Run statements in one transaction, retrying from the start if they can't get their locks within LOCK_TIMEOUT. Return the last one's result.
+
+    params are bound to every statement; a list of them runs each statement once per item."""
+
+    for attempt in range(LOCK_RETRIES):
+        # The connection is in autocommit mode, so the transaction is begun by hand
+        conn.exec_driver_sql("BEGIN")
+        try:
+            conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+            results = [conn.execute(db.text(statement), params) for statement in statements]
+            conn.exec_driver_sql("COMMIT")
+            return results[-1]
+        except OperationalError as e:
+            conn.exec_driver_sql("ROLLBACK")
+            # 55P03 is lock_not_available
+            if getattr(e.orig, "pgcode", None) != "55P03" or attempt == LOCK_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def create_index(conn, name, table, columns, unique=False, where=None, using=None):
+    """Build an index without blocking writes to the table"""
+
+    # An interrupted concurrent build leaves an invalid index behind, which IF NOT EXISTS would take for a finished one
+    if conn.exec_driver_sql(f"SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass('{name}')").scalar():
+        drop_index(conn, name)
+
+    # Not run through execute(): CONCURRENTLY can't run inside a transaction, and waits out other transactions rather than locking
+    conn.exec_driver_sql(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}"
+                         + (f" USING {using}" if using else "") + f" ({columns})"
+                         + (f" WHERE {where}" if where else ""))
+
+def drop_index(conn, name):
+    conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+def has_column(conn, table, column):
+    return conn.execute(db.text("SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column)"),
+                        {"table": table, "column": column}).scalar()
+
+def has_constraint(conn, table, name):
+    return conn.execute(db.text("SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(:table) AND conname = :name)"),
+                        {"table": table, "name": name}).scalar()
+
+def set_not_null(conn, table, column):
+    """SET NOT NULL without holding an exclusive lock while the table is scanned"""
+
+    # Validating a CHECK constraint scans the table under a lock that allows writes. Postgres then trusts it and skips the scan SET NOT NULL would do.
+    check = f"{table}_{column}_not_null"
+    if conn.exec_driver_sql(f"SELECT attnotnull FROM pg_attribute WHERE attrelid = '{table}'::regclass AND attname = '{column}'").scalar():
+        return
+    if not has_constraint(conn, table, check):
+        execute(conn, f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID")
+    execute(conn, f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}")
+    execute(conn, f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL", f"ALTER TABLE {table} DROP CONSTRAINT {check}")
+
+
+########################################################################
+# Migrations
+#
+# Keep the names of indexes and constraints the same as db.create_all() gives them, so migrated and freshly created databases match.
+
+
+@migration("0001", "Columns and indexes added since the original schema: books.norm_key and OpenLibrary ids, and version stamps")
+def add_catalog_columns(conn, report):
+    # Version stamps, which cached fragments and ETags are keyed on. Since Postgres 11 a constant default doesn't rewrite the table.
+    for table in ("users", "clubs", "books"):
+        execute(conn, f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1")
+
+    execute(conn, "ALTER TABLE books ADD COLUMN IF NOT EXISTS ol_edition_key text", "ALTER TABLE books ADD COLUMN IF NOT EXISTS isbn13 text")
+    create_index(conn, "ix_books_ol_edition_key", "books", "ol_edition_key")
+    create_index(conn, "ix_books_isbn13", "books", "isbn13")
+
+    # norm_key is computed in Python, so it's backfilled a batch at a time, walking the primary key so no batch rescans the rows before it
+    execute(conn, "ALTER TABLE books ADD COLUMN IF NOT EXISTS norm_key text")
+    after = 0
+    while True:
+        batch = execute(conn, "SELECT id, title, author FROM books WHERE id > :after AND norm_key IS NULL ORDER BY id LIMIT :limit",
+                        params={"after": after, "limit": BACKFILL_BATCH}).fetchall()
+        if not batch:
+            break
+        after = batch[-1].id
+        execute(conn, "UPDATE books SET norm_key = :key WHERE id = :id",
+                params=[{"id": book_id, "key": Book.make_key(title, author)} for book_id, title, author in batch])
+
+    merge_duplicate_books(conn)
+
+    create_index(conn, "books_norm_key_key", "books", "norm_key", unique=True)
+    if not has_constraint(conn, "books", "books_norm_key_key"):
+        execute(conn, "ALTER TABLE books ADD CONSTRAINT books_norm_key_key UNIQUE USING INDEX books_norm_key_key")
+    set_not_null(conn, "books", "norm_key")
+
+def merge_duplicate_books(conn):
+    """Fold books with the same norm_key into the oldest of them, moving their shelves, favorites and notes along"""
+
+    duplicates = "SELECT id, keep FROM (SELECT id, min(id) OVER (PARTITION BY norm_key) AS keep FROM books) books WHERE id <> keep"
+    execute(conn,
+        f"CREATE TEMPORARY TABLE book_merges ON COMMIT DROP AS {duplicates}",
+        "INSERT INTO reads (club_id, book_id, current, complete) SELECT club_id, keep, current, complete FROM reads JOIN book_merges ON book_merges.id = reads.book_id ON CONFLICT DO NOTHING",
+        "INSERT INTO favorites (user_id, book_id) SELECT user_id, keep FROM favorites JOIN book_merges ON book_merges.id = favorites.book_id ON CONFLICT DO NOTHING",
+        "UPDATE notes SET book_id = keep FROM book_merges WHERE book_merges.id = notes.book_id",
+        # Their reads and favorites go with them
+        "DELETE FROM books USING book_merges WHERE book_merges.id = books.id")
+
+
+@migration("0002", "Indexes for the foreign keys routes filter on, and partial indexes for club staff and current reads")
+def add_hot_path_indexes(conn, report):
+    create_index(conn, "ix_memberships_club_id", "memberships", "club_id")
+    create_index(conn, "ix_memberships_admins", "memberships", "club_id", where="admin")
+    create_index(conn, "ix_memberships_moderators", "memberships", "club_id", where="moderator")
+
+    # reads' primary key (club_id, book_id) already serves lookups by club
+    create_index(conn, "ix_reads_book_id", "reads", "book_id")
+    create_index(conn, "ix_reads_current", "reads", "club_id", where="current")
+
+    create_index(conn, "ix_meetings_club_id", "meetings", "club_id")
+    create_index(conn, "ix_notes_meeting_id", "notes", "meeting_id")
+    create_index(conn, "ix_notes_user_id", "notes", "user_id")
+    create_index(conn, "ix_notes_book_id", "notes", "book_id")
+
+    for table in ("memberships", "reads", "meetings", "notes"):
+        conn.exec_driver_sql(f"ANALYZE {table}")
+
+
+@migration("0003", "Typed meeting times: meetings.starts_at, read from the free-form date, indexed with club_id")
+def add_meeting_starts_at(conn, report):
+    execute(conn, "ALTER TABLE meetings ADD COLUMN IF NOT EXISTS starts_at timestamptz")
+
+    if has_column(conn, "meetings", "date"):
+        # Dates are free text, so they're read in Python, a batch at a time. Ones that can't be read are left without a time and listed, for a club admin to set again. So are ones without a year: a meeting saved last year as "Oct 3" would otherwise move to this one.
+        after = 0
+        while True:
+            batch = execute(conn, "SELECT id, date FROM meetings WHERE id > :after AND starts_at IS NULL ORDER BY id LIMIT :limit",
+                            params={"after": after, "limit": BACKFILL_BATCH}).fetchall()
+            if not batch:
+                break
+            after = batch[-1].id
+
+            times = [{"id": meeting_id, "starts_at": parse_datetime(date, assume_year=False)} for meeting_id, date in batch]
+            for unread in (time for time in times if time["starts_at"] is None):
+                date = dict(batch)[unread["id"]]
+                if parse_datetime(date) is not None:
+                    report(f"The date of meeting {unread['id']} has no year: {date!r}")
+                else:
+                    report(f"Couldn't read the date of meeting {unread['id']}: {date!r}")
+
+            times = [time for time in times if time["starts_at"] is not None]
+            if times:
+                execute(conn, "UPDATE meetings SET starts_at = :starts_at WHERE id = :id", params=times)
+
+        # The old column is kept for workers still running the previous release. New meetings don't fill it in, so it can't stay NOT NULL.
+        execute(conn, "ALTER TABLE meetings ALTER COLUMN date DROP NOT NULL")
+
+    # Leads with club_id, so it replaces the index on club_id alone
+    create_index(conn, "ix_meetings_club_id_starts_at", "meetings", "club_id, starts_at")
+    drop_index(conn, "ix_meetings_club_id")
+    conn.exec_driver_sql("ANALYZE meetings")
+
+
+@migration("0004", "Index books by (title, id), the order the catalog is paged in")
+def add_books_title_index(conn, report):
+    create_index(conn, "ix_books_title_id", "books", "title, id")
+    conn.exec_driver_sql("ANALYZE books")
+
+
+@migration("0005", "books.search_vector for full-text search, kept up to date by a trigger, with its GIN index")
+def add_search_vector(conn, report):
+    # Adding a generated column rewrites the table under an exclusive lock, so it's a plain column the trigger fills in. Databases that already got the generated one keep its values and only lose the expression, which doesn't rewrite it either.
+    generated = conn.exec_driver_sql("SELECT is_generated = 'ALWAYS' FROM information_schema.columns WHERE table_name = 'books' AND column_name = 'search_vector'").scalar()
+    if generated:
+        execute(conn, "ALTER TABLE books ALTER COLUMN search_vector DROP EXPRESSION")
+    else:
+        execute(conn, "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector")
+
+    # From here on the trigger covers new and renamed books, so the backfill only has to reach the rows already there, a range of ids at a time
+    execute(conn, *SEARCH_VECTOR_TRIGGER)
+    last_id = execute(conn, "SELECT coalesce(max(id), 0) FROM books").scalar()
+    for after in range(0, last_id, BACKFILL_BATCH):
+        execute(conn, "UPDATE books SET search_vector = to_tsvector('simple', norm_key) WHERE id > :after AND id <= :until AND search_vector IS NULL",
+                params={"after": after, "until": after + BACKFILL_BATCH})
+
+    create_index(conn, "ix_books_search", "books", "search_vector", using="gin")
+
+
+########################################################################
+# Running them
+
+
+def connect(engine=None):
+    """An autocommit connection with no statement timeout, for running migrations on"""
+
+    conn = (engine or db.engine).connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    # Building an index or backfilling a big table takes longer than any request should
+    conn.exec_driver_sql("SET statement_timeout = 0")
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS schema_migrations (version text PRIMARY KEY, description text NOT NULL, applied_at timestamptz NOT NULL DEFAULT now())")
+    return conn
+
+def applied(conn):
+    return {version for version, in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+def record(conn, version, description):
+    conn.execute(db.text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description) ON CONFLICT DO NOTHING"),
+                 {"version": version, "description": description})
+
+def upgrade(engine=None, report=print):
+    """Apply every migration that hasn't been, in order. Return the versions applied."""
+
+    conn = connect(engine)
+    try:
+        done = applied(conn)
+        ran = []
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+
+            report(f"{version}: {description}")
+            start = time.perf_counter()
+            migrate(conn, report)
+            record(conn, version, description)
+            report(f"{version}: done in {time.perf_counter() - start:.1f}s")
+            ran.append(version)
+        return ran
+    finally:
+        conn.close()
+
+def stamp(engine=None):
+    """Record every migration as applied, for a database db.create_all() just built"""
+
+    conn = connect(engine)
+    try:
+        for version, description, migrate in MIGRATIONS:
+            record(conn, version, description)
+    finally:
+        conn.close()
+
+def status(engine=None):
+    """Return (version, description, applied) for every migration"""
+
+    conn = connect(engine)
+    try:
+        done = applied(conn)
+        return [(version, description, version in done) for version, description, migrate in MIGRATIONS]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", nargs="?", choices=["upgrade", "status", "stamp"], default="upgrade")
+    args = parser.parse_args()
+
+    from app import create_app
+
+    app = create_app("prod")
+    engine = create_engine(os.environ["MIGRATION_DATABASE_URL"]) if os.environ.get("MIGRATION_DATABASE_URL") else None
+
+    with app.app_context():
+        if args.command == "upgrade":
+            ran = upgrade(engine)
+            print(f"Applied {len(ran)} migrations" if ran else "Nothing to apply")
+        elif args.command == "stamp":
+            stamp(engine)
+        else:
+            for version, description, done in status(engine):
+                print(f"{version} {'applied' if done else 'pending':8} {description}")
@@ -1,14 +1,20 @@
 from enum import unique
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from sqlalchemy.orm import backref
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timezone
+import re
+import unicodedata
+
+from passwords import hasher
+from dbpool import engine_options
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 def connect_db(app):
     """Connect to database."""
 
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
     db.app = app
     db.init_app(app)
 
@@ -28,6 +34,9 @@ class User(db.Model):
     image = db.Column(db.Text, default="/static/images/placeholder.png")
     bio = db.Column(db.Text)
 
+    # Bumped whenever something shown on the user's profile changes; cached fragments of the profile are keyed by it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
     # Map to clubs through membership. You can see which clubs a user is a part of, and which users are in which clubs
     clubs = db.relationship('Club', secondary="memberships", backref="users")
     # Map directly to memberships (important to view join date)
@@ -41,14 +50,21 @@ class User(db.Model):
     # Map directly to notes so you can see the notes a user has made on each book
     notes = db.relationship('Note', backref="users", cascade="all, delete-orphan")
 
+    @classmethod
+    def bump_version(cls, *user_ids):
+        """Mark these users' profiles as changed, so anything cached from them is rebuilt"""
+
+        db.session.execute(db.update(cls)
+                           .where(cls.id.in_(user_ids))
+                           .values(version=cls.version + 1)
+                           .execution_options(synchronize_session=False))
+
     @classmethod
     def register(cls, username, pwd, first, last, image, bio, email):
         """Register user w/hashed password & return user."""
 
-        pwd_hashed = bcrypt.generate_password_hash(pwd)
-        
-        # turn bytestring into normal (unicode utf8) string
-        hashed_utf8 = pwd_hashed.decode("utf8")
+        # hashing happens on the password worker pool; the result is already a utf8 string
+        hashed_utf8 = hasher.hash(pwd)
 
         # return instance of user w/username and hashed pwd
         user = User(username=username, password=hashed_utf8, first_name=first, last_name=last, image=image, bio=bio, email=email)
@@ -61,16 +77,114 @@ class User(db.Model):
     def authenticate(cls, username, pwd):
         """Validate that user exists & password is correct.
 
-        Return user if valide; else return False"""
+        Return user if valide; else return False. If the stored hash was made with an outdated cost factor, it is replaced on the instance; the caller's commit saves it."""
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.password, pwd):
+        if u and u.check_password(pwd):
             # return user instance
             return u
         else:
             return False
 
+    def check_password(self, pwd):
+        """Return whether pwd is the user's password, replacing a hash made with an outdated cost factor; the caller's commit saves it."""
+
+        if not hasher.check(self.password, pwd):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(pwd)
+
+        return True
+
+    def snapshot(self):
+        """Return the user's profile columns as a plain dict, suitable for caching between requests"""
+
+        return {
+            "id": self.id,
+            "username": self.username,
+            "email": self.email,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "image": self.image,
+            "bio": self.bio,
+            "version": self.version
+        }
+
+    def club_versions(self):
+        """Return (club id, version) for each of the user's clubs, in one query. Views of their clubs are cached by it, so a change to one club is seen without writing to every member's row."""
+
+        rows = (db.session.query(Club.id, Club.version)
+                .join(Membership, Membership.club_id == Club.id)
+                .filter(Membership.user_id == self.id)
+                .order_by(Club.id))
+
+        return tuple(tuple(row) for row in rows)
+
+    def club_meetings(self):
+        """Return the user's clubs, each with a list of its meetings, using a single query. Clubs and meetings are plain dicts, not full models."""
+
+        rows = (db.session.query(Club.id, Club.name, Meeting.id.label("meeting_id"), Meeting.starts_at)
+                .join(Membership, Membership.club_id == Club.id)
+                .outerjoin(Meeting, Meeting.club_id == Club.id)
+                .filter(Membership.user_id == self.id)
+                .order_by(Club.id, Meeting.starts_at, Meeting.id)
+                .all())
+
+        clubs = {}
+        for row in rows:
+            club = clubs.setdefault(row.id, {"id": row.id, "name": row.name, "meetings": []})
+            if row.meeting_id is not None:
+                club["meetings"].append({"id": row.meeting_id, "starts_at": row.starts_at})
+
+        return list(clubs.values())
+
+
+
+class CurrentUser:
+    """Stand-in for the logged in User, built from a cached snapshot.
+
+    Profile columns are read straight from the snapshot, so most requests never touch the users table. Anything else (clubs, favorites, memberships...) falls through to the full User, which is only loaded the first time a route needs it."""
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+        self._user = None
+
+    def load(self):
+        """Return the full User instance, querying for it on first use"""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # Only reached for attributes that aren't part of the snapshot
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, (User, CurrentUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+
+def fold_text(text):
+    """Fold case, accents, punctuation and runs of whitespace out of text"""
+
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", "", text.casefold())
+    return " ".join(text.split())
+
+def _book_key(context):
+    params = context.get_current_parameters()
+    return Book.make_key(params["title"], params["author"])
 
 
 class Book(db.Model):
@@ -78,6 +192,11 @@ class Book(db.Model):
 
     __tablename__ = "books"
 
+    # Lists page through the catalog by (title, id), which this index reads in order
+    __table_args__ = (
+        db.Index("ix_books_title_id", "title", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.Text, nullable=False)
     author = db.Column(db.String(), nullable=False)
@@ -85,6 +204,16 @@ class Book(db.Model):
     num_pages = db.Column(db.Integer)
     publish_date = db.Column(db.Text, nullable=False)
 
+    # Normalized title + author, filled in on insert. The unique index stops the same book being added twice.
+    norm_key = db.Column(db.Text, unique=True, nullable=False, default=_book_key)
+
+    # OpenLibrary identifiers, so a book already in the catalog can be shown without asking OpenLibrary again
+    ol_edition_key = db.Column(db.Text, index=True)
+    isbn13 = db.Column(db.Text, index=True)
+
+    # Bumped whenever the book's details change; pages showing it are versioned by it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
     # Map to clubs through reads
     clubs = db.relationship('Club', secondary="reads", backref="books")
     # Map directly to reads (important for finding whether this is the current book or not)
@@ -93,6 +222,93 @@ class Book(db.Model):
     # Map directly to notes so you can see the notes a on each book
     notes = db.relationship('Note', backref="books")
 
+    @staticmethod
+    def make_key(title, author):
+        """Return the normalized title + author key used to spot duplicate books"""
+
+        return f"{fold_text(title)}|{fold_text(author)}"
+
+    @classmethod
+    def get_or_create(cls, data):
+        """Insert a book from a transform_book_res dict, or find the existing copy.
+
+        A single INSERT ... ON CONFLICT statement against the norm_key index, so two users importing the same book at once can't create duplicates. Return (book_id, created)."""
+
+        return cls.get_or_create_many([data])[cls.make_key(data["title"], data["author"])]
+
+    @classmethod
+    def get_or_create_many(cls, records):
+        """Insert a batch of transform_book_res dicts in one INSERT ... ON CONFLICT statement.
+
+        Return a dict mapping each record's norm_key to (book_id, created)."""
+
+        # One statement can't touch the same row twice, so drop duplicates within the batch first
+        values = {}
+        for data in records:
+            norm_key = cls.make_key(data["title"], data["author"])
+            values.setdefault(norm_key, {
+                "title": data["title"],
+                "author": data["author"],
+                "image": data["image"],
+                "num_pages": data["num_pages"],
+                "publish_date": data["publish_date"],
+                "ol_edition_key": data.get("ol_edition_key"),
+                "isbn13": data.get("isbn13"),
+                "norm_key": norm_key
+            })
+
+        if not values:
+            return {}
+
+        # The update makes RETURNING give back the existing row on conflict, and fills in identifiers it was missing, bumping the version when it does; xmax is 0 only for freshly inserted rows
+        stmt = insert(cls).values(list(values.values()))
+        fills_identifier = db.or_(
+            db.and_(cls.ol_edition_key == None, stmt.excluded.ol_edition_key != None),
+            db.and_(cls.isbn13 == None, stmt.excluded.isbn13 != None))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.norm_key],
+            set_={
+                "norm_key": stmt.excluded.norm_key,
+                "ol_edition_key": db.func.coalesce(cls.ol_edition_key, stmt.excluded.ol_edition_key),
+                "isbn13": db.func.coalesce(cls.isbn13, stmt.excluded.isbn13),
+                "version": db.case((fills_identifier, cls.version + 1), else_=cls.version)
+            }
+        ).returning(cls.norm_key, cls.id, db.literal_column("xmax = 0"))
+
+        return {norm_key: (book_id, created) for norm_key, book_id, created in db.session.execute(stmt)}
+
+    @classmethod
+    def find_data(cls, ol_edition_key=None, isbn13=None):
+        """Return the catalog's copy of a book as a transform_book_res dict, looked up by edition key or ISBN-13. None if it isn't in the catalog."""
+
+        column, value = (cls.ol_edition_key, ol_edition_key) if ol_edition_key else (cls.isbn13, isbn13)
+        if not value:
+            return None
+
+        row = (db.session.query(cls.title, cls.author, cls.image, cls.num_pages, cls.publish_date, cls.ol_edition_key, cls.isbn13)
+               .filter(column == value)
+               .first())
+
+        return row._asdict() if row else None
+
+    @classmethod
+    def add_edition_key(cls, isbn13, ol_edition_key):
+        """Store the edition key a book was found under by its ISBN-13, if it doesn't have one yet, so the next lookup by that key is answered from the catalog"""
+
+        db.session.execute(db.update(cls)
+                           .where(cls.isbn13 == isbn13, cls.ol_edition_key == None)
+                           .values(ol_edition_key=ol_edition_key, version=cls.version + 1)
+                           .execution_options(synchronize_session=False))
+
+    @classmethod
+    def matching(cls, search):
+        """Return a filter for books whose title or author contains search (case insensitive)"""
+
+        search = search.lower()
+        return db.or_(
+            db.func.lower(cls.title).contains(search, autoescape=True),
+            db.func.lower(cls.author).contains(search, autoescape=True))
+
 
 
 class Club(db.Model):
@@ -103,13 +319,108 @@ class Club(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(20), nullable=False, unique=True) 
 
+    # Bumped whenever something shown on the club page changes; cached fragments of the page are keyed by it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
     # Map directly to reads (important for finding current book)
     reads = db.relationship('Read', overlaps="books,clubs", cascade="all, delete-orphan")
 
     # Map directly to memberships (important for seeing join dates of users)
     memberships = db.relationship('Membership', overlaps="clubs,users", cascade="all, delete-orphan")
 
-    meetings = db.relationship('Meeting', backref="clubs", cascade="all, delete-orphan")
+    meetings = db.relationship('Meeting', backref="clubs", cascade="all, delete-orphan", order_by="Meeting.starts_at, Meeting.id")
+
+    @classmethod
+    def bump_version(cls, *club_ids):
+        """Mark these clubs' pages as changed, so anything cached from them is rebuilt. Members' profiles are keyed on their clubs' versions, so they follow."""
+
+        db.session.execute(db.update(cls)
+                           .where(cls.id.in_(club_ids))
+                           .values(version=cls.version + 1)
+                           .execution_options(synchronize_session=False))
+
+    @classmethod
+    def bump_member_clubs(cls, user_id):
+        """Bump the version of every club the user belongs to, e.g. when their username changes"""
+
+        club_ids = db.select(Membership.club_id).where(Membership.user_id == user_id)
+        db.session.execute(db.update(cls)
+                           .where(cls.id.in_(club_ids))
+                           .values(version=cls.version + 1)
+                           .execution_options(synchronize_session=False))
+
+    def has_member(self, user_id):
+        """Return True if the user belongs to this club. Uses an EXISTS on memberships' primary key, so the cost doesn't grow with club size."""
+
+        return Membership.exists(user_id, self.id)
+
+    def has_members(self):
+        """Return True if anyone belongs to this club"""
+
+        return db.session.query(db.exists().where(Membership.club_id == self.id)).scalar()
+
+    def unshelved_books(self, search=None):
+        """Return a query for books the club hasn't added yet, as a NOT EXISTS anti-join against reads"""
+
+        query = Book.query.filter(~db.exists().where(Read.book_id == Book.id, Read.club_id == self.id))
+
+        if search:
+            query = query.filter(Book.matching(search))
+
+        return query
+
+    def current_books(self):
+        """Return the book(s) the club is currently reading"""
+
+        return Book.query.join(Read, Read.book_id == Book.id).filter(Read.club_id == self.id, Read.current == True).all()
+
+    def shelves(self):
+        """Sort the club's books into current, unfinished and finished shelves using a single query"""
+
+        shelves = {"current": [], "unfinished": [], "finished": []}
+
+        rows = (db.session.query(Book, Read.current, Read.complete)
+                .join(Read, Read.book_id == Book.id)
+                .filter(Read.club_id == self.id)
+                .order_by(Book.id)
+                .all())
+
+        for book, current, complete in rows:
+            if current:
+                shelves["current"].append(book)
+            elif complete:
+                shelves["finished"].append(book)
+            else:
+                shelves["unfinished"].append(book)
+
+        return shelves
+
+    def roster(self):
+        """Group the club's members by role using a single query. Members are (id, username) rows, not full Users."""
+
+        roster = {"admins": [], "mods": [], "members": [], "admin_ids": set(), "mod_ids": set(), "member_ids": set()}
+
+        rows = (db.session.query(User.id, User.username, Membership.admin, Membership.moderator)
+                .join(Membership, Membership.user_id == User.id)
+                .filter(Membership.club_id == self.id)
+                .order_by(User.username)
+                .all())
+
+        for row in rows:
+            roster["member_ids"].add(row.id)
+            if row.admin:
+                roster["admin_ids"].add(row.id)
+                roster["admins"].append(row)
+            elif row.moderator:
+                roster["mod_ids"].add(row.id)
+                roster["mods"].append(row)
+            else:
+                roster["members"].append(row)
+            # Admins can also hold the moderator flag
+            if row.moderator:
+                roster["mod_ids"].add(row.id)
+
+        return roster
 
 
 
@@ -118,8 +429,14 @@ class Meeting(db.Model):
 
     __tablename__ = "meetings"
 
+    # Serves a club's meetings in date order, and a range of them from any time on. It leads with club_id, so it covers lookups by club too.
+    __table_args__ = (
+        db.Index("ix_meetings_club_id_starts_at", "club_id", "starts_at"),
+    )
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    date = db.Column(db.String, nullable=False)
+    # None only for meetings whose free-form date couldn't be read when this column replaced it; they sort last and are never upcoming
+    starts_at = db.Column(db.DateTime(timezone=True))
     topic = db.Column(db.String, nullable=False)
     url = db.Column(db.String, nullable=False)
     club_id = db.Column(db.Integer, db.ForeignKey('clubs.id', ondelete="cascade"))
@@ -127,6 +444,40 @@ class Meeting(db.Model):
     # Map meeting to related notes
     notes = db.relationship('Note', backref="meeting")
 
+    def member_notes(self):
+        """Return (note, username) pairs for the notes current club members left for this meeting, using a single query"""
+
+        return (db.session.query(Note, User.username)
+                .join(User, User.id == Note.user_id)
+                .join(Membership, db.and_(Membership.user_id == Note.user_id, Membership.club_id == self.club_id))
+                .filter(Note.meeting_id == self.id)
+                .order_by(Note.id)
+                .all())
+
+    @classmethod
+    def upcoming(cls, user_id, limit, after=None):
+        """Return the next limit meetings across all of the user's clubs, as rows with the club's name, soonest first.
+
+        Each club's meetings are read with a range scan of (club_id, starts_at) from after (now by default) that stops at limit rows, so past meetings are never touched. Only the few rows that come back from every club are sorted."""
+
+        after = after or datetime.now(timezone.utc)
+
+        clubs = db.session.query(Membership.club_id).filter(Membership.user_id == user_id).subquery()
+        next_meetings = (db.session.query(cls.id, cls.starts_at, cls.topic, cls.url, cls.club_id)
+                         .filter(cls.club_id == clubs.c.club_id, cls.starts_at >= after)
+                         .order_by(cls.starts_at)
+                         .limit(limit)
+                         .subquery()
+                         .lateral())
+
+        return (db.session.query(next_meetings, Club.name.label("club_name"))
+                .select_from(clubs)
+                .join(next_meetings, db.true())
+                .join(Club, Club.id == next_meetings.c.club_id)
+                .order_by(next_meetings.c.starts_at, next_meetings.c.id)
+                .limit(limit)
+                .all())
+
 
 
 class Note(db.Model):
@@ -137,9 +488,9 @@ class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     text = db.Column(db.Text)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), nullable=False)
-    meeting_id = db.Column(db.Integer, db.ForeignKey('meetings.id', ondelete="SET NULL"))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), nullable=False, index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), nullable=False, index=True)
+    meeting_id = db.Column(db.Integer, db.ForeignKey('meetings.id', ondelete="SET NULL"), index=True)
 
 
 
@@ -153,8 +504,13 @@ class Read(db.Model):
 
     __tablename__ = "reads"
 
+    # The primary key already serves lookups by club. Clubs' current books are found through a partial index holding just those rows.
+    __table_args__ = (
+        db.Index("ix_reads_current", "club_id", postgresql_where=db.text("current"), sqlite_where=db.text("current")),
+    )
+
     club_id = db.Column(db.Integer, db.ForeignKey('clubs.id', ondelete="cascade"), primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True, index=True)
 
     current = db.Column(db.Boolean)
     complete = db.Column(db.Boolean)
@@ -162,6 +518,15 @@ class Read(db.Model):
     clubs = db.relationship("Club", overlaps="books,clubs")
     books = db.relationship("Book", overlaps="books,clubs")
 
+    # Labels for the values of status_rank()
+    STATUSES = {0: "Currently reading", 1: "To read", 2: "Finished"}
+
+    @classmethod
+    def status_rank(cls):
+        """SQL expression sorting reads by status: 0 current, 1 to read, 2 finished"""
+
+        return db.case((cls.current == True, 0), (cls.complete == True, 2), else_=1)
+
 
 
 class Membership(db.Model):
@@ -169,8 +534,14 @@ class Membership(db.Model):
 
     __tablename__ = "memberships"
 
+    # The primary key leads with user_id, so rosters need their own index. Admins and moderators are a handful of rows per club, found through partial indexes.
+    __table_args__ = (
+        db.Index("ix_memberships_admins", "club_id", postgresql_where=db.text("admin"), sqlite_where=db.text("admin")),
+        db.Index("ix_memberships_moderators", "club_id", postgresql_where=db.text("moderator"), sqlite_where=db.text("moderator")),
+    )
+
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
-    club_id = db.Column(db.Integer, db.ForeignKey('clubs.id', ondelete="cascade"), primary_key=True)
+    club_id = db.Column(db.Integer, db.ForeignKey('clubs.id', ondelete="cascade"), primary_key=True, index=True)
 
     join_date = db.Column(db.Date)
     admin = db.Column(db.Boolean, default=False)
@@ -179,6 +550,32 @@ class Membership(db.Model):
     clubs = db.relationship("Club", overlaps="memberships,clubs,users")
     users = db.relationship("User", overlaps="memberships,clubs,users",)
 
+    @classmethod
+    def exists(cls, user_id, club_id):
+        """Return True if a membership exists for this user and club, without loading it"""
+
+        if user_id is None:
+            return False
+
+        return db.session.query(db.exists().where(cls.user_id == user_id, cls.club_id == club_id)).scalar()
+
+
+
+class ClubRole:
+    """A user's standing in a single club, built from their Membership (or None if they aren't a member)"""
+
+    def __init__(self, membership=None):
+        self.membership = membership
+        self.is_member = membership is not None
+        self.is_admin = bool(membership and membership.admin)
+        self.is_mod = bool(membership and membership.moderator)
+
+    @property
+    def can_manage(self):
+        """Admins and moderators may add books and schedule meetings"""
+
+        return self.is_admin or self.is_mod
+
 
 
 
@@ -190,3 +587,9 @@ class Favorite(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="cascade"), primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete="cascade"), primary_key=True)
 
+    @classmethod
+    def exists(cls, user_id, book_id):
+        """Return True if the user has favorited the book, with an EXISTS on the primary key"""
+
+        return db.session.query(db.exists().where(cls.user_id == user_id, cls.book_id == book_id)).scalar()
+
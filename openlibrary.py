@@ -0,0 +1,276 @@
+from hashlib import sha1
+from urllib.parse import quote
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import TTLCache
+
+OPEN_LIB_URL = "https://openlibrary.org"
+
+# Most bibkeys the api/books endpoint is asked for in one request
+BIBKEYS_PER_REQUEST = 50
+
+# Results per page of a search, and the search.json fields needed to build them
+SEARCH_PAGE_SIZE = 10
+SEARCH_FIELDS = "key,cover_i,title,author_name,seed,cover_edition_key"
+COVERS_URL = "https://covers.openlibrary.org/b/id/"
+
+
+class OpenLibraryError(Exception):
+    """OpenLibrary couldn't be reached or sent back something unusable"""
+
+
+class OpenLibraryNotFound(OpenLibraryError):
+    """OpenLibrary answered 404 for the thing asked for"""
+
+
+class DiskCache:
+    """Optional second cache tier: one JSON file per key, so cached responses survive restarts and are shared between workers"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, sha1(key.encode("utf8")).hexdigest() + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry["expires"] < time.time():
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        # Write to a temp file and rename, so other workers never read a half written entry
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"expires": time.time() + self.ttl, "value": value}, f)
+        os.replace(tmp, self._file(key))
+
+
+class InFlight:
+    """An upstream call other threads can wait on instead of making their own"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class OpenLibraryClient:
+    """Client for the OpenLibrary endpoints BookTalk uses.
+
+    Requests share one pooled Session, have strict connect/read timeouts and are retried a few times with backoff. Responses are cached by edition ID and ISBN in an in-process LRU, plus an on-disk tier if OPENLIBRARY_CACHE_DIR is set (see config.py). Searches get their own shorter lived LRU. Identical lookups made at the same time share one upstream call."""
+
+    def __init__(self, app=None):
+        self.configure()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            base_url=app.config["OPEN_LIB_URL"],
+            timeout=(app.config["OPENLIBRARY_CONNECT_TIMEOUT"], app.config["OPENLIBRARY_READ_TIMEOUT"]),
+            retries=app.config["OPENLIBRARY_RETRIES"],
+            cache_size=app.config["OPENLIBRARY_CACHE_SIZE"],
+            cache_ttl=app.config["OPENLIBRARY_CACHE_TTL"],
+            cache_dir=app.config["OPENLIBRARY_CACHE_DIR"],
+            search_cache_size=app.config["OPENLIBRARY_SEARCH_CACHE_SIZE"],
+            search_cache_ttl=app.config["OPENLIBRARY_SEARCH_CACHE_TTL"])
+
+    def configure(self, base_url=OPEN_LIB_URL, timeout=(2, 5), retries=2, cache_size=2048, cache_ttl=24 * 60 * 60, cache_dir=None, pool_size=10, search_cache_size=1024, search_cache_ttl=60 * 60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.disk = DiskCache(cache_dir, cache_ttl) if cache_dir else None
+        self.search_cache = TTLCache(maxsize=search_cache_size, ttl=search_cache_ttl)
+
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def get_json(self, path, params=None):
+        """GET a path on OpenLibrary and return the decoded JSON, raising OpenLibraryNotFound on a 404 and OpenLibraryError on any other failure"""
+
+        try:
+            res = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+            if res.status_code == 404:
+                raise OpenLibraryNotFound(f"{path} not found")
+            res.raise_for_status()
+            return res.json()
+        except (requests.RequestException, ValueError) as e:
+            raise OpenLibraryError(str(e)) from e
+
+    def cached(self, key, fetch, cache=None):
+        """Return the cached value for key, calling fetch() and caching its result on a miss.
+
+        Pass cache to use an in-process cache other than the default one; those entries aren't written to disk."""
+
+        disk = self.disk if cache is None else None
+        cache = self.cache if cache is None else cache
+
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        if disk:
+            value = disk.get(key)
+            if value is not None:
+                cache.set(key, value)
+                return value
+
+        # If another thread is already fetching this key, wait for its result
+        with self.lock:
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = InFlight()
+
+        if not leader:
+            return call.wait()
+
+        try:
+            value = call.value = fetch()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call.done.set()
+
+        # Don't cache misses; the book may show up upstream later
+        if value is not None:
+            cache.set(key, value)
+            if disk:
+                disk.set(key, value)
+
+        return value
+
+    def edition(self, edition_id):
+        """Return the edition record for an OpenLibrary edition ID (e.g. OL7353617M), or None if OpenLibrary doesn't know it"""
+
+        def fetch():
+            try:
+                return self.get_json(f"/books/{quote(edition_id)}.json")
+            except OpenLibraryNotFound:
+                return None
+
+        return self.cached(f"edition:{edition_id}", fetch)
+
+    def book_by_isbn(self, isbn):
+        """Return the `jscmd=data` record for an ISBN, or None if OpenLibrary doesn't know it"""
+
+        return self.books([f"ISBN:{isbn}"]).get(f"ISBN:{isbn}")
+
+    def books(self, bibkeys):
+        """Return `jscmd=data` records for many bibkeys (ISBN:... or OLID:...) as a dict; unknown keys are left out.
+
+        Cached keys are answered locally; the rest are fetched BIBKEYS_PER_REQUEST at a time."""
+
+        found = {}
+        missing = []
+        for bibkey in dict.fromkeys(bibkeys):
+            value = self.cache.get(f"bibkey:{bibkey}")
+            if value is None and self.disk:
+                value = self.disk.get(f"bibkey:{bibkey}")
+                if value is not None:
+                    self.cache.set(f"bibkey:{bibkey}", value)
+            if value is None:
+                missing.append(bibkey)
+            else:
+                found[bibkey] = value
+
+        for i in range(0, len(missing), BIBKEYS_PER_REQUEST):
+            chunk = missing[i:i + BIBKEYS_PER_REQUEST]
+            data = self.get_json("/api/books", params={"bibkeys": ",".join(chunk), "format": "json", "jscmd": "data"})
+
+            for bibkey in chunk:
+                if bibkey in data:
+                    found[bibkey] = data[bibkey]
+                    self.cache.set(f"bibkey:{bibkey}", data[bibkey])
+                    if self.disk:
+                        self.disk.set(f"bibkey:{bibkey}", data[bibkey])
+
+        return found
+
+    def search(self, query, by="title", page=1):
+        """Return one page of an OpenLibrary title or author search as {"books": [...], "total": n}.
+
+        Each book is trimmed to what the search page shows: its edition id, title, first author and cover URL."""
+
+        query = " ".join(query.casefold().split())
+        params = {
+            "q" if by == "title" else "author": query,
+            "page": page,
+            "limit": SEARCH_PAGE_SIZE,
+            "fields": SEARCH_FIELDS,
+            "mode": "everything"
+        }
+
+        def fetch():
+            data = self.get_json("/search.json", params=params)
+            books = [book for book in map(trim_search_doc, data.get("docs", [])) if book["id"]]
+            return {"books": books, "total": data.get("numFound", 0)}
+
+        return self.cached(f"search:{by}:{page}:{query}", fetch, cache=self.search_cache)
+
+
+def trim_search_doc(doc):
+    """Keep only the fields of a search.json doc that the search page uses"""
+
+    # The first seed is the edition the search matched, which is what the transform route looks up
+    seeds = [seed[len("/books/"):] for seed in doc.get("seed", []) if seed.startswith("/books/")]
+    edition_id = seeds[0] if seeds else doc.get("cover_edition_key")
+
+    return {
+        "id": edition_id,
+        "title": doc.get("title", "Title not available"),
+        "author": (doc.get("author_name") or ["Author not available"])[0],
+        "cover": f"{COVERS_URL}{doc['cover_i']}-M.jpg" if doc.get("cover_i") else None
+    }
+
+
+def to_bibkey(key):
+    """Turn an edition key (OL7353617M, /books/OL7353617M) or ISBN-10/13 into an api/books bibkey. Return None if it's neither."""
+
+    key = key.strip()
+    edition = re.fullmatch(r"(?:OLID:|/books/)?(OL\d+M)", key, re.IGNORECASE)
+    if edition:
+        return f"OLID:{edition.group(1).upper()}"
+
+    isbn = re.sub(r"[\s-]", "", re.sub(r"^ISBN:?", "", key, flags=re.IGNORECASE))
+    if re.fullmatch(r"\d{9}[\dXx]|\d{13}", isbn):
+        return f"ISBN:{isbn.upper()}"
+
+    return None
+
+
+openlibrary = OpenLibraryClient()
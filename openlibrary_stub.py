@@ -0,0 +1,137 @@
+"""Local stand-in for the OpenLibrary endpoints BookTalk uses, for offline tests and benchmarks."""
+
+# run it like:
+#
+#    python openlibrary_stub.py 5001
+#
+# then start the app with OPEN_LIB_URL=http://localhost:5001
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+import json
+import sys
+import time
+
+SAMPLE_BOOKS = {
+    "OL7353617M": {
+        "isbn_13": "9780261102217",
+        "title": "The Hobbit",
+        "authors": [{"name": "J.R.R. Tolkien"}],
+        "cover": {"medium": "https://covers.openlibrary.org/b/id/6979861-M.jpg"},
+        "number_of_pages": 310,
+        "publish_date": "1937"
+    },
+    "OL24364628M": {
+        "isbn_13": "9780765326355",
+        "title": "The Way of Kings",
+        "authors": [{"name": "Brandon Sanderson"}],
+        "number_of_pages": 1007,
+        "publish_date": "2010"
+    }
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves /books/<edition>.json, /api/books?bibkeys=ISBN:...,OLID:... and /search.json from the server's books, plus cover images at /b/id/<id>-M.jpg"""
+
+    def do_GET(self):
+        server = self.server
+        server.hits += 1
+        time.sleep(server.delay)
+
+        url = urlparse(self.path)
+
+        if url.path.startswith("/books/") and url.path.endswith(".json"):
+            edition_id = url.path[len("/books/"):-len(".json")]
+            book = server.books.get(edition_id)
+            if book is None:
+                return self.send_json({"error": "notfound"}, status=404)
+            return self.send_json({"key": f"/books/{edition_id}", "isbn_13": [book["isbn_13"]], "title": book["title"]})
+
+        if url.path == "/api/books":
+            bibkeys = parse_qs(url.query).get("bibkeys", [""])[0].split(",")
+            by_key = {}
+            for edition_id, book in server.books.items():
+                data = {**book, "key": f"/books/{edition_id}", "identifiers": {"openlibrary": [edition_id], "isbn_13": [book["isbn_13"]]}}
+                by_key[f"ISBN:{book['isbn_13']}"] = by_key[f"OLID:{edition_id}"] = data
+            return self.send_json({key: by_key[key] for key in bibkeys if key in by_key})
+
+        if url.path == "/search.json":
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            field, query = ("title", params["q"]) if "q" in params else ("authors", params.get("author", ""))
+            page, limit = int(params.get("page", 1)), int(params.get("limit", 100))
+
+            docs = [{
+                "key": f"/works/{edition_id[:-1]}W",
+                "title": book["title"],
+                "author_name": [author["name"] for author in book["authors"]],
+                "seed": [f"/books/{edition_id}", f"/works/{edition_id[:-1]}W"]
+            } for edition_id, book in server.books.items()
+                if query.lower() in (book["title"] if field == "title" else book["authors"][0]["name"]).lower()]
+
+            return self.send_json({"numFound": len(docs), "docs": docs[(page - 1) * limit:page * limit]})
+
+        if url.path.startswith("/b/id/"):
+            from PIL import Image
+
+            # A plain 600x900 cover, coloured by the cover id
+            cover_id = int(url.path[len("/b/id/"):].split("-")[0])
+            data = BytesIO()
+            Image.new("RGB", (600, 900), (cover_id % 256, 80, 120)).save(data, "jpeg")
+            body = data.getvalue()
+
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+
+        self.send_json({"error": "notfound"}, status=404)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer:
+    """Run the stub on a free local port in a background thread. Use as a context manager; `url` is the base URL to point the client at."""
+
+    def __init__(self, books=SAMPLE_BOOKS, delay=0, port=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+        self.httpd.books = books
+        self.httpd.delay = delay
+        self.httpd.hits = 0
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    @property
+    def hits(self):
+        return self.httpd.hits
+
+    def __enter__(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    with StubServer(port=port) as stub:
+        print(f"OpenLibrary stub listening on {stub.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,107 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+import binascii
+import json
+
+from sqlalchemy import literal, tuple_
+
+PER_PAGE = 24
+
+
+def encode_cursor(values):
+    """Turn the sort values of the last item on a page into an opaque, url safe cursor"""
+
+    values = [v.isoformat() if isinstance(v, (date, datetime)) else str(v) if isinstance(v, Decimal) else v for v in values]
+    return urlsafe_b64encode(json.dumps(values).encode("utf8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, columns):
+    """Return the sort values stored in a cursor, converted to the types of columns, or None if it is missing, was tampered with or doesn't fit columns"""
+
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        return None
+
+    try:
+        return [coerce(value, col.type) for col, value in zip(columns, values)]
+    except (TypeError, ValueError, InvalidOperation):
+        return None
+
+def coerce(value, type_):
+    """Convert a value read from a cursor to the python type of a column, raising TypeError or ValueError if it can't be one"""
+
+    try:
+        python_type = type_.python_type
+    except NotImplementedError:
+        python_type = None
+
+    # bool is an int in python, but never a valid id or title
+    if value is None or isinstance(value, (bool, dict, list)):
+        raise TypeError(f"{value!r} isn't a sort value")
+
+    if python_type is None:
+        return value
+    if python_type is int and isinstance(value, int):
+        return value
+    if python_type is float and isinstance(value, (int, float)):
+        return float(value)
+    if python_type is Decimal and isinstance(value, (str, int, float)):
+        value = Decimal(str(value))
+        if not value.is_finite():
+            raise ValueError(f"{value!r} isn't a sort value")
+        return value
+    if python_type is str and isinstance(value, str):
+        return value
+    if python_type in (date, datetime) and isinstance(value, str):
+        return python_type.fromisoformat(value)
+
+    raise TypeError(f"{value!r} isn't a {python_type.__name__}")
+
+
+class Page:
+    """One page of keyset paginated results"""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def paginate(query, order_by, cursor=None, per_page=PER_PAGE):
+    """Return the page of query results that comes after cursor.
+
+    order_by is a list of columns, ending in a unique one (usually the id) so the sort is stable. Rather than OFFSET, the page starts with a `(col1, col2...) > (last values)` comparison, so every page costs the same no matter how deep into the results it is."""
+
+    query = query.order_by(*order_by)
+
+    # A cursor that doesn't fit the sort, from an old link or typed by hand, starts over at the first page rather than failing in the database
+    after = decode_cursor(cursor, order_by)
+    if after is not None:
+        after = [literal(value, type_=col.type) for col, value in zip(order_by, after)]
+        query = query.filter(tuple_(*order_by) > tuple_(*after))
+
+    items = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, col.key) for col in order_by])
+
+    return Page(items, next_cursor)
@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+import os
+
+import bcrypt
+
+
+def _hash(pwd, rounds):
+    """Hash pwd with the given bcrypt cost. Runs inside the worker pool."""
+
+    return bcrypt.hashpw(pwd.encode("utf8"), bcrypt.gensalt(rounds)).decode("utf8")
+
+def _check(pwd_hash, pwd):
+    """Check pwd against a stored bcrypt hash. Runs inside the worker pool."""
+
+    return bcrypt.checkpw(pwd.encode("utf8"), pwd_hash.encode("utf8"))
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a small pool of worker processes.
+
+    bcrypt is deliberately slow, so running it on the request thread lets a burst of logins pin every worker. Here the work happens in at most PASSWORD_POOL_SIZE processes, and at most PASSWORD_POOL_QUEUE jobs may be waiting on them at once. A pool size of 0 runs bcrypt inline.
+
+    The cost factor comes from BCRYPT_LOG_ROUNDS. Hashes made at any other cost are upgraded by User.authenticate on the next successful login."""
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.pool_size = 0
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            rounds=app.config["BCRYPT_LOG_ROUNDS"],
+            pool_size=app.config["PASSWORD_POOL_SIZE"],
+            queue_size=app.config["PASSWORD_POOL_QUEUE"])
+
+    def configure(self, rounds=12, pool_size=0, queue_size=None):
+        """Set the work factor and pool size, shutting down any running pool"""
+
+        self.shutdown()
+        self.rounds = rounds
+        self.pool_size = pool_size
+        self._slots = BoundedSemaphore(queue_size or max(pool_size, 1))
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+            self._pool_pid = None
+
+    def _get_pool(self):
+        # gunicorn forks workers after import, so each process builds its own pool on first use
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.pool_size)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if self.pool_size <= 0:
+            return fn(*args)
+
+        with self._slots:
+            return self._get_pool().submit(fn, *args).result()
+
+    def hash(self, pwd, rounds=None):
+        """Return a utf8 bcrypt hash of pwd at the configured (or given) cost"""
+
+        return self._run(_hash, pwd, rounds or self.rounds)
+
+    def check(self, pwd_hash, pwd):
+        """Return True if pwd matches pwd_hash"""
+
+        return self._run(_check, pwd_hash, pwd)
+
+    def needs_rehash(self, pwd_hash):
+        """Return True if pwd_hash was made with a cost other than the configured one"""
+
+        try:
+            return int(pwd_hash.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
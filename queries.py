@@ -0,0 +1,142 @@
+"""Per-request SQL statistics and N+1 query detection."""
+
+# Every statement run on any engine is recorded by whichever recorders are active in the current thread. QueryCounter keeps one per request, and in dev (QUERY_STATS) reports it in X-Query-Count and Server-Timing headers, and in the log.
+# Tests use record_queries() to look at what a block ran, or strict_queries() to fail it on the wrong number of statements or an N+1 pattern.
+
+from collections import Counter
+from contextlib import contextmanager
+import re
+import threading
+import time
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# A statement shape repeating more than this many times in one request is reported as N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+_active = threading.local()
+
+
+def statement_shape(statement):
+    """Statement text with bind parameters collapsed, so lookups that only differ in their values or IN list length match"""
+
+    return re.sub(r"%\(\w+\)s(\s*,\s*%\(\w+\)s)*", "?", " ".join(statement.split()))
+
+
+class QueryStats:
+    """Statements run, and the time spent on them, while recording"""
+
+    def __init__(self):
+        self.statements = []
+        self.db_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.statements.append(statement)
+        self.db_time += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Return (shape, times) for every statement shape that ran more than threshold times, most repeated first"""
+
+        return [(shape, times) for shape, times in self.shapes.most_common() if times > threshold]
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    for stats in getattr(_active, "recorders", ()):
+        stats.record(statement, duration)
+
+
+def start_recording():
+    """Return a new QueryStats that records statements run in this thread until passed to stop_recording()"""
+
+    stats = QueryStats()
+    _active.__dict__.setdefault("recorders", []).append(stats)
+    return stats
+
+def stop_recording(stats):
+    _active.recorders.remove(stats)
+
+@contextmanager
+def record_queries():
+    """Record every statement run in this thread inside the block into a QueryStats"""
+
+    stats = start_recording()
+    try:
+        yield stats
+    finally:
+        stop_recording(stats)
+
+@contextmanager
+def strict_queries(count=None, threshold=N_PLUS_ONE_THRESHOLD):
+    """Like record_queries(), but raise AssertionError if the block runs other than count statements (when given), or any statement shape more than threshold times"""
+
+    with record_queries() as stats:
+        yield stats
+
+    if count is not None and stats.count != count:
+        raise AssertionError(f"Expected {count} queries, ran {stats.count}:\n" + "\n".join(stats.statements))
+
+    repeated = stats.repeated(threshold)
+    if repeated:
+        raise AssertionError("N+1 queries:\n" + "\n".join(f"{times}x {shape}" for shape, times in repeated))
+
+
+class QueryCounter:
+    """With QUERY_STATS set, records the statements each request runs, reports their count and DB time in response headers and the log, and warns about N+1 queries"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUERY_STATS", False)
+        app.config.setdefault("QUERY_N_PLUS_ONE_THRESHOLD", N_PLUS_ONE_THRESHOLD)
+
+        if not app.config["QUERY_STATS"]:
+            return
+
+        app.before_request(self.start)
+        app.after_request(self.report)
+        app.teardown_request(self.stop)
+
+    def start(self):
+        g.query_stats = start_recording()
+
+    def stop(self, exc=None):
+        stats = g.pop("query_stats", None)
+        if stats is not None:
+            stop_recording(stats)
+
+    def report(self, resp):
+        stats = g.get("query_stats")
+        if stats is None:
+            return resp
+
+        db_ms = stats.db_time * 1000
+        resp.headers["X-Query-Count"] = str(stats.count)
+        resp.headers.add("Server-Timing", f'db;dur={db_ms:.1f};desc="{stats.count} queries"')
+        current_app.logger.info("%s %s: %d queries, %.1fms in the database", request.method, request.path, stats.count, db_ms)
+
+        for shape, times in stats.repeated(current_app.config["QUERY_N_PLUS_ONE_THRESHOLD"]):
+            current_app.logger.warning("Possible N+1 on %s %s, ran %d times: %s", request.method, request.path, times, shape)
+
+        return resp
+
+
+query_counter = QueryCounter()
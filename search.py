@@ -0,0 +1,83 @@
+from sqlalchemy import DDL, event, literal_column
+
+from models import db, Book, fold_text
+from pagination import PER_PAGE, Page, paginate
+
+# Longest search we'll turn into a query; anything past this is ignored
+MAX_TERMS = 8
+
+
+########################################################################
+# Indexes
+#
+# Searches run against Book.norm_key, which already has case, accents and punctuation folded out. On Postgres its tsvector is stored in search_vector (so ranking doesn't re-parse every match) with a GIN index. A trigger fills the column in rather than it being generated, because adding a generated column rewrites the whole table (see migration 0005). On SQLite (local development) it's an FTS5 table kept in sync by triggers.
+
+SEARCH_VECTOR_TRIGGER = [
+    """CREATE OR REPLACE FUNCTION books_search_vector() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('simple', NEW.norm_key);
+        RETURN NEW;
+    END $$""",
+    "DROP TRIGGER IF EXISTS books_search_vector ON books",
+    "CREATE TRIGGER books_search_vector BEFORE INSERT OR UPDATE OF norm_key ON books FOR EACH ROW EXECUTE FUNCTION books_search_vector()"]
+
+for statement in [
+    "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    *SEARCH_VECTOR_TRIGGER,
+    "CREATE INDEX IF NOT EXISTS ix_books_search ON books USING gin (search_vector)"]:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(norm_key, content='books', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, norm_key) VALUES (new.id, new.norm_key);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, norm_key) VALUES ('delete', old.id, old.norm_key);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, norm_key) VALUES ('delete', old.id, old.norm_key);
+        INSERT INTO books_fts(rowid, norm_key) VALUES (new.id, new.norm_key);
+    END"""]:
+    event.listen(Book.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(Book.__table__, "before_drop", DDL("DROP TABLE IF EXISTS books_fts").execute_if(dialect="sqlite"))
+
+
+########################################################################
+# Queries
+
+
+def search_terms(search):
+    """Split a search into folded terms, each of which will be prefix matched"""
+
+    return fold_text(search).split()[:MAX_TERMS]
+
+def search_books(search, cursor=None, per_page=PER_PAGE):
+    """Return a page of books whose title or author match every term in search, best matches first"""
+
+    terms = search_terms(search)
+    if not terms:
+        return Page([])
+
+    query = db.session.query(Book.id, Book.title, Book.author, Book.image)
+
+    if db.engine.dialect.name == "sqlite":
+        match = " ".join(f'"{term}"*' for term in terms)
+
+        # bm25 is lower for better matches
+        fts = db.table("books_fts", db.column("rowid"))
+        rank = literal_column("bm25(books_fts)", type_=db.Float).label("rank")
+        query = (query.add_columns(rank)
+                 .join(fts, fts.c.rowid == Book.id)
+                 .filter(literal_column("books_fts").op("MATCH")(match)))
+
+    else:
+        vector = literal_column("books.search_vector")
+        tsquery = db.func.to_tsquery(literal_column("'simple'"), " & ".join(f"{term}:*" for term in terms))
+
+        # Negate ts_rank so best matches sort first. ts_rank is a float4, which doesn't survive the trip through a cursor exactly, so books tied on rank would be skipped or repeated across pages; rounding it to a numeric gives a value that does.
+        rank = (-db.func.round(db.cast(db.func.ts_rank(vector, tsquery), db.Numeric), 6, type_=db.Numeric)).label("rank")
+        query = query.add_columns(rank).filter(vector.op("@@")(tsquery))
+
+    return paginate(query, [rank, Book.id], cursor=cursor, per_page=per_page)
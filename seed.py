@@ -1,11 +1,16 @@
 """Seed file to make sample data for Users db."""
 
+from datetime import datetime, timezone
 from models import Meeting, db, User, Club, Book, Membership, Read, Note, Favorite
-from app import app
+from app import create_app
+from migrations import stamp
 
-# Create all tables
+app = create_app()
+
+# Create all tables, already at the latest migration
 db.drop_all()
 db.create_all()
+stamp()
 
 #### Users ########################################################
 
@@ -121,24 +126,28 @@ db.session.commit()
 # If table isn't empty, empty it
 Meeting.query.delete()
 
-meeting1 = Meeting(date="9/20/21", topic="Harry Potter and the Prisoner of Azkaban", club_id=c1.id, url="https://www.google.com")
-meeting2 = Meeting(date="9/30/21", topic="Harry Potter and the Goblet of Fire", club_id=c1.id, url="https://www.google.com")
-meeting3 = Meeting(date="9/20/21", topic="The Hobbit", club_id=c2.id, url="https://www.google.com")
-meeting4 = Meeting(date="9/30/21", topic="The Fellowship of the Ring", club_id=c2.id, url="https://www.google.com")
-meeting5 = Meeting(date="9/21/21", topic="Words of Radiance", club_id=c3.id, url="https://www.google.com")
-meeting6 = Meeting(date="9/21/21", topic="The Silent Patient", club_id=c4.id, url="https://www.google.com")
-meeting7 = Meeting(date="9/30/21", topic="Man's Search for Meaning", club_id=c5.id, url="https://www.google.com")
+sept20 = datetime(2021, 9, 20, 19, tzinfo=timezone.utc)
+sept21 = datetime(2021, 9, 21, 19, tzinfo=timezone.utc)
+sept30 = datetime(2021, 9, 30, 19, tzinfo=timezone.utc)
+
+meeting1 = Meeting(starts_at=sept20, topic="Harry Potter and the Prisoner of Azkaban", club_id=c1.id, url="https://www.google.com")
+meeting2 = Meeting(starts_at=sept30, topic="Harry Potter and the Goblet of Fire", club_id=c1.id, url="https://www.google.com")
+meeting3 = Meeting(starts_at=sept20, topic="The Hobbit", club_id=c2.id, url="https://www.google.com")
+meeting4 = Meeting(starts_at=sept30, topic="The Fellowship of the Ring", club_id=c2.id, url="https://www.google.com")
+meeting5 = Meeting(starts_at=sept21, topic="Words of Radiance", club_id=c3.id, url="https://www.google.com")
+meeting6 = Meeting(starts_at=sept21, topic="The Silent Patient", club_id=c4.id, url="https://www.google.com")
+meeting7 = Meeting(starts_at=sept30, topic="Man's Search for Meaning", club_id=c5.id, url="https://www.google.com")
 
 db.session.add_all([meeting1, meeting2, meeting3, meeting4, meeting5, meeting6, meeting7])
 db.session.commit()
 
-mtg1 = db.session.query(Meeting).filter( Meeting.date == "9/20/21", Meeting.club_id == c1.id).first()
-mtg2 = db.session.query(Meeting).filter( Meeting.date == "9/30/21", Meeting.club_id == c1.id).first()
-mtg3 = db.session.query(Meeting).filter( Meeting.date == "9/20/21", Meeting.club_id == c2.id).first()
-mtg4 = db.session.query(Meeting).filter( Meeting.date == "9/30/21", Meeting.club_id == c2.id).first()
-mtg5 = db.session.query(Meeting).filter( Meeting.date == "9/21/21", Meeting.club_id == c3.id).first()
-mtg6 = db.session.query(Meeting).filter( Meeting.date == "9/21/21", Meeting.club_id == c4.id).first()
-mtg7 = db.session.query(Meeting).filter( Meeting.date == "9/30/21", Meeting.club_id == c5.id).first()
+mtg1 = db.session.query(Meeting).filter( Meeting.starts_at == sept20, Meeting.club_id == c1.id).first()
+mtg2 = db.session.query(Meeting).filter( Meeting.starts_at == sept30, Meeting.club_id == c1.id).first()
+mtg3 = db.session.query(Meeting).filter( Meeting.starts_at == sept20, Meeting.club_id == c2.id).first()
+mtg4 = db.session.query(Meeting).filter( Meeting.starts_at == sept30, Meeting.club_id == c2.id).first()
+mtg5 = db.session.query(Meeting).filter( Meeting.starts_at == sept21, Meeting.club_id == c3.id).first()
+mtg6 = db.session.query(Meeting).filter( Meeting.starts_at == sept21, Meeting.club_id == c4.id).first()
+mtg7 = db.session.query(Meeting).filter( Meeting.starts_at == sept30, Meeting.club_id == c5.id).first()
 
 ## Notes #######################################################
 
@@ -1,51 +1,49 @@
-const OPEN_LIB_URL = "https://openlibrary.org";
-const COVERS_URL = "https://covers.openlibrary.org/b/id/";
-// TO-DO: Find way to have this change depending on whether the app is running locally or deployed
-const SERVER_URL = "https://connor-booktalk.herokuapp.com/";
+// Searches go through BookTalk's /api/books/search proxy, which caches popular searches and trims results to what generateBook needs
+let currentSearch = {};
 
 $("#search-form").on("submit", async function(evt) {
 	evt.preventDefault();
 
 	$("#results-list").empty();
 
-	const subject = $("#subject").val();
-	const query = $("#search").val();
-	let parameters = {};
+	currentSearch = {
+		q: $("#search").val(),
+		by: $("#subject").val(),
+		page: 1
+	};
+	await showResults();
+});
 
-	if (subject === "title") {
-		parameters = {
-			q: query,
-			limit: 10,
-			fields: "key,cover_i,title,author_name,name,seed",
-			mode: "everything"
-		};
-	} else {
-		parameters = {
-			author: query,
-			limit: 10,
-			fields: "key,cover_i,title,author_name,name,seed",
-			mode: "everything"
-		};
-	}
-	const res = await axios.get(`${OPEN_LIB_URL}/search.json`, {
-		params: parameters
+$("#more-results").on("click", async function(evt) {
+	evt.preventDefault();
+	await showResults();
+});
+
+async function showResults() {
+	const res = await axios.get("/api/books/search", {
+		params: currentSearch
 	});
 
-	for (let bookData of res.data.docs) {
+	for (let bookData of res.data.books) {
 		book = $(generateBook(bookData));
 		$("#results-list").append(book);
 	}
-});
+
+	// Show the button for the next page only if OpenLibrary has more results
+	currentSearch.page = res.data.next;
+	$("#more-results").prop("hidden", !res.data.next);
+}
 
 function generateBook(book) {
-	// Use the first seed for bookID, this way it will correspond to the bookdata and have details for the ISBN
-	const bookID = book["seed"][0].slice(7);
+	// The id is the edition that matched the search, so it will correspond to the bookdata and have details for the ISBN
+	const bookID = book["id"];
+	const cover = book["cover"] || "/static/images/placeholder.png";
 
 	return `<div class="book-tag" data-id=${bookID}> 
-	<img src="${COVERS_URL}${book["cover_i"]}-M/jpg" alt="No image available" class="cover-image"> <li> Title: ${book[
-		"title"
-	]} </li> <li> Author: ${book["author_name"][0]} 
-	<form method="POST" action="${SERVER_URL}/books/${bookID}/transform" class="form-inline col">
+	<img src="${cover}" alt="No image available" class="cover-image"> <li> Title: ${book["title"]} </li> <li> Author: ${book[
+		"author"
+	]} 
+	<form method="POST" action="/books/${bookID}/transform" class="form-inline col">
 	<button class="btn btn-outline-success">Details</button>
 	</form></div> `;
 }
@@ -61,6 +59,6 @@ function generateBook(book) {
 // 	console.log(bookID);
 
 // 	// Post the URL to the add book route on the server where it will be sent and then transformed into a BookTalk object, and then redirect to a new page where the book object can be added to the database
-// 	const res = await axios.post(`${SERVER_URL}/books/transform`, { bookID });
+// 	const res = await axios.post(`/books/transform`, { bookID });
 // 	console.log(res);
 // });
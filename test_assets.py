@@ -0,0 +1,75 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import gzip
+import os
+
+from flask import url_for
+from PIL import Image
+
+from app import create_app
+from assets import assets, build
+
+app = create_app("test")
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(assets.configure, app.static_folder)
+
+        static = self.tmp.name
+        os.makedirs(os.path.join(static, "css"))
+        os.makedirs(os.path.join(static, "images"))
+
+        self.css = b"body { color: #127780; }\n" * 100
+        with open(os.path.join(static, "css", "styles.css"), "wb") as f:
+            f.write(self.css)
+        Image.new("RGB", (2000, 1000), (18, 119, 128)).save(os.path.join(static, "images", "big.png"))
+        with open(os.path.join(static, "images", "mockups.pptx"), "wb") as f:
+            f.write(b"not served")
+
+        self.manifest = build(static, report=lambda msg: None)
+        assets.configure(static)
+
+    def test_build(self):
+        """Assets are fingerprinted, images shrunk, text precompressed, and design files left out"""
+
+        self.assertRegex(self.manifest["css/styles.css"], r"^css/styles\.[0-9a-f]{8}\.css$")
+        self.assertNotIn("images/mockups.pptx", self.manifest)
+
+        built = os.path.join(self.tmp.name, "dist", self.manifest["css/styles.css"])
+        with gzip.open(f"{built}.gz") as f:
+            self.assertEqual(f.read(), self.css)
+
+        image = Image.open(os.path.join(self.tmp.name, "dist", self.manifest["images/big.png"]))
+        self.assertEqual(image.size, (800, 400))
+
+    def test_serve(self):
+        """url_for links to built assets, which are served precompressed and cached forever"""
+
+        with app.test_request_context():
+            url = url_for("static", filename="css/styles.css")
+            self.assertEqual(url, f"/static/dist/{self.manifest['css/styles.css']}")
+            self.assertEqual(url_for("static", filename="css/missing.css"), "/static/css/missing.css")
+
+        with app.test_client() as c:
+            resp = c.get(url, headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertEqual(resp.mimetype, "text/css")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(gzip.decompress(resp.data), self.css)
+
+            resp = c.get(url)
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertEqual(resp.data, self.css)
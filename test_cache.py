@@ -0,0 +1,60 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import TTLCache
+
+
+class TTLCacheTestCase(TestCase):
+    """Test TTLCache eviction and expiry"""
+
+    def test_get_set(self):
+        """Stored values come back until popped"""
+
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIn("a", cache)
+
+        cache.pop("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_lru_eviction(self):
+        """Least recently used entry is evicted once the cache is full"""
+
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_expiry(self):
+        """Entries expire after ttl seconds"""
+
+        cache = TTLCache(maxsize=2, ttl=10)
+
+        with patch("cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("cache.time.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+    def test_disabled(self):
+        """A ttl of 0 turns the cache off"""
+
+        cache = TTLCache(maxsize=2, ttl=0)
+        cache.set("a", 1)
+
+        self.assertNotIn("a", cache)
@@ -0,0 +1,43 @@
+"""Meeting time parsing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dates.py
+
+
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from dates import parse_datetime, format_datetime
+
+
+class DatesTestCase(TestCase):
+    """Test reading typed dates and showing them"""
+
+    def test_parse_datetime(self):
+        """The ways people write dates all read the same, and anything else is None"""
+
+        sept20 = datetime(2021, 9, 20, 19, tzinfo=timezone.utc)
+        for text in ["2021-09-20T19:00", "2021-09-20 19:00Z", "2021-09-20T21:00:00+02:00", "9/20/21 7pm", "09/20/2021 7:00 PM",
+                     "Monday, Sept 20th 2021 at 7 p.m.", "20 September 2021 19:00", "Sep 20, 2021 @ 7:00pm"]:
+            self.assertEqual(parse_datetime(text), sept20, text)
+
+        self.assertEqual(parse_datetime("9/20/21"), datetime(2021, 9, 20, tzinfo=timezone.utc))
+        self.assertEqual(parse_datetime("Oct 3 8pm", today=datetime(2030, 1, 1)), datetime(2030, 10, 3, 20, tzinfo=timezone.utc))
+        self.assertIsNone(parse_datetime("Oct 3 8pm", assume_year=False))
+
+        # Feb 29 is only a date in leap years
+        for text in ["Feb 29", "2/29", "February 29th 7pm"]:
+            self.assertEqual(parse_datetime(text, today=datetime(2028, 1, 1)).date(), datetime(2028, 2, 29).date(), text)
+            self.assertIsNone(parse_datetime(text, today=datetime(2027, 1, 1)), text)
+        self.assertEqual(parse_datetime("9/20/21 7pm", tz=timezone(timedelta(hours=-4))), sept20 + timedelta(hours=4))
+
+        for text in ["", "Friday", "next week", "13/45/21"]:
+            self.assertIsNone(parse_datetime(text), text)
+
+    def test_format_datetime(self):
+        """Times are shown in UTC, and midnight is left out"""
+
+        self.assertEqual(format_datetime(datetime(2021, 9, 20, 21, 30, tzinfo=timezone(timedelta(hours=2)))), "Mon, Sep 20 2021, 7:30 PM UTC")
+        self.assertEqual(format_datetime(datetime(2021, 9, 20, tzinfo=timezone.utc)), "Mon, Sep 20 2021")
+        self.assertEqual(format_datetime(None), "Date to be announced")
@@ -0,0 +1,111 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dbpool.py
+
+
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+
+from app import create_app
+from config import TestConfig
+from dbpool import engine_options, pool_metrics
+
+app = create_app("test")
+
+
+def db_settings(**overrides):
+    settings = {key: getattr(TestConfig, key) for key in dir(TestConfig) if key.startswith("DB_") or key == "SQLALCHEMY_DATABASE_URI"}
+    settings.update(overrides)
+    return settings
+
+def make_engine(**overrides):
+    return create_engine(TestConfig.SQLALCHEMY_DATABASE_URI, **engine_options(db_settings(**overrides)))
+
+
+class DBPoolTestCase(TestCase):
+    """Test pool settings and metrics"""
+
+    def setUp(self):
+        pool_metrics.reset()
+
+    def test_statement_timeout(self):
+        """Statement timeout is set for the whole session when connecting directly"""
+
+        engine = make_engine(DB_STATEMENT_TIMEOUT=1500)
+        self.addCleanup(engine.dispose)
+
+        with engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SHOW statement_timeout").scalar(), "1500ms")
+
+    def test_sqlite_statement_timeout(self):
+        """SQLite engines ignore the timeout rather than failing to connect"""
+
+        settings = db_settings(SQLALCHEMY_DATABASE_URI="sqlite://", DB_STATEMENT_TIMEOUT=1500)
+        self.assertNotIn("connect_args", engine_options(settings))
+
+        engine = create_engine("sqlite://", **engine_options(settings))
+        self.addCleanup(engine.dispose)
+
+        with engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT 1").scalar(), 1)
+
+    def test_pgbouncer_statement_timeout(self):
+        """Behind PgBouncer the timeout is set per transaction, and never left on the server connection"""
+
+        engine = make_engine(DB_STATEMENT_TIMEOUT=1500, DB_PGBOUNCER=True, DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0)
+        self.addCleanup(engine.dispose)
+        self.assertNotIn("connect_args", engine_options(db_settings(DB_PGBOUNCER=True)))
+
+        with engine.begin() as conn:
+            self.assertEqual(conn.exec_driver_sql("SHOW statement_timeout").scalar(), "1500ms")
+
+        # The same pooled connection, outside any transaction the app started
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SHOW statement_timeout")
+            self.assertEqual(cursor.fetchone()[0], "0")
+        finally:
+            raw.close()
+
+    def test_metrics(self):
+        """Checkouts, overflow and timeouts are counted"""
+
+        engine = make_engine(DB_POOL_SIZE=1, DB_MAX_OVERFLOW=1, DB_POOL_TIMEOUT=0.1)
+        self.addCleanup(engine.dispose)
+
+        first = engine.connect()
+        second = engine.connect()
+        with self.assertRaises(TimeoutError):
+            engine.connect()
+
+        metrics = pool_metrics.snapshot(engine.pool)
+        self.assertEqual(metrics["checkouts"], 2)
+        self.assertEqual(metrics["overflows"], 1)
+        self.assertEqual(metrics["timeouts"], 1)
+        self.assertEqual(metrics["checked_out"], 2)
+        self.assertGreaterEqual(metrics["wait_ms_max"], 100)
+
+        first.close()
+        second.close()
+        self.assertEqual(pool_metrics.snapshot(engine.pool)["checked_out"], 0)
+
+    def test_metrics_endpoint(self):
+        """Metrics are only served with the configured token"""
+
+        client = app.test_client()
+        self.assertEqual(client.get("/api/metrics/db").status_code, 404)
+
+        app.config["METRICS_TOKEN"] = "secret"
+        self.addCleanup(app.config.__setitem__, "METRICS_TOKEN", None)
+
+        self.assertEqual(client.get("/api/metrics/db", headers={"Authorization": "Bearer wrong"}).status_code, 404)
+
+        resp = client.get("/api/metrics/db", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("checked_out", resp.json)
+        self.assertGreaterEqual(resp.json["pool_size"], 1)
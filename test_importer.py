@@ -0,0 +1,137 @@
+"""Dump importer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_importer.py
+
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import gzip
+import json
+import os
+
+from models import db, Book
+from app import create_app
+from importer import import_dump, save_checkpoint, backfill_identifiers
+from openlibrary import openlibrary
+from openlibrary_stub import StubServer
+
+app = create_app("test")
+
+db.create_all()
+
+
+def dump_line(record_type, key, record):
+    return "\t".join([record_type, key, "1", "2021-01-01T00:00:00", json.dumps(record)]) + "\n"
+
+SAMPLE_DUMP = [
+    dump_line("/type/edition", "/books/OL1M", {"key": "/books/OL1M", "isbn_13": ["9780261102217"], "title": "The Hobbit", "by_statement": "J.R.R. Tolkien", "covers": [6979861], "number_of_pages": 310, "publish_date": "1937"}),
+    dump_line("/type/author", "/authors/OL1A", {"name": "J.R.R. Tolkien"}),
+    dump_line("/type/edition", "/books/OL2M", {"title": "The Hobbit!", "by_statement": "JRR Tolkien", "publish_date": "1951"}),
+    "not a dump line\n",
+    dump_line("/type/edition", "/books/OL3M", {"title": "No Author Here", "publish_date": "2000"}),
+    dump_line("/type/edition", "/books/OL4M", {"title": "The Way of Kings", "by_statement": "Brandon Sanderson", "number_of_pages": "1007 p.", "publish_date": "2010"}),
+    dump_line("/type/work", "/works/OL5W", {"title": "Mistborn", "by_statement": "Brandon Sanderson", "covers": [-1]}),
+    dump_line("/type/edition", "/books/OL6M", {"title": "Elantris", "by_statement": "Brandon Sanderson", "publish_date": "", "isbn_13": [""]}),
+]
+
+
+class ImporterTestCase(TestCase):
+    """Test streaming a dump into the books table"""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dump = os.path.join(self.tmp.name, "editions.txt.gz")
+        with gzip.open(self.dump, "wt", encoding="utf8") as f:
+            f.writelines(SAMPLE_DUMP)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_import(self):
+        """Books are transformed, deduplicated and loaded by either method, and re-runs add nothing"""
+
+        for method in ("copy", "insert"):
+            totals = import_dump(self.dump, batch_size=2, method=method, report=lambda msg: None)
+            self.assertEqual(totals["records"], 6)
+
+        self.assertEqual(Book.query.count(), 4)
+
+        hobbit = Book.query.filter_by(norm_key=Book.make_key("The Hobbit", "J.R.R. Tolkien")).one()
+        self.assertEqual(hobbit.image, "https://covers.openlibrary.org/b/id/6979861-M.jpg")
+        self.assertEqual(hobbit.publish_date, "1937")
+        self.assertEqual((hobbit.ol_edition_key, hobbit.isbn13), ("OL1M", "9780261102217"))
+
+        kings = Book.query.filter_by(title="The Way of Kings").one()
+        self.assertIsNone(kings.num_pages)
+        self.assertEqual(Book.query.filter_by(title="Mistborn").one().image, "/static/images/placeholder.png")
+
+        # An empty publish date would be a NULL to COPY
+        elantris = Book.query.filter_by(title="Elantris").one()
+        self.assertEqual((elantris.publish_date, elantris.isbn13), ("Publish date not available", None))
+
+    def test_authors(self):
+        """Records that only link their authors by key are named from the authors dump"""
+
+        authors = os.path.join(self.tmp.name, "authors.txt")
+        with open(authors, "w", encoding="utf8") as f:
+            f.writelines([
+                dump_line("/type/author", "/authors/OL1A", {"key": "/authors/OL1A", "name": "Ursula K. Le Guin"}),
+                dump_line("/type/author", "/authors/OL2A", {"key": "/authors/OL2A"}),
+                dump_line("/type/redirect", "/authors/OL3A", {"location": "/authors/OL1A"})])
+
+        with gzip.open(self.dump, "wt", encoding="utf8") as f:
+            f.writelines([
+                dump_line("/type/edition", "/books/OL1M", {"title": "A Wizard of Earthsea", "authors": [{"key": "/authors/OL1A"}], "publish_date": "1968"}),
+                dump_line("/type/work", "/works/OL2W", {"title": "The Dispossessed", "authors": [{"type": {"key": "/type/author_role"}, "author": {"key": "/authors/OL1A"}}]}),
+                dump_line("/type/work", "/works/OL3W", {"title": "Nameless", "authors": [{"author": {"key": "/authors/OL2A"}}]})])
+
+        totals = import_dump(self.dump, batch_size=2, authors=authors, report=lambda msg: None)
+
+        self.assertEqual(totals["inserted"], 2)
+        self.assertEqual({(book.title, book.author) for book in Book.query},
+                         {("A Wizard of Earthsea", "Ursula K. Le Guin"), ("The Dispossessed", "Ursula K. Le Guin")})
+
+        # The lookup table is scratch space for one import
+        self.assertIsNone(db.session.execute(db.text("SELECT to_regclass('import_authors')")).scalar())
+
+        # Without the authors dump they can't be told apart
+        Book.query.delete()
+        db.session.commit()
+        self.assertEqual(import_dump(self.dump, report=lambda msg: None)["inserted"], 0)
+
+    def test_resume(self):
+        """A run with a checkpoint starts after the last committed line and records its own progress"""
+
+        checkpoint = os.path.join(self.tmp.name, "import.checkpoint")
+        save_checkpoint(checkpoint, self.dump, 4)
+
+        totals = import_dump(self.dump, batch_size=2, checkpoint=checkpoint, report=lambda msg: None)
+
+        self.assertEqual(totals["records"], 4)
+        self.assertEqual({book.title for book in Book.query}, {"The Way of Kings", "Mistborn", "Elantris"})
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)["line"], 8)
+
+    def test_backfill(self):
+        """Books without identifiers get them from an exact OpenLibrary match"""
+
+        db.session.add_all([
+            Book(title="The Hobbit", author="J.R.R. Tolkien", publish_date="1937"),
+            Book(title="The Hobbit", author="Bilbo Baggins", publish_date="1937")])
+        db.session.commit()
+
+        with StubServer() as stub:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            self.assertEqual(backfill_identifiers(report=lambda msg: None), 1)
+
+        hobbit = Book.query.filter_by(author="J.R.R. Tolkien").one()
+        self.assertEqual((hobbit.ol_edition_key, hobbit.isbn13, hobbit.version), ("OL7353617M", "9780261102217", 2))
+        self.assertIsNone(Book.query.filter_by(author="Bilbo Baggins").one().ol_edition_key)
@@ -0,0 +1,156 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+from datetime import datetime, timezone
+from unittest import TestCase
+
+from app import create_app
+import migrations
+from models import db, Book, Read, Note, Meeting, Favorite
+from migrations import MIGRATIONS, execute, status, upgrade
+
+app = create_app("test")
+
+
+def schema():
+    """Every column and index of the app's tables"""
+
+    tables = [table.name for table in db.metadata.sorted_tables]
+    columns = db.session.execute(db.text(
+        "SELECT table_name, column_name, data_type, is_nullable FROM information_schema.columns WHERE table_name = ANY(:tables)"), {"tables": tables})
+    indexes = db.session.execute(db.text("SELECT indexdef FROM pg_indexes WHERE tablename = ANY(:tables)"), {"tables": tables})
+    return {tuple(column) for column in columns}, {index for index, in indexes}
+
+
+class MigrationsTestCase(TestCase):
+    """Test bringing an old database up to the current schema"""
+
+    def setUp(self):
+        db.drop_all()
+        db.session.execute(db.text("DROP TABLE IF EXISTS schema_migrations"))
+        db.session.commit()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def make_old_schema(self):
+        """Strip the columns and indexes the migrations add, as a database from before them would be"""
+
+        for index in ["ix_memberships_club_id", "ix_memberships_admins", "ix_memberships_moderators", "ix_reads_book_id", "ix_reads_current",
+                      "ix_meetings_club_id_starts_at", "ix_notes_meeting_id", "ix_notes_user_id", "ix_notes_book_id", "ix_books_ol_edition_key", "ix_books_isbn13",
+                      "ix_books_title_id"]:
+            db.session.execute(db.text(f"DROP INDEX {index}"))
+        for table in ("users", "clubs", "books"):
+            db.session.execute(db.text(f"ALTER TABLE {table} DROP COLUMN version"))
+        db.session.execute(db.text("DROP TRIGGER books_search_vector ON books"))
+        db.session.execute(db.text("ALTER TABLE books DROP COLUMN search_vector, DROP COLUMN norm_key, DROP COLUMN ol_edition_key, DROP COLUMN isbn13"))
+        db.session.execute(db.text("ALTER TABLE meetings DROP COLUMN starts_at, ADD COLUMN date varchar NOT NULL"))
+        db.session.commit()
+
+    def test_upgrade(self):
+        """Upgrading an old database gives it the same schema as create_all(), merges duplicate books and reads meeting dates"""
+
+        columns, indexes = schema()
+        # Left for the previous release's workers
+        expected = columns | {("meetings", "date", "character varying", "YES")}, indexes
+        db.session.commit()
+        self.make_old_schema()
+
+        db.session.execute(db.text("INSERT INTO users (id, username, password, email, first_name, last_name) VALUES (1, 'reader', 'x', 'r@test.com', 'R', 'R')"))
+        db.session.execute(db.text("INSERT INTO clubs (id, name) VALUES (1, 'Readers')"))
+        db.session.execute(db.text("INSERT INTO books (id, title, author, publish_date) VALUES (1, 'The Hobbit', 'J.R.R. Tolkien', '1937'), (2, 'the hobbit!', 'JRR Tolkien', '1951')"))
+        db.session.execute(db.text("INSERT INTO reads (club_id, book_id, current, complete) VALUES (1, 1, false, false), (1, 2, true, false)"))
+        db.session.execute(db.text("INSERT INTO favorites (user_id, book_id) VALUES (1, 2)"))
+        db.session.execute(db.text("INSERT INTO meetings (id, date, topic, url, club_id) VALUES (1, 'Friday', 'The Hobbit', 'https://meet.example.com', 1), (2, 'Mon 9/20/21 7pm', 'The Hobbit', '', 1), (3, 'Oct 3', 'The Hobbit', '', 1)"))
+        db.session.execute(db.text("INSERT INTO notes (text, user_id, book_id, meeting_id) VALUES ('Riddles!', 1, 2, 1)"))
+        db.session.commit()
+
+        # One row per batch, so the backfills have to page through the tables
+        self.addCleanup(setattr, migrations, "BACKFILL_BATCH", migrations.BACKFILL_BATCH)
+        migrations.BACKFILL_BATCH = 1
+
+        reports = []
+        self.assertEqual(upgrade(db.engine, report=reports.append), [version for version, description, migrate in MIGRATIONS])
+        self.assertIn("Couldn't read the date of meeting 1: 'Friday'", reports)
+        self.assertIn("The date of meeting 3 has no year: 'Oct 3'", reports)
+
+        self.assertEqual(schema(), expected)
+        self.assertEqual([book.id for book in Book.query.all()], [1])
+        self.assertEqual(Book.query.get(1).norm_key, Book.make_key("The Hobbit", "J.R.R. Tolkien"))
+        self.assertEqual(db.session.execute(db.text("SELECT search_vector::text FROM books")).scalar(), "'hobbit':2 'jrr':3 'the':1 'tolkien':4")
+        self.assertEqual([(read.book_id, read.current) for read in Read.query.all()], [(1, False)])
+        self.assertEqual(Favorite.query.one().book_id, 1)
+        self.assertEqual(Note.query.one().book_id, 1)
+        self.assertEqual([meeting.starts_at for meeting in Meeting.query.order_by(Meeting.id)], [None, datetime(2021, 9, 20, 19, tzinfo=timezone.utc), None])
+        db.session.commit()
+
+        # Everything is recorded, so nothing runs twice
+        self.assertTrue(all(done for version, description, done in status(db.engine)))
+        self.assertEqual(upgrade(db.engine, report=lambda msg: None), [])
+
+    def test_generated_search_vector(self):
+        """A database that got search_vector as a generated column keeps its values, and the trigger takes over"""
+
+        columns, indexes = schema()
+        db.session.execute(db.text("INSERT INTO books (id, title, author, publish_date, norm_key) VALUES (1, 'The Hobbit', 'Tolkien', '1937', 'the hobbit|tolkien')"))
+        db.session.execute(db.text("DROP TRIGGER books_search_vector ON books"))
+        db.session.execute(db.text("ALTER TABLE books DROP COLUMN search_vector"))
+        db.session.execute(db.text("ALTER TABLE books ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', norm_key)) STORED"))
+        db.session.execute(db.text("CREATE INDEX ix_books_search ON books USING gin (search_vector)"))
+        db.session.commit()
+
+        migrations.stamp(db.engine)
+        db.session.execute(db.text("DELETE FROM schema_migrations WHERE version = '0005'"))
+        db.session.commit()
+
+        self.assertEqual(upgrade(db.engine, report=lambda msg: None), ["0005"])
+        self.assertEqual(schema(), (columns, indexes))
+
+        db.session.execute(db.text("INSERT INTO books (id, title, author, publish_date, norm_key) VALUES (2, 'Dune', 'Herbert', '1965', 'dune|herbert')"))
+        db.session.execute(db.text("UPDATE books SET norm_key = 'the hobbit|jrr tolkien' WHERE id = 1"))
+        vectors = db.session.execute(db.text("SELECT id, search_vector::text FROM books ORDER BY id")).all()
+        self.assertEqual(vectors, [(1, "'hobbit':2 'jrr':3 'the':1 'tolkien':4"), (2, "'dune':1 'herbert':2")])
+
+    def test_invalid_index_rebuilt(self):
+        """An index left invalid by an interrupted concurrent build is rebuilt"""
+
+        db.session.execute(db.text("DROP INDEX ix_notes_user_id"))
+        db.session.execute(db.text("INSERT INTO users (id, username, password, email, first_name, last_name) VALUES (1, 'reader', 'x', 'r@test.com', 'R', 'R')"))
+        db.session.execute(db.text("INSERT INTO books (id, title, author, publish_date, norm_key) VALUES (1, 'The Hobbit', 'Tolkien', '1937', 'hobbit')"))
+        db.session.execute(db.text("INSERT INTO notes (text, user_id, book_id) VALUES ('one', 1, 1), ('two', 1, 1)"))
+        db.session.commit()
+
+        # A unique build fails on the duplicate user_ids, leaving the index behind but invalid
+        conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        with self.assertRaises(Exception):
+            conn.exec_driver_sql("CREATE UNIQUE INDEX CONCURRENTLY ix_notes_user_id ON notes (user_id)")
+        conn.close()
+
+        upgrade(db.engine, report=lambda msg: None)
+
+        valid = db.session.execute(db.text("SELECT indisvalid FROM pg_index WHERE indexrelid = 'ix_notes_user_id'::regclass")).scalar()
+        self.assertTrue(valid)
+
+    def test_lock_timeout(self):
+        """A statement that can't get its locks gives up instead of waiting behind other transactions"""
+
+        # Hold a lock on users in another transaction
+        db.session.execute(db.text("LOCK TABLE users IN ACCESS SHARE MODE"))
+        self.addCleanup(db.session.rollback)
+
+        conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        self.addCleanup(conn.close)
+
+        for setting, value in {"LOCK_TIMEOUT": "100ms", "LOCK_RETRIES": 2}.items():
+            self.addCleanup(setattr, migrations, setting, getattr(migrations, setting))
+            setattr(migrations, setting, value)
+
+        with self.assertRaisesRegex(Exception, "lock timeout"):
+            execute(conn, "ALTER TABLE users ADD COLUMN nickname text")
@@ -10,6 +10,7 @@ from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Book, Club, Meeting, Note, Read, Membership, Favorite
+from passwords import hasher
 
 # CODE REVIEW QUESTION: The below commented out code was borrowed from the Warbler assignment. However, it didn't work to set up a new database -- why is this?
 
@@ -23,13 +24,10 @@ from models import db, User, Book, Club, Meeting, Note, Read, Membership, Favori
 
 # Now we can import app
 
-from app import app
+from app import create_app
 import pdb
 
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///booktalk_test"
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['TESTING'] = True
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app = create_app("test")
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -159,3 +157,90 @@ class UserModelTestCase(TestCase):
         user = User.authenticate("test1", "wrong_password")
 
         self.assertEqual(user, False)
+
+    def test_user_authenticate_rehash(self):
+        """Does User.authenticate upgrade a hash made with an outdated cost factor?"""
+
+        self.u1.password = hasher.hash("password", rounds=hasher.rounds + 1)
+        db.session.commit()
+
+        user = User.authenticate("testuser1", "password")
+        db.session.commit()
+
+        self.assertFalse(hasher.needs_rehash(user.password))
+        self.assertEqual(User.authenticate("testuser1", "password").id, self.uid1)
+
+    ######################################################
+    # Club membership tests
+
+    def test_club_has_member(self):
+        """Does Club.has_member only report users with a membership?"""
+
+        club = Club(name="Test Club")
+        db.session.add(club)
+        db.session.commit()
+
+        self.assertFalse(club.has_members())
+
+        db.session.add(Membership(user_id=self.uid1, club_id=club.id))
+        db.session.commit()
+
+        self.assertTrue(club.has_members())
+        self.assertTrue(club.has_member(self.uid1))
+        self.assertFalse(club.has_member(self.uid2))
+
+    def test_library_pages_by_index(self):
+        """A page of a club's unshelved books is read in order from the (title, id) index, not sorted out of the whole catalog"""
+
+        club = Club(name="Test Club")
+        db.session.add(club)
+        db.session.commit()
+
+        query = club.unshelved_books().with_entities(Book.id, Book.title).order_by(Book.title, Book.id)
+        query = query.filter(db.tuple_(Book.title, Book.id) > db.tuple_(db.literal("M"), db.literal(0))).limit(25)
+
+        # The tables are tiny, so keep the planner from sorting them just because it's cheap
+        db.session.execute(db.text("SET LOCAL enable_sort = off"))
+        plan = "\n".join(row[0] for row in db.session.execute(db.text("EXPLAIN " + str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})))))
+
+        self.assertIn("ix_books_title_id", plan)
+        self.assertNotIn("Sort", plan)
+
+    ######################################################
+    # Book tests
+
+    def test_book_get_or_create(self):
+        """Does Book.get_or_create return the existing book for a trivially different spelling?"""
+
+        data = {"title": "The Hobbit", "author": "J.R.R. Tolkien", "image": None, "num_pages": 310, "publish_date": "1937"}
+
+        book_id, created = Book.get_or_create(data)
+        self.assertTrue(created)
+
+        same_id, created = Book.get_or_create({**data, "title": "the  HOBBIT!", "author": "JRR Tolkien"})
+        self.assertFalse(created)
+        self.assertEqual(same_id, book_id)
+
+        other_id, created = Book.get_or_create({**data, "author": "Someone Else"})
+        self.assertTrue(created)
+        self.assertNotEqual(other_id, book_id)
+
+        db.session.commit()
+        self.assertEqual(Book.query.count(), 2)
+
+    def test_book_version(self):
+        """Filling in a book's missing identifiers bumps its version; finding it again doesn't"""
+
+        data = {"title": "The Hobbit", "author": "J.R.R. Tolkien", "image": None, "num_pages": 310, "publish_date": "1937"}
+        book_id, created = Book.get_or_create(data)
+        db.session.commit()
+        self.assertEqual(Book.query.get(book_id).version, 1)
+
+        Book.get_or_create({**data, "isbn13": "9780261102217"})
+        Book.get_or_create({**data, "isbn13": "9780000000000"})
+        Book.get_or_create(data)
+        db.session.commit()
+        db.session.expire_all()
+
+        book = Book.query.get(book_id)
+        self.assertEqual((book.isbn13, book.version), ("9780261102217", 2))
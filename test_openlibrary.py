@@ -0,0 +1,123 @@
+"""OpenLibrary client tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_openlibrary.py
+
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from openlibrary import OpenLibraryClient, OpenLibraryError, to_bibkey
+from openlibrary_stub import StubServer
+
+
+class OpenLibraryClientTestCase(TestCase):
+    """Test OpenLibraryClient against the local stub server"""
+
+    def test_edition_and_isbn(self):
+        """Edition and ISBN lookups return the upstream records"""
+
+        with StubServer() as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url)
+
+            edition = client.edition("OL7353617M")
+            book = client.book_by_isbn(edition["isbn_13"][0])
+
+            self.assertEqual(book["title"], "The Hobbit")
+            self.assertIsNone(client.book_by_isbn("0000000000000"))
+
+    def test_cached(self):
+        """Repeat lookups are answered from the cache"""
+
+        with StubServer() as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url)
+
+            client.edition("OL7353617M")
+            client.edition("OL7353617M")
+            client.book_by_isbn("9780261102217")
+            client.book_by_isbn("9780261102217")
+
+            self.assertEqual(stub.hits, 2)
+
+    def test_disk_cache(self):
+        """A fresh client reuses responses cached on disk by another"""
+
+        with StubServer() as stub, TemporaryDirectory() as cache_dir:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url, cache_dir=cache_dir)
+            client.edition("OL7353617M")
+
+            other = OpenLibraryClient()
+            other.configure(base_url=stub.url, cache_dir=cache_dir)
+            other.edition("OL7353617M")
+
+            self.assertEqual(stub.hits, 1)
+
+    def test_errors(self):
+        """Slow responses raise OpenLibraryError; missing editions are None"""
+
+        with StubServer(delay=0.5) as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url, timeout=(1, 0.1), retries=0)
+
+            with self.assertRaises(OpenLibraryError):
+                client.edition("OL7353617M")
+
+        with StubServer() as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url, retries=0)
+
+            self.assertIsNone(client.edition("OL0M"))
+
+    def test_books(self):
+        """Many bibkeys are fetched in batches, and only uncached ones go upstream"""
+
+        with StubServer() as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url)
+
+            books = client.books(["OLID:OL7353617M", "ISBN:9780765326355", "ISBN:0000000000000"])
+            self.assertEqual(books["OLID:OL7353617M"]["title"], "The Hobbit")
+            self.assertEqual(books["ISBN:9780765326355"]["title"], "The Way of Kings")
+            self.assertNotIn("ISBN:0000000000000", books)
+            self.assertEqual(stub.hits, 1)
+
+            client.books(["OLID:OL7353617M", "OLID:OL24364628M"])
+            self.assertEqual(stub.hits, 2)
+            client.books(["OLID:OL7353617M", "OLID:OL24364628M"])
+            self.assertEqual(stub.hits, 2)
+
+    def test_to_bibkey(self):
+        """Edition keys and ISBNs are turned into bibkeys; anything else is rejected"""
+
+        self.assertEqual(to_bibkey("/books/ol7353617m"), "OLID:OL7353617M")
+        self.assertEqual(to_bibkey("978-0-261-10221-7"), "ISBN:9780261102217")
+        self.assertEqual(to_bibkey("ISBN:026110221x"), "ISBN:026110221X")
+        self.assertIsNone(to_bibkey("OL123W"))
+        self.assertIsNone(to_bibkey("hobbit"))
+
+    def test_search(self):
+        """Searches are trimmed, cached, and identical concurrent searches share one upstream call"""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with StubServer(delay=0.2) as stub:
+            client = OpenLibraryClient()
+            client.configure(base_url=stub.url)
+
+            with ThreadPoolExecutor(max_workers=4) as threads:
+                results = list(threads.map(lambda query: client.search(query), ["Hobbit", "hobbit", " hobbit ", "HOBBIT"]))
+
+            self.assertEqual(stub.hits, 1)
+            self.assertEqual(results[0]["total"], 1)
+            self.assertEqual(results[0]["books"], [{"id": "OL7353617M", "title": "The Hobbit", "author": "J.R.R. Tolkien", "cover": None}])
+
+            client.search("hobbit")
+            self.assertEqual(stub.hits, 1)
+
+            self.assertEqual(client.search("sanderson", by="author")["books"][0]["id"], "OL24364628M")
+            self.assertEqual(client.search("hobbit", page=2)["books"], [])
+            self.assertEqual(stub.hits, 3)
@@ -0,0 +1,85 @@
+"""Query instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_queries.py
+
+
+from unittest import TestCase
+
+from app import create_app, CURR_USER_KEY, user_cache
+from config import TestConfig
+from models import db, User
+from queries import record_queries, strict_queries, statement_shape
+
+
+class QueryStatsConfig(TestConfig):
+    QUERY_STATS = True
+
+app = create_app("test")
+
+
+class QueriesTestCase(TestCase):
+    """Test query recording and N+1 detection"""
+
+    def lookup(self, times):
+        for user_id in range(times):
+            db.session.execute(db.text("SELECT id FROM users WHERE id = :id"), {"id": user_id})
+
+    def test_statement_shape(self):
+        """Statements that only differ in values or IN list length have the same shape"""
+
+        self.assertEqual(
+            statement_shape("SELECT * FROM books WHERE id IN (%(id_1_1)s, %(id_1_2)s)"),
+            statement_shape("SELECT *\nFROM books WHERE id IN (%(id_1_1)s)"))
+
+    def test_record_queries(self):
+        """Every statement in the block is recorded, with its time"""
+
+        with record_queries() as stats:
+            self.lookup(3)
+
+        self.assertEqual(stats.count, 3)
+        self.assertGreater(stats.db_time, 0)
+        self.assertEqual(stats.repeated(2), [("SELECT id FROM users WHERE id = ?", 3)])
+
+    def test_strict_queries(self):
+        """Strict mode fails on the wrong query count or a repeated statement"""
+
+        with strict_queries(2):
+            self.lookup(2)
+
+        with self.assertRaisesRegex(AssertionError, "Expected 1 queries, ran 2"):
+            with strict_queries(1):
+                self.lookup(2)
+
+        with self.assertRaisesRegex(AssertionError, "N\\+1 queries:\n6x SELECT id FROM users"):
+            with strict_queries():
+                self.lookup(6)
+
+    def test_request_stats(self):
+        """With QUERY_STATS on, responses report their queries and N+1 patterns are logged"""
+
+        stats_app = create_app(QueryStatsConfig)
+        self.addCleanup(setattr, db, "app", app)
+        stats_app.config["QUERY_N_PLUS_ONE_THRESHOLD"] = 0
+
+        User.query.delete()
+        user = User(username="counted", password="x", email="c@test.com", first_name="C", last_name="C")
+        db.session.add(user)
+        db.session.commit()
+        user_cache.clear()
+
+        client = stats_app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+        with self.assertLogs(stats_app.logger, "WARNING") as logs:
+            resp = client.get(f"/users/{user.id}")
+
+        self.assertGreaterEqual(int(resp.headers["X-Query-Count"]), 1)
+        self.assertIn("db;dur=", resp.headers["Server-Timing"])
+        self.assertIn("Possible N+1 on GET /users/", logs.output[0])
+
+        # The test profile adds nothing
+        self.assertNotIn("X-Query-Count", app.test_client().get("/login").headers)
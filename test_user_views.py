@@ -6,11 +6,14 @@
 
 
 import os
+import json
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
 from requests.sessions import session
 from sqlalchemy.exc import IntegrityError
 
-from models import Club, db, User, Note, Membership, Favorite
+from models import Club, db, User, Note, Membership, Favorite, Book, Read, Meeting
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,14 +25,14 @@ from models import Club, db, User, Note, Membership, Favorite
 
 # Now we can import app
 
-from app import CURR_USER_KEY, app
+from app import CURR_USER_KEY, create_app, user_cache, fragment_cache
+from openlibrary import openlibrary
+from openlibrary_stub import StubServer
+from queries import record_queries, strict_queries
 import pdb
 
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///booktalk_test"
-app.config['SQLALCHEMY_ECHO'] = False
-
-# For tests of forms to work, need to disable CSRF checking in tests
-app.config['WTF_CSRF_ENABLED'] = False
+# The test profile uses booktalk_test, and disables CSRF checking so forms can be posted
+app = create_app("test")
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -48,6 +51,12 @@ class UserViewsTestCase(TestCase):
         Membership.query.delete()
         Favorite.query.delete()
         Club.query.delete()
+        Read.query.delete()
+        Book.query.delete()
+
+        # Ids get reused between tests, so don't let a cached identity leak across them
+        user_cache.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -167,6 +176,67 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f'<li>Username: { self.testuser.username }</li>', html)
 
+    def test_cached_identity(self):
+        """Logged in user is cached after the first request and dropped when edited"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.get(f"/users/{self.testuser.id}")
+
+            self.assertIn(self.testuser.id, user_cache)
+
+            data = {
+                "username": "CachedUser",
+                "password": "password",
+                "email": "email@email.com",
+                "image": User.image.default.arg,
+                "first_name": "Edit",
+                "last_name": "Edit",
+                "bio": "editedbio"
+            }
+            c.post(f"/users/{self.testuser.id}/edit", data=data)
+
+            self.assertNotIn(self.testuser.id, user_cache)
+
+            c.get("/")
+            self.assertEqual(user_cache.get(self.testuser_id)["username"], "CachedUser")
+
+    def test_stale_identity(self):
+        """A snapshot cached by another worker before the user edited their profile is reloaded, and a cache hit costs no query"""
+
+        data = {
+            "password": "password",
+            "email": "email@email.com",
+            "image": User.image.default.arg,
+            "first_name": "Edit",
+            "last_name": "Edit",
+            "bio": "editedbio"
+        }
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+
+            with strict_queries(0):
+                c.get("/")
+
+            # Another worker still holds the snapshot from before the rename
+            stale = user_cache.get(self.testuser_id)
+            c.post(f"/users/{self.testuser_id}/edit", data={**data, "username": "Renamed"})
+            user_cache.set(self.testuser_id, stale)
+
+            with strict_queries(1):
+                c.get("/")
+            self.assertEqual(user_cache.get(self.testuser_id)["username"], "Renamed")
+
+            user_cache.set(self.testuser_id, stale)
+            resp = c.post(f"/users/{self.testuser_id}/edit", data={**data, "username": "RenamedAgain"}, follow_redirects=True)
+
+            self.assertIn("Successfully updated user information.", resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(self.testuser_id).username, "RenamedAgain")
+
     def test_show_user_edit_form(self):
         """Successfully load user edit form"""
 
@@ -267,3 +337,626 @@ class UserViewsTestCase(TestCase):
 
             self.assertEqual(membership, None)
 
+    def setup_large_club(self, num_reads=1000, num_members=500):
+        """Used to add a club with many books and members to db"""
+
+        club = Club(name="Big Club")
+        books = [Book(title=f"Book {i}", author="Author", publish_date="2021") for i in range(num_reads)]
+        users = [User(username=f"member{i}", password="x", email=f"m{i}@test.com", first_name="M", last_name="M") for i in range(num_members - 1)]
+        db.session.add_all([club, *books, *users])
+        db.session.commit()
+
+        reads = [Read(club_id=club.id, book_id=book.id, current=(i == 0), complete=(i % 2 == 1)) for i, book in enumerate(books)]
+        memberships = [Membership(club_id=club.id, user_id=user.id, moderator=(i < 10)) for i, user in enumerate(users)]
+        memberships.append(Membership(club_id=club.id, user_id=self.testuser_id, admin=True))
+        db.session.add_all(reads + memberships)
+        db.session.commit()
+
+        return club.id
+
+    def test_show_club_page_queries(self):
+        """Club page runs a fixed number of queries no matter how big the club is"""
+
+        club_id = self.setup_large_club()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # user, club, membership, shelves, then meetings and roster for the cached fragments
+            with strict_queries(6):
+                resp = c.get(f"/clubs/{club_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Book 0", html)
+            self.assertIn("member498", html)
+
+            # Member lists and meetings come from the fragment cache now
+            with strict_queries(3):
+                resp = c.get(f"/clubs/{club_id}")
+
+            self.assertEqual(resp.get_data(as_text=True), html)
+
+    def test_club_fragments_invalidated(self):
+        """Changing a club's members or meetings shows up on the next view of its page"""
+
+        club_id = self.setup_large_club(num_reads=1, num_members=3)
+        newbie = User(username="newbie", password="x", email="n@test.com", first_name="N", last_name="N")
+        db.session.add(newbie)
+        db.session.commit()
+        newbie_id = newbie.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            self.assertNotIn("newbie", c.get(f"/clubs/{club_id}").get_data(as_text=True))
+            self.assertIn("No meetings scheduled!", c.get(f"/users/{self.testuser_id}").get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = newbie_id
+            c.post(f"/clubs/{club_id}/join")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            self.assertIn("newbie", c.get(f"/clubs/{club_id}").get_data(as_text=True))
+
+            c.post(f"/clubs/{club_id}/{newbie_id}/toggle_moderator")
+            html = c.get(f"/clubs/{club_id}").get_data(as_text=True)
+            self.assertIn("newbie", html.split("Moderators:")[1].split("Other members:")[0])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = newbie_id
+            self.assertIn("No meetings scheduled!", c.get(f"/users/{newbie_id}").get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            versions = {user.id: user.version for user in User.query}
+            c.post(f"/clubs/{club_id}/meetings/new", data={"starts_at": "2030-01-01 19:00", "topic": "Book 0", "url": ""})
+            self.assertIn("Tue, Jan 1 2030, 7:00 PM UTC", c.get(f"/clubs/{club_id}").get_data(as_text=True))
+            self.assertIn("Tue, Jan 1 2030, 7:00 PM UTC", c.get(f"/users/{self.testuser_id}").get_data(as_text=True))
+
+            # Members' profiles follow the club's version, without a write to each of them
+            self.assertEqual({user.id: user.version for user in User.query}, versions)
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = newbie_id
+            self.assertIn("Tue, Jan 1 2030, 7:00 PM UTC", c.get(f"/users/{newbie_id}").get_data(as_text=True))
+
+    def test_meeting_and_profile_queries(self):
+        """Meeting and profile pages load notes and meetings without a query per member or club"""
+
+        club_id = self.setup_large_club(num_reads=1, num_members=10)
+        book_id = Read.query.filter_by(club_id=club_id).first().book_id
+        meeting = Meeting(club_id=club_id, starts_at=datetime(2030, 1, 1, tzinfo=timezone.utc), topic="Book 0", url="")
+        db.session.add(meeting)
+        db.session.commit()
+        meeting_id = meeting.id
+        db.session.add_all([Note(user_id=membership.user_id, book_id=book_id, meeting_id=meeting_id, text=f"note {i}")
+                            for i, membership in enumerate(Membership.query.filter_by(club_id=club_id))])
+        for i in range(10):
+            db.session.add(Club(name=f"Other {i}"))
+        db.session.commit()
+        db.session.add_all([Membership(club_id=club.id, user_id=self.testuser_id) for club in Club.query.filter(Club.id != club_id)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # user, club, the viewer's membership (reused for the delete button), meeting, notes
+            with strict_queries(5):
+                html = c.get(f"/clubs/{club_id}/meetings/{meeting_id}").get_data(as_text=True)
+            self.assertEqual(html.count("note-card"), 10)
+            self.assertIn("Delete Meeting", html)
+
+            with strict_queries():
+                html = c.get(f"/users/{self.testuser_id}").get_data(as_text=True)
+            self.assertIn("Other 9", html)
+            self.assertIn("Tue, Jan 1 2030", html)
+
+    def test_upcoming_meetings(self):
+        """Upcoming meetings come from every club the user is in, soonest first, from one query"""
+
+        clubs = [Club(name=name) for name in ("Mine", "Also mine", "Not mine")]
+        db.session.add_all(clubs)
+        db.session.commit()
+        db.session.add_all([Membership(club_id=club.id, user_id=self.testuser_id) for club in clubs[:2]])
+
+        now = datetime.now(timezone.utc)
+        for club, days in [(clubs[0], -3), (clubs[0], 20), (clubs[0], 2), (clubs[1], 5), (clubs[1], 1), (clubs[2], 1)]:
+            db.session.add(Meeting(club_id=club.id, starts_at=now + timedelta(days=days), topic=f"{club.name} in {days}", url=""))
+        db.session.commit()
+
+        with self.client as c:
+            self.assertEqual(c.get("/api/meetings/upcoming").status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # The user, then every club's meetings at once
+            with strict_queries(2):
+                resp = c.get("/api/meetings/upcoming?limit=3")
+            self.assertEqual([meeting["topic"] for meeting in resp.json["meetings"]], ["Also mine in 1", "Mine in 2", "Also mine in 5"])
+            self.assertEqual(resp.json["meetings"][0]["club_name"], "Also mine")
+
+    def test_meeting_date_validation(self):
+        """New meetings need a date that can be read"""
+
+        club_id = self.setup_large_club(num_reads=1, num_members=1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/clubs/{club_id}/meetings/new", data={"starts_at": "soon", "topic": "Book 0", "url": ""})
+            self.assertIn("We couldn&#39;t read that date", resp.get_data(as_text=True))
+
+            c.post(f"/clubs/{club_id}/meetings/new", data={"starts_at": "Monday, Sept 20th 2021 at 7pm", "topic": "Book 0", "url": ""})
+            self.assertEqual(Meeting.query.filter_by(club_id=club_id).one().starts_at, datetime(2021, 9, 20, 19, tzinfo=timezone.utc))
+
+    def test_club_page_not_modified(self):
+        """A repeat view of an unchanged club page is a 304 that skips rendering, until the club changes"""
+
+        club_id = self.setup_large_club(num_reads=1, num_members=3)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/clubs/{club_id}")
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith("W/"))
+
+            # Only the club is loaded to compare versions; the user comes from the identity cache
+            with strict_queries(1):
+                resp = c.get(f"/clubs/{club_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            c.post(f"/clubs/{club_id}/meetings/new", data={"starts_at": "2030-01-01 19:00", "topic": "Book 0", "url": ""})
+
+            resp = c.get(f"/clubs/{club_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            # Someone else sees their own version of the page
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = User.query.filter_by(username="member0").one().id
+            resp = c.get(f"/clubs/{club_id}", headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_book_details_not_modified(self):
+        """Book pages change their ETag when favorited, and always render pending flash messages"""
+
+        book = Book(title="Dune", author="Frank Herbert", image="/static/images/placeholder.png", publish_date="1965")
+        db.session.add(book)
+        db.session.commit()
+        book_id = book.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            etag = c.get(f"/books/{book_id}").headers["ETag"]
+            self.assertEqual(c.get(f"/books/{book_id}", headers={"If-None-Match": etag}).status_code, 304)
+
+            # Favoriting redirects back with a flash, which must show even though the page is cached
+            c.post(f"/books/{book_id}/favorite")
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Added!")]
+            resp = c.get(f"/books/{book_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Remove from Favorites", resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_library_requires_mod(self):
+        """Only admins and moderators can open a club's library"""
+
+        self.setup_membership()
+        club = Club.query.first()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/clubs/{club.id}/library")
+            self.assertEqual(resp.status_code, 302)
+
+            membership = Membership.query.get((self.testuser_id, club.id))
+            membership.moderator = True
+            db.session.commit()
+
+            resp = c.get(f"/clubs/{club.id}/library")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_library_pages(self):
+        """Library lists books the club hasn't added, a page at a time"""
+
+        self.setup_membership()
+        club_id = Club.query.first().id
+        Membership.query.get((self.testuser_id, club_id)).admin = True
+
+        books = [Book(title=f"Library Book {i:02}", author="Author", publish_date="2021") for i in range(30)]
+        books.append(Book(title="Shelved Book", author="Author", publish_date="2021"))
+        books.append(Book(title="Other Book", author="Someone Else", publish_date="2021"))
+        db.session.add_all(books)
+        db.session.commit()
+        db.session.add(Read(club_id=club_id, book_id=books[30].id, current=False, complete=False))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/clubs/{club_id}/library")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Library Book 23", html)
+            self.assertNotIn("Library Book 24", html)
+            self.assertNotIn("Shelved Book", html)
+
+            cursor = html.split("?after=")[1].split('"')[0]
+            html = c.get(f"/clubs/{club_id}/library?after={cursor}").get_data(as_text=True)
+
+            self.assertIn("Library Book 24", html)
+            self.assertIn("Library Book 29", html)
+            self.assertNotIn("Library Book 23", html)
+            self.assertNotIn("Next page", html)
+
+            html = c.get(f"/clubs/{club_id}/library?q=someone").get_data(as_text=True)
+
+            self.assertIn("Other Book", html)
+            self.assertNotIn("Library Book", html)
+
+    def test_my_books(self):
+        """My books lists each book from the user's clubs once, optionally grouped"""
+
+        self.setup_membership()
+        club_id = Club.query.first().id
+        other = Club(name="Other Club")
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        db.session.add(Membership(club_id=other_id, user_id=self.testuser_id))
+
+        shared = Book(title="Shared Book", author="Author", publish_date="2021")
+        finished = Book(title="Finished Book", author="Author", publish_date="2021")
+        unread = Book(title="Unread Book", author="Author", publish_date="2021")
+        db.session.add_all([shared, finished, unread])
+        db.session.commit()
+
+        db.session.add_all([
+            Read(club_id=club_id, book_id=shared.id, current=True, complete=False),
+            Read(club_id=other_id, book_id=shared.id, current=False, complete=False),
+            Read(club_id=other_id, book_id=finished.id, current=False, complete=True)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/books/my_books").get_data(as_text=True)
+
+            self.assertEqual(html.count("<h5 class=\"card-title\">Shared Book</h5>"), 1)
+            self.assertIn("Finished Book", html)
+            self.assertNotIn("Unread Book", html)
+
+            html = c.get("/books/my_books?group=club").get_data(as_text=True)
+
+            self.assertEqual(html.count("<h5 class=\"card-title\">Shared Book</h5>"), 2)
+            self.assertLess(html.index("<h3>Other Club</h3>"), html.index("<h3>Test Club</h3>"))
+
+            html = c.get("/books/my_books?group=status").get_data(as_text=True)
+
+            self.assertLess(html.index("<h3>Currently reading</h3>"), html.index("<h3>Finished</h3>"))
+
+    def test_show_clubs(self):
+        """Club list shows each club's current book, a page at a time"""
+
+        clubs = [Club(name=f"Club {i:02}") for i in range(30)]
+        book = Book(title="Current Book", author="Author", publish_date="2021")
+        db.session.add_all([*clubs, book])
+        db.session.commit()
+        db.session.add(Read(club_id=clubs[0].id, book_id=book.id, current=True, complete=False))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = c.get("/clubs").get_data(as_text=True)
+
+            self.assertIn("Currently reading: <b>Current Book</b>", html)
+            self.assertIn("Club 23", html)
+            self.assertNotIn("Club 24", html)
+
+            cursor = html.split("?after=")[1].split('"')[0]
+            html = c.get(f"/clubs?after={cursor}").get_data(as_text=True)
+
+            self.assertIn("Club 29", html)
+            self.assertNotIn("Club 23", html)
+
+    def test_bad_cursor(self):
+        """A cursor whose values don't fit the sort shows the first page instead of failing"""
+
+        db.session.add_all([Club(name=f"Club {i:02}") for i in range(30)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for values in (["abc", "x"], [1, 2], [{"a": 1}, {"b": 2}], ["Club 05"], ["Club 05", 1, 2], ["Club 05", True], ["Club 05", None], "Club 05"):
+                cursor = urlsafe_b64encode(json.dumps(values).encode("utf8")).decode("ascii")
+                resp = c.get(f"/clubs?after={cursor}")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200, values)
+                self.assertIn("Club 00", html)
+                self.assertNotIn("Club 24", html)
+
+            cursor = urlsafe_b64encode(json.dumps(["abc", "x"]).encode("utf8")).decode("ascii")
+            self.assertEqual(c.get(f"/books/search/local?q=club&after={cursor}").status_code, 200)
+
+    def test_search_local_books(self):
+        """Local search matches title/author prefixes, ignoring case and accents"""
+
+        db.session.add_all([
+            Book(title="Les Misérables", author="Victor Hugo", publish_date="1862"),
+            Book(title="The Hobbit", author="J.R.R. Tolkien", publish_date="1937"),
+            Book(title="The Hunchback of Notre-Dame", author="Victor Hugo", publish_date="1831")])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/books/search/local?q=miserab")
+            titles = [book["title"] for book in resp.json["books"]]
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(titles, ["Les Misérables"])
+
+            titles = [book["title"] for book in c.get("/books/search/local?q=HUGO").json["books"]]
+            self.assertEqual(sorted(titles), ["Les Misérables", "The Hunchback of Notre-Dame"])
+
+            self.assertEqual(c.get("/books/search/local?q=tolk hob").json["books"][0]["title"], "The Hobbit")
+            self.assertEqual(c.get("/books/search/local?q=!!").json["books"], [])
+
+    def test_search_local_books_pages(self):
+        """Paging through a search returns every match once, even when they all rank the same"""
+
+        db.session.add_all([Book(title=f"Dragon {i:02}", author="Author", publish_date="2021") for i in range(60)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            titles = []
+            pages = 0
+            url = "/books/search/local?q=dragon"
+            while url:
+                resp = c.get(url)
+                titles += [book["title"] for book in resp.json["books"]]
+                pages += 1
+                url = resp.json["next"] and f"/books/search/local?q=dragon&after={resp.json['next']}"
+
+            self.assertEqual(pages, 3)
+            self.assertEqual(sorted(titles), [f"Dragon {i:02}" for i in range(60)])
+
+    def test_show_book(self):
+        """Transform route looks the book up on OpenLibrary and stores it in the session, or 404s if OpenLibrary doesn't have it"""
+
+        with StubServer() as stub, self.client as c:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/books/OL7353617M/transform")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location.split("/", 3)[-1], "books/show")
+
+            with c.session_transaction() as sess:
+                self.assertEqual(sess["book"]["title"], "The Hobbit")
+                self.assertEqual(sess["book"]["author"], "J.R.R. Tolkien")
+
+            # An edition OpenLibrary doesn't know is a 404
+            resp = c.post("/books/OL0M/transform")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_show_book_local_first(self):
+        """Books already in the catalog are shown without asking OpenLibrary"""
+
+        with StubServer() as stub, self.client as c:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/books/OL7353617M/transform")
+            c.post("/books/add")
+            self.assertEqual(stub.hits, 2)
+
+            book = Book.query.one()
+            self.assertEqual((book.ol_edition_key, book.isbn13), ("OL7353617M", "9780261102217"))
+
+            # A fresh cache, so only the catalog can answer
+            openlibrary.cache.clear()
+            with record_queries() as stats:
+                resp = c.post("/books/OL7353617M/transform")
+
+            self.assertEqual(resp.location.split("/", 3)[-1], "books/show")
+            self.assertEqual(stub.hits, 2)
+            self.assertEqual(len([s for s in stats.statements if "FROM books" in s]), 1)
+            with c.session_transaction() as sess:
+                self.assertEqual(sess["book"]["title"], "The Hobbit")
+
+    def test_show_book_by_isbn_stores_key(self):
+        """A catalog book found by ISBN gets the edition key it was asked for, so the next view doesn't ask OpenLibrary"""
+
+        db.session.add(Book(title="The Hobbit", author="J.R.R. Tolkien", publish_date="1937", isbn13="9780261102217"))
+        db.session.commit()
+
+        with StubServer() as stub, self.client as c:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/books/OL7353617M/transform")
+            self.assertEqual(stub.hits, 1)
+            self.assertEqual(Book.query.one().ol_edition_key, "OL7353617M")
+
+            openlibrary.cache.clear()
+            c.post("/books/OL7353617M/transform")
+            self.assertEqual(stub.hits, 1)
+
+    def test_import_books(self):
+        """Bulk import adds every known key in one go, reuses existing books and shelves them for the club"""
+
+        club = Club(name="Importers")
+        db.session.add(club)
+        db.session.commit()
+        db.session.add(Membership(user_id=self.testuser_id, club_id=club.id, admin=True))
+        db.session.commit()
+        club_id = club.id
+
+        with StubServer() as stub, self.client as c:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            self.assertEqual(c.post("/api/books/import", json={"keys": ["OL7353617M"]}).status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/api/books/import", json={"keys": ["OL7353617M", "9780765326355", "OL0M", "hobbit"], "club_id": club_id})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["added"], 2)
+            self.assertEqual(resp.json["not_found"], ["OL0M"])
+            self.assertEqual(resp.json["invalid"], ["hobbit"])
+            self.assertEqual(stub.hits, 1)
+            self.assertEqual(Read.query.filter_by(club_id=club_id).count(), 2)
+
+            resp = c.post("/api/books/import", json={"keys": ["9780261102217"], "club_id": club_id})
+            self.assertEqual(resp.json["existing"], 1)
+            self.assertEqual(Book.query.count(), 2)
+            self.assertEqual(Read.query.filter_by(club_id=club_id).count(), 2)
+
+            self.assertEqual(c.post("/api/books/import", json={"keys": "OL7353617M"}).status_code, 400)
+            for bad_id in ("1", str(club_id), 1.5, True, [club_id], {"id": club_id}):
+                self.assertEqual(c.post("/api/books/import", json={"keys": ["OL7353617M"], "club_id": bad_id}).status_code, 400, bad_id)
+
+    def test_search_openlibrary(self):
+        """Search proxy returns trimmed pages of OpenLibrary results"""
+
+        with StubServer() as stub, self.client as c:
+            openlibrary.configure(base_url=stub.url)
+            self.addCleanup(openlibrary.init_app, app)
+
+            self.assertEqual(c.get("/api/books/search?q=hobbit").status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/api/books/search?q=the&by=title")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["total"], 2)
+            self.assertIsNone(resp.json["next"])
+            self.assertEqual({book["id"] for book in resp.json["books"]}, {"OL7353617M", "OL24364628M"})
+
+            self.assertEqual(c.get("/api/books/search?q=tolkien&by=author").json["books"][0]["title"], "The Hobbit")
+            self.assertEqual(c.get("/api/books/search?q=hobbit&by=isbn").status_code, 400)
+            self.assertEqual(c.get("/api/books/search?q=hobbit&page=0").status_code, 400)
+
+    def test_image_proxy(self):
+        """Remote images are fetched once, resized, and served from content-hash names with far future caching"""
+
+        from tempfile import TemporaryDirectory
+        from app import thumbnail
+        from images import images, ImageError
+        from assets import assets
+
+        with StubServer() as stub, TemporaryDirectory() as image_dir, self.client as c:
+            images.configure(image_dir, app.config["SECRET_KEY"], allow_private=True)
+            self.addCleanup(images.init_app, app)
+
+            cover = f"{stub.url}/b/id/6979861-M.jpg"
+            with app.test_request_context():
+                proxy_url = thumbnail(cover, 180)
+                self.assertEqual(thumbnail("/static/images/placeholder.png", 180), assets.url("images/placeholder.png"))
+
+            resp = c.get(proxy_url)
+            self.assertEqual(resp.status_code, 302)
+            image_url = "/" + resp.location.split("/", 3)[-1]
+
+            resp = c.get(image_url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+
+            from PIL import Image
+            from io import BytesIO
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (120, 180))
+
+            # Once stored, pages link straight to the thumbnail and upstream isn't asked again
+            with app.test_request_context():
+                self.assertEqual(thumbnail(cover, 180), image_url)
+            c.get(proxy_url)
+            self.assertEqual(stub.hits, 1)
+
+            # Tampered URLs aren't fetched
+            self.assertEqual(c.get(proxy_url.replace("6979861", "1")).status_code, 404)
+
+            images.configure(image_dir, app.config["SECRET_KEY"])
+            with self.assertRaises(ImageError):
+                images.check_host(cover)
+
+            # A name that resolved to a public address for check_host but connects to a private one is still refused
+            images.check_host = lambda url: None
+            with self.assertRaises(ImageError):
+                images.download(cover)
+            del images.check_host
+            self.assertEqual(stub.hits, 1)
+
+    def test_config_profiles(self):
+        """Only the dev profile logs SQL and loads the debug toolbar, and only the test profile lowers the bcrypt cost"""
+
+        from passwords import hasher
+        from images import images
+
+        # Building an app points the models and extensions at it; point them back at the test app afterwards
+        self.addCleanup(setattr, db, "app", app)
+        for extension in (hasher, openlibrary, images):
+            self.addCleanup(extension.init_app, app)
+
+        self.assertEqual(hasher.rounds, 4)
+
+        prod = create_app("prod")
+        self.assertFalse(prod.config["SQLALCHEMY_ECHO"])
+        self.assertNotIn("_debug_toolbar.static", prod.view_functions)
+        self.assertEqual(hasher.rounds, prod.config["BCRYPT_LOG_ROUNDS"])
+        self.assertGreater(hasher.rounds, 4)
+
+        dev = create_app("dev")
+        self.assertTrue(dev.config["SQLALCHEMY_ECHO"])
+        self.assertIn("_debug_toolbar.static", dev.view_functions)
+
+    def test_warmup(self):
+        """Warmup compiles every template and leaves open connections in the pool"""
+
+        from app import warmup
+
+        warmup(app)
+
+        with app.app_context():
+            self.assertGreaterEqual(db.engine.pool.checkedin(), app.config["WARMUP_CONNECTIONS"])
+        self.assertIn("clubs/member-details.html", [key[1] for key in app.jinja_env.cache.keys()])
@@ -1,5 +1,7 @@
 from flask import request
 
+COVERS_URL = "https://covers.openlibrary.org/b/id/"
+
 def transform_book_res(data):
     """Takes the response from Open Library's Works API and transforms into an instance of the Book model"""
 
@@ -10,11 +12,14 @@ def transform_book_res(data):
     try:
         author = data["authors"][0]["name"]
     except:
-        author = "Author not available"
+        # Dump records only link authors by key, but often name them in by_statement
+        author = data.get("by_statement") or "Author not available"
     try:
         image = data["cover"]['medium']
     except:
-        image = "/static/images/placeholder.png"
+        # Dump records list cover IDs instead of URLs; negative IDs are placeholders
+        covers = [cover for cover in data.get("covers", []) if cover and cover > 0]
+        image = f"{COVERS_URL}{covers[0]}-M.jpg" if covers else "/static/images/placeholder.png"
     try:
         num_pages = data["number_of_pages"]
     except:
@@ -23,11 +28,29 @@ def transform_book_res(data):
         publish_date = data["publish_date"]
     except:
         publish_date = "Publish date not available"
+    try:
+        ol_edition_key = data["identifiers"]["openlibrary"][0]
+    except:
+        # Edition and dump records carry it in their key instead
+        key = data.get("key", "")
+        ol_edition_key = key[len("/books/"):] if key.startswith("/books/") else None
+    try:
+        isbn13 = data["identifiers"]["isbn_13"][0]
+    except:
+        isbn13 = (data.get("isbn_13") or [None])[0]
 
     return {
-        "title": title, 
-        "author": author, 
+        "title": title,
+        "author": author,
         "image": image,
         "num_pages": num_pages,
-        "publish_date": publish_date
-    }
\ No newline at end of file
+        "publish_date": publish_date,
+        "ol_edition_key": ol_edition_key,
+        "isbn13": isbn13
+    }
+
+def transform_book_res_many(records):
+    """Transform an iterable of Open Library records, yielding Book dicts as it goes so large batches never sit in memory twice"""
+
+    for data in records:
+        yield transform_book_res(data)